@@ -9,4 +9,4 @@ config = Config()
 DIR = os.path.abspath(__file__)
 DIR = os.path.dirname(DIR)
 
-from transact import Transact
+from transact import Transact, TransactBatcher
@@ -10,7 +10,7 @@ from decimal import Decimal
 from sqlalchemy.orm.attributes import manager_of_class
 
 from pooldlib.sqlalchemy import transaction_session
-from pooldlib.postgresql import Balance as BalanceModel
+from pooldlib.postgresql import db, Balance as BalanceModel
 
 
 BALANCE_TABLE = manager_of_class(BalanceModel).mapper.mapped_table
@@ -19,7 +19,10 @@ BALANCE_TABLE = manager_of_class(BalanceModel).mapper.mapped_table
 def get(for_update=False, **kwargs):
     """Retrieve :class:`pooldlib.postgresql.models.Balance` objects from the
     database. If ``for_update`` is `True` it is assumed that the caller wants a
-    single balance object retrieved.
+    single balance object retrieved. If that balance is striped (see
+    :func:`pooldlib.api.balance.create_stripes`) only its first stripe is
+    locked and returned; use :func:`pooldlib.api.balance.lock` to lock every
+    stripe.
 
     :param for_update: If `True` the ``FOR UPDATE`` directive will be used, locking the row for an ``UPDATE`` query.
     :type for_update: boolean, default `False`
@@ -32,7 +35,7 @@ def get(for_update=False, **kwargs):
     filters = dict()
     for (f, v) in fields:
         filters[f] = v
-    q = q.filter_by(**filters)
+    q = q.filter_by(**filters).order_by(BalanceModel.stripe)
     if for_update:
         q = q.with_lockmode('update')
         balance = q.first()
@@ -41,6 +44,107 @@ def get(for_update=False, **kwargs):
     return balance
 
 
+def lock(balance_ids):
+    """Lock all :class:`pooldlib.postgresql.models.Balance` rows with ids in
+    ``balance_ids`` using a single ``SELECT ... FOR UPDATE`` query. Rows are
+    locked in ascending id order, so any two callers locking overlapping sets
+    of balances cannot deadlock against each other. The returned balances are
+    refreshed with the values read under the lock.
+
+    :param balance_ids: Ids of the balances to lock.
+    :type balance_ids: list of longs
+
+    :returns: list of :class:`pooldlib.postgresql.models.Balance`, ordered by id.
+    """
+    return refresh(balance_ids, for_update=True)
+
+
+def refresh(balance_ids, for_update=False):
+    """Re-read all :class:`pooldlib.postgresql.models.Balance` rows with ids in
+    ``balance_ids`` using a single query, ordered by id, overwriting any values
+    previously loaded into the session.
+
+    :param balance_ids: Ids of the balances to read.
+    :type balance_ids: list of longs
+    :param for_update: If `True` the ``FOR UPDATE`` directive will be used, see
+                       :func:`pooldlib.api.balance.lock`.
+    :type for_update: boolean, default `False`
+
+    :returns: list of :class:`pooldlib.postgresql.models.Balance`, ordered by id.
+    """
+    if not balance_ids:
+        return list()
+
+    q = BalanceModel.query.filter(BalanceModel.id.in_(balance_ids))\
+                          .order_by(BalanceModel.id)\
+                          .populate_existing()
+    if for_update:
+        q = q.with_lockmode('update')
+    return q.all()
+
+
+def apply_delta(balance_id, delta):
+    """Atomically change the amount of a balance by ``delta`` in the database
+    with a single ``UPDATE ... RETURNING`` statement, without first reading
+    the balance. If ``delta`` is negative the update is guarded so that the
+    balance is never overdrawn.
+
+    :param balance_id: Id of the balance to update.
+    :type balance_id: long
+    :param delta: The amount to add to the balance (negative to debit).
+    :type delta: decimal.Decimal
+
+    :returns: decimal.Decimal, the new balance amount, or `None` if the
+              balance has insufficient funds for ``delta``.
+    """
+    amount = BALANCE_TABLE.c.amount
+    stmt = BALANCE_TABLE.update().where(BALANCE_TABLE.c.id == balance_id)
+    if delta < Decimal('0.0000'):
+        stmt = stmt.where(amount + delta >= Decimal('0.0000'))
+    # Bump the version as well so optimistic writers notice the change.
+    stmt = stmt.values(amount=amount + delta,
+                       version=BALANCE_TABLE.c.version + 1).returning(amount)
+    row = db.session.execute(stmt).first()
+    if row is None:
+        return None
+    return row[0]
+
+
+def create_stripes(balance, stripes):
+    """Split ``balance`` across ``stripes`` rows. Credits made through
+    :class:`pooldlib.Transact` are spread over the stripes so that concurrent
+    transfers to the same balance do not wait on a single row lock, while
+    reads through ``balance_for_currency`` return the sum of all stripes.
+    Existing funds remain in the original row. Striping is never reduced.
+
+    :param balance: The balance to stripe.
+    :type balance: :class:`pooldlib.postgresql.models.Balance`
+    :param stripes: The total number of rows the balance should span.
+    :type stripes: integer
+
+    :returns: list of :class:`pooldlib.postgresql.models.Balance`, all stripes.
+    """
+    existing = get(currency_id=balance.currency_id,
+                   user_id=balance.user_id,
+                   campaign_id=balance.campaign_id)
+    new = list()
+    for stripe in range(len(existing), stripes):
+        b = BalanceModel()
+        b.enabled = True
+        b.amount = Decimal('0.0000')
+        b.currency_id = balance.currency_id
+        b.user_id = balance.user_id
+        b.campaign_id = balance.campaign_id
+        b.type = balance.type
+        b.stripe = stripe
+        new.append(b)
+
+    with transaction_session(auto_commit=True) as session:
+        for b in new:
+            session.add(b)
+    return existing + new
+
+
 def create_for_campaign(campaign, currency):
     b = BalanceModel()
     b.enabled = True
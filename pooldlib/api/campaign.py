@@ -6,34 +6,62 @@ pooldlib.api.campaign
 
 """
 import pytz
+import base64
+from uuid import uuid4 as uuid
 from datetime import datetime
+from multiprocessing.pool import ThreadPool
 
+from sqlalchemy import bindparam, func, literal, or_, select, tuple_
+from sqlalchemy.orm import joinedload
 from sqlalchemy.exc import (DataError as SQLAlchemyDataError,
                             IntegrityError as SQLAlchemyIntegrityError)
 
+import pooldlib.log
 from pooldlib.sqlalchemy import transaction_session
+from pooldlib.postgresql import db
 from pooldlib.postgresql import (Campaign as CampaignModel,
                                  Invitee as InviteeModel,
                                  CampaignGoal as CampaignGoalModel,
                                  CampaignMeta as CampaignMetaModel,
                                  CampaignGoalMeta as CampaignGoalMetaModel,
                                  CampaignAssociation as CampaignAssociationModel,
-                                 CampaignGoalAssociation as CampaignGoalAssociationModel)
+                                 CampaignGoalAssociation as CampaignGoalAssociationModel,
+                                 CampaignStats as CampaignStatsModel,
+                                 CampaignGoalStats as CampaignGoalStatsModel,
+                                 User as UserModel,
+                                 UserMeta as UserMetaModel)
+from pooldlib.postgresql.common import StripedBalance
 from pooldlib.api import balance as _balance
+from pooldlib.api import fee as _fee
 from pooldlib.exceptions import (InvalidUserRoleError,
                                  InvalidGoalParticipationNameError,
                                  UnknownCampaignAssociationError,
                                  UnknownCampaignGoalAssociationError,
                                  DuplicateCampaignUserAssociationError,
                                  DuplicateCampaignGoalUserAssociationError,
-                                 PreviousUserContributionError)
+                                 PreviousUserContributionError,
+                                 PledgeCollectionPendingError,
+                                 StripeCustomerAccountError,
+                                 UserCreditCardDeclinedError,
+                                 ExternalAPIUsageError)
+
+
+logger = pooldlib.log.get_logger(None, logging_name=__name__)
+
+# Default number of rows per page of :func:`campaigns_page` and
+# :func:`goals_page`, and per chunk of :func:`iter_campaigns` and
+# :func:`iter_goals`.
+PAGE_SIZE = 50
+CHUNK_SIZE = 1000
+
+_CURSOR_DATETIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
 
 
-# TODO :: Enable pagination
 def campaigns(campaign_ids, filter_inactive=True):
     """Return all campaigns with ids in ``campaign_ids``. If ``filter_inactive``
     is `True`, return only those whos `start` and `endtime` make it currently active.
-    If ``campaign_ids`` is `None`, return all campaigns.
+    If ``campaign_ids`` is `None`, return all campaigns. To retrieve a large
+    number of campaigns use :func:`campaigns_page` or :func:`iter_campaigns`.
 
     :param campaign_ids: List of campaign IDs to return. Pass `None` to return
                           **all** campaigns.
@@ -45,6 +73,48 @@ def campaigns(campaign_ids, filter_inactive=True):
 
     :returns: list of :class:`pooldlib.postgresql.models.Communitiy`
     """
+    campaign = _campaigns_query(campaign_ids, filter_inactive).all()
+    return campaign
+
+
+def campaigns_page(campaign_ids, filter_inactive=True, limit=PAGE_SIZE, cursor=None):
+    """Return one page of the campaigns returned by :func:`campaigns`, ordered by
+    `start` and id. Pages are selected by keyset rather than offset, so every
+    page costs the same to retrieve however far into the results it is.
+
+    :param campaign_ids: List of campaign IDs to return. Pass `None` to return
+                          **all** campaigns.
+    :type campaign_id: list of type `long`.
+    :param filter_inactive: Return campaigns only if they are currently active.
+    :type filter_inactive: boolean
+    :param limit: The maximum number of campaigns to return.
+    :type limit: integer
+    :param cursor: The cursor returned with the previous page, `None` for the first page.
+    :type cursor: string
+
+    :raises: ValueError
+
+    :returns: tuple -- ``(campaigns, cursor)``, ``cursor`` is `None` if this is the last page.
+    """
+    q = _campaigns_query(campaign_ids, filter_inactive)
+    return _page(q, CampaignModel, limit, cursor)
+
+
+def iter_campaigns(campaign_ids, filter_inactive=True, chunk_size=CHUNK_SIZE):
+    """Iterate over the campaigns returned by :func:`campaigns`, ordered by
+    `start` and id, reading ``chunk_size`` of them from the database at a time
+    rather than loading all of them at once.
+
+    :param chunk_size: The number of campaigns to read at a time.
+    :type chunk_size: integer
+
+    :returns: generator of :class:`pooldlib.postgresql.models.Campaign`
+    """
+    q = _campaigns_query(campaign_ids, filter_inactive)
+    return _stream(q, CampaignModel, chunk_size)
+
+
+def _campaigns_query(campaign_ids, filter_inactive):
     if campaign_ids and not isinstance(campaign_ids, (list, tuple)):
         campaign_ids = [campaign_ids]
 
@@ -55,8 +125,7 @@ def campaigns(campaign_ids, filter_inactive=True):
         now = pytz.UTC.localize(datetime.utcnow())
         q = q.filter(CampaignModel.start <= now)\
              .filter(CampaignModel.end > now)
-    campaign = q.all()
-    return campaign
+    return q
 
 
 def get(campaign_id, filter_inactive=False):
@@ -137,23 +206,18 @@ def create(organizer, name, description, start=None, end=None, **kwargs):
     campaign.start = start or pytz.UTC.localize(datetime.utcnow())
     campaign.end = end
 
+    # NOTE :: The campaign, its metadata and the organizer association are
+    # NOTE :: written in a single transaction. The flush inserts the campaign
+    # NOTE :: with ``INSERT ... RETURNING id``, without ending the transaction.
     with transaction_session() as session:
         session.add(campaign)
+        session.flush()
+        if kwargs:
+            meta_rows = _metadata_rows('campaign_id', campaign.id, kwargs)
+            session.execute(CampaignMetaModel.__table__.insert().values(meta_rows))
+        # NOTE :: A new campaign has no goals to associate the organizer with.
+        _associate_user(session, campaign, organizer, 'organizer', 'participating', campaign_goals=())
         session.commit()
-
-    meta = list()
-    for (k, v) in kwargs.items():
-        cm = CampaignMetaModel()
-        cm.key = k
-        cm.value = v
-        cm.campaign_id = campaign.id
-        meta.append(cm)
-
-    with transaction_session(auto_commit=True) as session:
-        for cm in meta:
-            session.add(cm)
-
-    associate_user(campaign, organizer, 'organizer', 'participating')
     return campaign
 
 
@@ -251,10 +315,14 @@ def balance(campaign, currency, get_or_create=False, for_update=False):
                           one will be created for ``currency``.
     :type get_or_create: boolean
     :param for_update: If `True`, the ``SELECT FOR UPDATE`` directive will be
-                       used when retrieving the target balance.
+                       used when retrieving the target balance. For a
+                       striped balance only the first stripe is locked and
+                       returned, see :func:`pooldlib.api.balance.get`.
     :type for_update: boolean
 
-    :returns: :class:`pooldlib.postgresql.models.Balance`
+    :returns: :class:`pooldlib.postgresql.models.Balance`, or a
+              :class:`pooldlib.postgresql.common.StripedBalance` if the
+              balance is striped and ``for_update`` is `False`.
     """
     b = _balance.get(for_update=for_update,
                      currency_id=currency.id,
@@ -263,43 +331,126 @@ def balance(campaign, currency, get_or_create=False, for_update=False):
     if not b and get_or_create:
         b = _balance.create_for_campaign(campaign, currency)
 
-    if isinstance(b, (tuple, list)):
-        b = b[0]
+    if isinstance(b, (tuple, list)) and len(b) > 1:
+        b = StripedBalance(b)
+    elif isinstance(b, (tuple, list)):
+        b = b[0] if b else None
     return b or None
 
 
+def stripe_balance(campaign, currency, stripes):
+    """Split a campaign's balance for ``currency`` across ``stripes`` rows
+    to relieve lock contention on campaigns receiving many concurrent
+    contributions. Reads through :func:`pooldlib.api.campaign.balance`
+    return the sum of all stripes.
+
+    :param campaign: Campaign whose balance to stripe.
+    :type campaign: :class:`pooldlib.postgresql.models.Campaign`
+    :param currency: Currency of the balance to stripe.
+    :type currency: :class:`pooldlib.postgresql.models.Currency`
+    :param stripes: The total number of rows the balance should span.
+    :type stripes: integer
+
+    :returns: :class:`pooldlib.postgresql.common.StripedBalance`
+    """
+    b = balance(campaign, currency, get_or_create=True)
+    head = b.stripes[0] if isinstance(b, StripedBalance) else b
+    return StripedBalance(_balance.create_stripes(head, stripes))
+
+
 def add_invites(campaign, emails):
-    invites = list()
+    """Invite every address in ``emails`` to ``campaign``. Invitations to an
+    address belonging to a user are associated with that user. Addresses
+    already invited in any case, or belonging to a user who was already
+    invited, are skipped. However many addresses are given, users are looked up with one
+    query, existing invitations with another and the new invitations are
+    written with a single ``INSERT``.
+
+    :param campaign: The campaign to which to invite.
+    :type campaign: :class:`pooldlib.postgresql.models.Campaign`
+    :param emails: The email addresses to invite.
+    :type emails: list of strings
+
+    :returns: list of :class:`pooldlib.postgresql.models.Invitee`, the new invitations.
+    """
+    emails = list(emails)
+    if not emails:
+        return list()
+
+    lowered = set(e.lower() for e in emails)
+    users = dict()
+    q = db.session.query(UserMetaModel.value, UserModel)\
+                  .join(UserModel, UserMetaModel.user_id == UserModel.id)\
+                  .filter(UserModel.enabled == True)\
+                  .filter(UserMetaModel.key == 'email')\
+                  .filter(UserMetaModel.value.in_(lowered))
+    for (email, usr) in q:
+        users.setdefault(email, usr)
+
+    criteria = [func.lower(InviteeModel.email).in_(lowered)]
+    if users:
+        criteria.append(InviteeModel.user_id.in_(set(u.id for u in users.values())))
+    q = db.session.query(InviteeModel.email, InviteeModel.user_id)\
+                  .filter(InviteeModel.campaign_id == campaign.id)\
+                  .filter(or_(*criteria))
+    invited = set()
+    for (email, user_id) in q:
+        invited.add(('email', email.lower()))
+        if user_id is not None:
+            invited.add(('user', user_id))
+
+    rows = list()
     for email in emails:
-        i = add_invite(campaign, email)
-        if i is not None:
-            invites.append(i)
-    return invites
+        usr = users.get(email.lower())
+        keys = [('email', email.lower())]
+        if usr is not None:
+            keys.append(('user', usr.id))
+        if any(k in invited for k in keys):
+            continue
+        invited.update(keys)
+        rows.append(dict(id=uuid(),
+                         email=email,
+                         campaign_id=campaign.id,
+                         user_id=usr.id if usr is not None else None))
+    if not rows:
+        return list()
+
+    with transaction_session() as session:
+        session.execute(InviteeModel.__table__.insert().values(rows))
+        CampaignStatsModel.increment(session, campaign.id, invited=len(rows))
+        session.commit()
+
+    ids = [r['id'] for r in rows]
+    invites = dict((i.id, i) for i in InviteeModel.query.filter(InviteeModel.id.in_(ids)))
+    return [invites[id] for id in ids]
 
 
 def add_invite(campaign, email):
-    from pooldlib.api import user
-    usr = user.get_by_email(email)
-
-    q = InviteeModel.query.filter_by(campaign_id=campaign.id)
-    if usr is not None:
-        q = q.filter_by(user_id=usr.id)
-    else:
-        q = q.filter_by(email=email)
-    existing_invite = q.first()
-    if existing_invite is not None:
-        return None
+    """Invite ``email`` to ``campaign``, see :func:`add_invites`.
 
-    invite = InviteeModel()
-    invite.email = email
-    invite.campaign_id = campaign.id
-    if usr is not None:
-        invite.user_id = usr.id
+    :returns: :class:`pooldlib.postgresql.models.Invitee`, or `None` if the
+              address was already invited.
+    """
+    invites = add_invites(campaign, [email])
+    return invites[0] if invites else None
 
-    with transaction_session() as session:
-        session.add(invite)
-        session.commit()
-    return invite
+
+def _accept_invitations(session, campaign, user, accepted):
+    """Mark the pending invitations of ``user`` to ``campaign``, by user or by
+    email address in any case, as accepted with a single ``UPDATE``.
+
+    :returns: integer, the number of invitations accepted.
+    """
+    invitee = InviteeModel.__table__
+    criteria = [invitee.c.user_id == user.id]
+    email = getattr(user, 'email', None)
+    if email:
+        criteria.append(func.lower(invitee.c.email) == email.lower())
+    stmt = invitee.update().where(invitee.c.campaign_id == campaign.id)\
+                           .where(invitee.c.accepted == None)\
+                           .where(or_(*criteria))\
+                           .values(accepted=accepted, user_id=user.id, modified=accepted)
+    return session.execute(stmt).rowcount
 
 
 def associate_user(campaign, user, role, goal_participation, pledge=None):
@@ -318,13 +469,39 @@ def associate_user(campaign, user, role, goal_participation, pledge=None):
 
     :raises: :class:`pooldlib.exceptions.InvalidUserRoleError`
              :class:`pooldlib.exceptions.DuplicateCampaignUserAssociationError`
+             :class:`pooldlib.exceptions.InvalidGoalParticipationNameError`
+             :class:`pooldlib.exceptions.DuplicateCampaignGoalUserAssociationError`
+
+    :return: :class:`pooldlib.postgresql.models.CampaignAssociation`
+    """
+    with transaction_session() as session:
+        ca = _associate_user(session, campaign, user, role, goal_participation, pledge=pledge)
+        session.commit()
+    return ca
+
+
+def _associate_user(session, campaign, user, role, goal_participation, pledge=None, campaign_goals=None):
+    """Stage the association of ``user`` with ``campaign`` and its goals in
+    ``session``, accept any invitations of the user to the campaign and
+    update the campaign's :class:`pooldlib.postgresql.models.CampaignStats`.
+    The caller is responsible for committing the session.
+
+    :param campaign_goals: The goals to associate the user with, by default
+                           all goals of the campaign.
+    :type campaign_goals: list of :class:`pooldlib.postgresql.models.CampaignGoal`
+
+    :raises: :class:`pooldlib.exceptions.InvalidUserRoleError`
+             :class:`pooldlib.exceptions.DuplicateCampaignUserAssociationError`
+             :class:`pooldlib.exceptions.InvalidGoalParticipationNameError`
+             :class:`pooldlib.exceptions.DuplicateCampaignGoalUserAssociationError`
 
     :return: :class:`pooldlib.postgresql.models.CampaignAssociation`
     """
     # NOTE :: We intentionally associate the user with all existing goals, not just
     # NOTE :: active ones. Date stamps can distinguish users who joined prior to goal
     # NOTE :: becoming inactive.
-    campaign_goals = goals(campaign, filter_inactive=False)
+    if campaign_goals is None:
+        campaign_goals = goals(campaign, filter_inactive=False)
     ca = CampaignAssociationModel()
     ca.enabled = True
     ca.campaign = campaign
@@ -335,30 +512,50 @@ def associate_user(campaign, user, role, goal_participation, pledge=None):
         ca.pledge = pledge
         if campaign_goals:
             goal_pledge = pledge / len(campaign_goals)
-    for goal in campaign_goals:
-        associate_user_with_goal(goal, user, goal_participation, pledge=goal_pledge)
-
-    # Check to see if this user was invited and mark them as accepted
-    update_invitee = None
-    for invitee in campaign.invitees:
-        if invitee.user == user or invitee.email == user.email:
-            invitee.accepted = pytz.UTC.localize(datetime.utcnow())
-            invitee.user = user
-            update_invitee = invitee
-
-    with transaction_session() as session:
-        session.add(ca)
-        if update_invitee is not None:
-            session.add(update_invitee)
+    now = pytz.UTC.localize(datetime.utcnow())
+    goal_rows = [dict(user_id=user.id,
+                      campaign_id=campaign.id,
+                      campaign_goal_id=goal.id,
+                      participation=goal_participation,
+                      pledge=goal_pledge) for goal in campaign_goals]
+
+    # NOTE :: The goal associations and the campaign association are written
+    # NOTE :: in a single transaction, the goal associations by one statement.
+    if goal_rows:
+        insert = CampaignGoalAssociationModel.__table__.insert().values(goal_rows)
         try:
-            session.commit()
+            session.execute(insert)
         except SQLAlchemyDataError:
-            raise InvalidUserRoleError()
+            raise InvalidGoalParticipationNameError()
         except SQLAlchemyIntegrityError:
-            raise DuplicateCampaignUserAssociationError()
+            raise DuplicateCampaignGoalUserAssociationError()
+        goal_ids = [goal.id for goal in campaign_goals]
+        CampaignGoalStatsModel.increment(session, goal_ids, campaign.id, participants=1)
+    accepted = _accept_invitations(session, campaign, user, now)
+    session.add(ca)
+    try:
+        session.flush()
+    except SQLAlchemyDataError:
+        raise InvalidUserRoleError()
+    except SQLAlchemyIntegrityError:
+        raise DuplicateCampaignUserAssociationError()
+
+    deltas = dict(participants=1, accepted=accepted)
+    if pledge is not None:
+        deltas['pledged'] = pledge
+    CampaignStatsModel.increment(session, campaign.id, **deltas)
     return ca
 
 
+def _metadata_rows(column, owner_id, metadata):
+    """Build rows for a multi-row insert of key-value ``metadata`` belonging
+    to the campaign or campaign goal ``owner_id``, referenced by ``column``.
+
+    :returns: list of dictionaries
+    """
+    return [{column: owner_id, 'key': k, 'value': v} for (k, v) in metadata.items()]
+
+
 def get_associations(campaign, user=None):
     """Retrieve all :class:`pooldlib.postgresql.models.CampaignAssociation`
     objects associated with the specified campaign. If ``user`` is not `None`,
@@ -379,6 +576,285 @@ def get_associations(campaign, user=None):
     return q.all()
 
 
+def collect_pledges(campaign, currency, fees, concurrency=8, chunk_size=100):
+    """Collect the pledge of every participant of ``campaign`` as a payment to
+    its organizer, see :func:`pooldlib.api.user.payment_to_campaign`. Up to
+    ``concurrency`` participants are charged with Stripe at once, after which
+    the ledger entries of the successful charges are written, ``chunk_size``
+    participants per database transaction.
+
+    Collection may be run again after a failure without charging anyone
+    twice. A participant's association is marked as collecting before they
+    are charged, the Stripe charge id is recorded as soon as the charge
+    succeeds, and the association is marked as collected along with the
+    ledger entries. The Stripe charge and the ledger entries are both made
+    under an idempotency key of the association. When run again:
+
+        - Collected participants are skipped.
+        - Participants charged but not collected are not charged again, only
+          their ledger entries are written.
+        - Participants whose collection was started, but whose charge was
+          never recorded, may or may not have been charged. They are reported
+          with a :class:`pooldlib.exceptions.PledgeCollectionPendingError`.
+
+    A participant who cannot be charged, or whose entries cannot be written,
+    does not stop the collection, the error is recorded in their entry of the
+    returned report instead. Participants whose charge was declined may be
+    collected again.
+
+    :param campaign: The campaign for which to collect pledges.
+    :type campaign: :class:`pooldlib.postgresql.models.Campaign`
+    :param currency: The currency in which to charge participants.
+    :type currency: :class:`pooldlib.postgresql.models.Currency`
+    :param fees: The fees to apply to each payment, or their names, see
+                 :func:`pooldlib.api.fee.schedule`.
+    :type fees: list of :class:`pooldlib.postgresql.models.Fee`
+    :param concurrency: The maximum number of simultaneous Stripe charges.
+    :type concurrency: integer
+    :param chunk_size: The maximum number of participants written per
+                       database transaction.
+    :type chunk_size: integer
+
+    :raises: :class:`pooldlib.exception.StripeUserAccountError`
+             :class:`pooldlib.exception.CampaignConfigurationError`
+
+    :returns: list of dict, one per uncollected participant with a pledge, keys:
+              user, amount, reference (the Stripe charge id), deposit_id,
+              withdrawal_id and error (`None` if the pledge was collected).
+    """
+    from pooldlib import Transact
+    # NOTE :: api.user imports this module, import it only when needed.
+    from pooldlib.api import user as _user
+
+    associations = CampaignAssociationModel.query.options(joinedload('user'))\
+                                                 .filter_by(enabled=True)\
+                                                 .filter(CampaignAssociationModel.campaign_id == campaign.id)\
+                                                 .filter(CampaignAssociationModel.pledge > 0)\
+                                                 .filter(CampaignAssociationModel.collected == None)\
+                                                 .all()
+    campaign_organizer = organizer(campaign)
+    schedule = _fee.schedule(fees)
+    report = list()
+    charged = list()
+    to_claim = list()
+    for association in associations:
+        result = dict(user=association.user,
+                      amount=association.pledge,
+                      reference=association.charge_reference,
+                      deposit_id=None,
+                      withdrawal_id=None,
+                      error=None)
+        report.append(result)
+        if association.charge_reference is not None:
+            (result['charge'], _, _) = _user._calculate_transaction_amounts(result['amount'], schedule)
+            charged.append((association, result))
+        elif association.collecting is not None:
+            result['error'] = _collection_pending_error(association)
+        else:
+            to_claim.append((association, result))
+
+    to_charge = list()
+    released = list()
+    claimed = _claim_pledges(campaign, to_claim)
+    try:
+        for (association, result) in claimed:
+            try:
+                campaign_organizer = _user._campaign_payment_organizer(association.user,
+                                                                       campaign,
+                                                                       organizer=campaign_organizer)
+            except StripeCustomerAccountError, e:
+                result['error'] = e
+                released.append(association)
+                continue
+            to_charge.append((association, result))
+    except Exception:
+        # Nobody has been charged, e.g. the organizer cannot be paid.
+        _record_charges(campaign, list(), [association for (association, result) in claimed])
+        raise
+
+    def charge(item):
+        (result, key) = item
+        try:
+            result['charge'] = _user._charge_for_campaign(result['user'],
+                                                          campaign,
+                                                          campaign_organizer,
+                                                          result['amount'],
+                                                          currency,
+                                                          schedule,
+                                                          idempotency_key=key)
+        # NOTE :: Catch everything, the charges already made must still be written.
+        except Exception, e:
+            result['error'] = e
+
+    # NOTE :: Claiming the pledges committed the session, load everything
+    # NOTE :: the charging threads read beforehand.
+    (campaign.id, currency.code)
+    keys = [(result, _pledge_key(association)) for (association, result) in to_charge]
+    pool = ThreadPool(concurrency)
+    try:
+        pool.map(charge, keys)
+    finally:
+        pool.close()
+        pool.join()
+
+    for (association, result) in to_charge:
+        if result['error'] is None:
+            (result['charge'], result['reference']) = result['charge']
+            charged.append((association, result))
+        elif isinstance(result['error'], _UNCHARGED_ERRORS):
+            released.append(association)
+    _record_charges(campaign, charged, released)
+
+    staged = list()
+    for (association, result) in charged:
+        transact_ledger = Transact(net=True)
+        ids = _user._stage_campaign_payment(transact_ledger,
+                                            result['user'],
+                                            campaign,
+                                            campaign_organizer,
+                                            result['amount'],
+                                            currency,
+                                            result.pop('charge'),
+                                            result['reference'])
+        (result['deposit_id'], result['withdrawal_id']) = ids
+        staged.append((association, result, transact_ledger))
+
+    for i in range(0, len(staged), chunk_size):
+        _write_collected_pledges(campaign, staged[i:i + chunk_size])
+    return report
+
+
+# Charge errors raised before Stripe could have charged the card.
+_UNCHARGED_ERRORS = (UserCreditCardDeclinedError, ExternalAPIUsageError)
+
+
+def _pledge_key(association):
+    """The idempotency key of the Stripe charge and ledger entries collecting
+    the pledge of ``association``.
+    """
+    return 'pledge:%s:%s' % (association.campaign_id, association.user_id)
+
+
+def _collection_pending_error(association):
+    msg = 'Collection of the pledge of user %s was started, but its charge was never recorded.'
+    msg %= association.user_id
+    return PledgeCollectionPendingError(msg)
+
+
+def _claim_pledges(campaign, pledges):
+    """Mark the association of each ``(association, result)`` in ``pledges``
+    as collecting, and commit, before any of them is charged. Associations
+    claimed meanwhile by another collection have the error recorded in their
+    ``result`` and are left out of the returned list.
+
+    :returns: list -- The ``(association, result)`` pairs claimed.
+    """
+    if not pledges:
+        return list()
+
+    table = CampaignAssociationModel.__table__
+    user_ids = [association.user_id for (association, result) in pledges]
+    stmt = table.update().where(table.c.campaign_id == campaign.id)\
+                         .where(table.c.user_id.in_(user_ids))\
+                         .where(table.c.collecting == None)\
+                         .values(collecting=pytz.UTC.localize(datetime.utcnow()))\
+                         .returning(table.c.user_id)
+    with transaction_session() as session:
+        claimed = set(row[0] for row in session.execute(stmt))
+        session.commit()
+
+    ret = list()
+    for (association, result) in pledges:
+        if association.user_id in claimed:
+            ret.append((association, result))
+        else:
+            result['error'] = _collection_pending_error(association)
+    return ret
+
+
+def _record_charges(campaign, charged, released):
+    """Record the Stripe charge id of each ``(association, result)`` in
+    ``charged``, and clear the collecting mark of each association in
+    ``released``, which was not charged, and commit.
+    """
+    table = CampaignAssociationModel.__table__
+    by_user = table.update().where(table.c.campaign_id == campaign.id)\
+                            .where(table.c.user_id == bindparam('_user_id'))
+    references = [dict(_user_id=association.user_id, _reference=result['reference'])
+                  for (association, result) in charged
+                  if association.charge_reference is None]
+    try:
+        with transaction_session() as session:
+            if references:
+                stmt = by_user.values(charge_reference=bindparam('_reference'))
+                session.execute(stmt, references)
+            if released:
+                stmt = by_user.values(collecting=None)
+                session.execute(stmt, [dict(_user_id=a.user_id) for a in released])
+            session.commit()
+    except Exception:
+        msg = 'Stripe charge completed, but it could not be recorded!'
+        for reference in references:
+            data = dict(user=reference['_user_id'],
+                        campaign=str(campaign),
+                        stripe_ref_number=reference['_reference'])
+            logger.transaction(msg, data=data)
+        raise
+
+
+def _write_collected_pledges(campaign, charged):
+    """Write the staged ledger entries of each ``(association, result,
+    transact_ledger)`` in ``charged`` and mark the association collected, in a
+    single database transaction. Every participant is written within its own
+    savepoint, as by :class:`pooldlib.TransactBatcher`, so that a failure is
+    recorded in the ``error`` of their ``result`` only.
+    """
+    from pooldlib.transact import PendingTransact
+
+    pending = list()
+    for (association, result, transact_ledger) in charged:
+        p = PendingTransact(transact_ledger, idempotency_key=_pledge_key(association))
+        pending.append((association, result, p))
+
+    try:
+        with transaction_session() as session:
+            # NOTE :: Participants share the campaign and organizer balances,
+            # NOTE :: lock every balance of the chunk once, in id order.
+            ids = set()
+            for (association, result, p) in pending:
+                ids.update(p.transact._balance_ids())
+            _balance.lock(sorted(ids))
+
+            for (association, result, p) in pending:
+                savepoint = session.begin_nested()
+                try:
+                    p.execute(session)
+                    association.collected = pytz.UTC.localize(datetime.utcnow())
+                    session.flush()
+                    savepoint.commit()
+                except SQLAlchemyIntegrityError, e:
+                    savepoint.rollback()
+                    if not p.executed_record():
+                        result['error'] = e
+                except Exception, e:
+                    savepoint.rollback()
+                    result['error'] = e
+            session.commit()
+    except Exception, e:
+        for (association, result, p) in pending:
+            result['error'] = result['error'] or e
+
+    for (association, result, p) in pending:
+        if result['error'] is not None:
+            (result['deposit_id'], result['withdrawal_id']) = (None, None)
+            msg = 'Stripe charge completed, but its ledger entries could not be written!'
+            data = dict(user=str(result['user']),
+                        campaign=str(campaign),
+                        stripe_ref_number=result['reference'],
+                        error=str(result['error']))
+            logger.transaction(msg, data=data)
+
+
 def update_user_association(campaign, user, role=None, pledge=None, only_active_goals=True):
     """Update an existing User/Campaign association to change the
     specified user's role in the campaign.
@@ -403,28 +879,34 @@ def update_user_association(campaign, user, role=None, pledge=None, only_active_
               "one with campaign.associate_user()."
         raise UnknownCampaignAssociationError(msg)
     ca = ca[0]
-    updated = False
-    if role is not None:
-        updated = ca.update_field('role', role)
-    if pledge is not None:
-        if ca.pledge is not None:
-            msg = "User %s has previously contributed to campaign '%s'"
-            msg %= (user.username, campaign.name)
-            raise PreviousUserContributionError(msg)
-        updated = ca.update_field('pledge', pledge)
-        goal_pledge = None
-        campaign_goals = goals(campaign, filter_inactive=only_active_goals)
-        if campaign_goals:
-            goal_pledge = pledge / len(campaign_goals)
-        for goal in campaign_goals:
-            update_user_goal_association(goal, user, pledge=goal_pledge)
-
-    if updated:
-        with transaction_session() as session:
+    # NOTE :: The association, its goal associations and the campaign's
+    # NOTE :: counters are updated in a single transaction, rolled back if
+    # NOTE :: any of the updates fails.
+    with transaction_session() as session:
+        updated = False
+        if role is not None:
+            updated = ca.update_field('role', role)
+        if pledge is not None:
+            if ca.pledge is not None:
+                msg = "User %s has previously contributed to campaign '%s'"
+                msg %= (user.username, campaign.name)
+                raise PreviousUserContributionError(msg)
+            updated = ca.update_field('pledge', pledge)
+            goal_pledge = None
+            campaign_goals = goals(campaign, filter_inactive=only_active_goals)
+            if campaign_goals:
+                goal_pledge = pledge / len(campaign_goals)
+            for goal in campaign_goals:
+                _update_user_goal_association(goal, user, pledge=goal_pledge)
+
+        if updated:
             try:
-                session.commit()
-            except SQLAlchemyIntegrityError:
+                session.flush()
+            except (SQLAlchemyDataError, SQLAlchemyIntegrityError):
                 raise InvalidUserRoleError()
+            if pledge is not None:
+                CampaignStatsModel.increment(session, campaign.id, pledged=pledge)
+            session.commit()
 
 
 def disassociate_user(campaign, user):
@@ -445,11 +927,60 @@ def disassociate_user(campaign, user):
               "one with campaign.associate_user()."
         raise UnknownCampaignAssociationError(msg)
     ca = ca[0]
+    deltas = dict(participants=-1)
+    if ca.pledge is not None:
+        deltas['pledged'] = -ca.pledge
     with transaction_session() as session:
         session.delete(ca)
+        session.flush()
+        CampaignStatsModel.increment(session, campaign.id, **deltas)
         session.commit()
 
 
+def stats(campaign):
+    """Return the participant count, total pledged, invitations and amount
+    raised per goal of ``campaign``. These are read from the counters kept
+    by :class:`pooldlib.postgresql.models.CampaignStats` and
+    :class:`pooldlib.postgresql.models.CampaignGoalStats`, counters not yet
+    written for a campaign or goal are counted from its rows instead.
+
+    :param campaign: The campaign for which to retrieve statistics.
+    :type campaign: :class:`pooldlib.postgresql.models.Campaign`
+
+    :returns: dictionary with the keys ``participants``, ``pledged``,
+              ``invited``, ``accepted``, ``acceptance_rate`` (`None` if
+              nobody was invited), ``goal_participants``, the number of
+              users associated with each goal, and ``raised``, the amount
+              raised for each goal, both keyed by goal id.
+    """
+    counters = CampaignStatsModel.query.get(campaign.id)
+    if counters is None:
+        counters = db.session.execute(CampaignStatsModel.tally(campaign.id)).first()
+
+    goal_stats = CampaignGoalStatsModel
+    participants = func.coalesce(goal_stats.participants, goal_stats.participants_total(CampaignGoalModel.id))
+    raised = func.coalesce(goal_stats.raised, goal_stats.raised_total(CampaignGoalModel.id))
+    q = db.session.query(CampaignGoalModel.id, participants, raised)\
+                  .outerjoin(goal_stats, goal_stats.campaign_goal_id == CampaignGoalModel.id)\
+                  .filter(CampaignGoalModel.campaign_id == campaign.id)
+    goal_participants = dict()
+    goal_raised = dict()
+    for (goal_id, goal_participant_count, goal_raised_amount) in q:
+        goal_participants[goal_id] = goal_participant_count
+        goal_raised[goal_id] = goal_raised_amount
+
+    acceptance_rate = None
+    if counters.invited:
+        acceptance_rate = float(counters.accepted) / counters.invited
+    return dict(participants=counters.participants,
+                pledged=counters.pledged,
+                invited=counters.invited,
+                accepted=counters.accepted,
+                acceptance_rate=acceptance_rate,
+                goal_participants=goal_participants,
+                raised=goal_raised)
+
+
 # TODO :: Enable pagination
 def transfers(campaign, direction, goal, currency=None, other_party=None):
     """
@@ -457,11 +988,11 @@ def transfers(campaign, direction, goal, currency=None, other_party=None):
     pass
 
 
-# TODO :: Enable pagination
 def goals(campaign, goal_ids=None, filter_inactive=True):
     """Return all goals associated with a campaign. If ``goal_ids`` is specified,
     return only those goal objects. If ``filter_inactive`` is `True`, return only
-    those whose `start` and `endtime` make it currently active.
+    those whose `start` and `endtime` make it currently active. To retrieve a
+    large number of goals use :func:`goals_page` or :func:`iter_goals`.
 
     :param campaign: The campaign for which to retrieve goals.
     :type campaign_id: :class:`pooldlib.postgresql.models.Campaign`
@@ -474,6 +1005,41 @@ def goals(campaign, goal_ids=None, filter_inactive=True):
 
     :returns: list of :class:`pooldlib.postgresql.models.Communitiy`
     """
+    goals = _goals_query(campaign, goal_ids, filter_inactive).all()
+    return goals
+
+
+def goals_page(campaign, goal_ids=None, filter_inactive=True, limit=PAGE_SIZE, cursor=None):
+    """Return one page of the goals returned by :func:`goals`, ordered by
+    `start` and id, see :func:`campaigns_page`.
+
+    :param limit: The maximum number of goals to return.
+    :type limit: integer
+    :param cursor: The cursor returned with the previous page, `None` for the first page.
+    :type cursor: string
+
+    :raises: ValueError
+
+    :returns: tuple -- ``(goals, cursor)``, ``cursor`` is `None` if this is the last page.
+    """
+    q = _goals_query(campaign, goal_ids, filter_inactive)
+    return _page(q, CampaignGoalModel, limit, cursor)
+
+
+def iter_goals(campaign, goal_ids=None, filter_inactive=True, chunk_size=CHUNK_SIZE):
+    """Iterate over the goals returned by :func:`goals`, ordered by `start`
+    and id, reading ``chunk_size`` of them from the database at a time.
+
+    :param chunk_size: The number of goals to read at a time.
+    :type chunk_size: integer
+
+    :returns: generator of :class:`pooldlib.postgresql.models.CampaignGoal`
+    """
+    q = _goals_query(campaign, goal_ids, filter_inactive)
+    return _stream(q, CampaignGoalModel, chunk_size)
+
+
+def _goals_query(campaign, goal_ids, filter_inactive):
     if goal_ids and not isinstance(goal_ids, (list, tuple)):
         goal_ids = [goal_ids]
 
@@ -485,8 +1051,43 @@ def goals(campaign, goal_ids=None, filter_inactive=True):
         now = pytz.UTC.localize(datetime.utcnow())
         q = q.filter(CampaignGoalModel.start <= now)\
              .filter(CampaignGoalModel.end > now)
-    goals = q.all()
-    return goals
+    return q
+
+
+# NOTE :: Campaigns and goals are always created with a start, rows without
+# NOTE :: one would never satisfy the keyset comparison and are not paged.
+def _page(q, model, limit, cursor):
+    if cursor is not None:
+        (start, id) = _decode_cursor(cursor)
+        q = q.filter(tuple_(model.start, model.id) > (start, id))
+    # NOTE :: Read one extra row to find out whether there is a next page.
+    rows = q.order_by(model.start, model.id).limit(limit + 1).all()
+    if len(rows) <= limit:
+        return rows, None
+    rows = rows[:limit]
+    return rows, _encode_cursor(rows[-1].start, rows[-1].id)
+
+
+def _stream(q, model, chunk_size):
+    q = q.order_by(model.start, model.id)\
+         .execution_options(stream_results=True)\
+         .yield_per(chunk_size)
+    for row in q:
+        yield row
+
+
+def _encode_cursor(start, id):
+    start = start.astimezone(pytz.UTC).strftime(_CURSOR_DATETIME_FORMAT)
+    return base64.urlsafe_b64encode('%s|%s' % (start, id))
+
+
+def _decode_cursor(cursor):
+    try:
+        (start, id) = base64.urlsafe_b64decode(str(cursor)).split('|')
+        start = pytz.UTC.localize(datetime.strptime(start, _CURSOR_DATETIME_FORMAT))
+        return start, long(id)
+    except (TypeError, ValueError):
+        raise ValueError('Invalid pagination cursor: %r' % cursor)
 
 
 def goal(goal_id, campaign=None, filter_inactive=False):
@@ -549,22 +1150,41 @@ def add_goal(campaign, name, description, type, predecessor=None, start=None, en
         goal.predecessor = predecessor
     campaign.goals.append(goal)
 
+    # NOTE :: The goal, its metadata and the organizer's goal association are
+    # NOTE :: written in a single transaction. The flush inserts the goal
+    # NOTE :: with ``INSERT ... RETURNING id``, without ending the transaction.
     with transaction_session() as session:
         session.add(goal)
+        session.flush()
+        if kwargs:
+            meta_rows = _metadata_rows('campaign_goal_id', goal.id, kwargs)
+            session.execute(CampaignGoalMetaModel.__table__.insert().values(meta_rows))
+        organizers = session.execute(_organizer_goal_association(campaign, goal)).rowcount
+        if organizers:
+            CampaignGoalStatsModel.increment(session, [goal.id], campaign.id, participants=organizers)
         session.commit()
+    return goal
 
-    meta = list()
-    for (k, v) in kwargs.items():
-        goal_meta = CampaignGoalMetaModel()
-        goal_meta.key = k
-        goal_meta.value = v
-        goal_meta.campaign_goal = goal
-        meta.append(goal_meta)
 
-    with transaction_session(auto_commit=True) as session:
-        for goal_meta in meta:
-            session.add(goal_meta)
-    return goal
+def _organizer_goal_association(campaign, goal):
+    """Build an ``INSERT ... SELECT`` associating the organizers of
+    ``campaign`` with its new ``goal`` as participating.
+    """
+    ca = CampaignAssociationModel.__table__
+    cga = CampaignGoalAssociationModel.__table__
+    now = pytz.UTC.localize(datetime.utcnow())
+    organizers = select([ca.c.user_id,
+                         ca.c.campaign_id,
+                         literal(goal.id),
+                         literal('participating', type_=cga.c.participation.type),
+                         literal(True),
+                         literal(now, type_=cga.c.created.type),
+                         literal(now, type_=cga.c.modified.type)])\
+        .where(ca.c.campaign_id == campaign.id)\
+        .where(ca.c.role == 'organizer')
+    columns = ['user_id', 'campaign_id', 'campaign_goal_id', 'participation',
+               'enabled', 'created', 'modified']
+    return cga.insert().from_select(columns, organizers)
 
 
 def update_goal(update_goal, name=None, predecessor=None, description=None, start=None, end=None, **kwargs):
@@ -671,11 +1291,13 @@ def associate_user_with_goal(campaign_goal, user, participation, pledge=None):
     with transaction_session() as session:
         session.add(cga)
         try:
-            session.commit()
+            session.flush()
         except SQLAlchemyDataError:
             raise InvalidGoalParticipationNameError()
         except SQLAlchemyIntegrityError:
             raise DuplicateCampaignGoalUserAssociationError()
+        CampaignGoalStatsModel.increment(session, [campaign_goal.id], cga.campaign_id, participants=1)
+        session.commit()
     return cga
 
 
@@ -689,6 +1311,23 @@ def update_user_goal_association(campaign_goal, user, participation=None, pledge
 
     :raises: :class:`pooldlib.exceptions.InvalidGoalParticipationNameError`
     """
+    (cga, updated) = _update_user_goal_association(campaign_goal, user, participation=participation, pledge=pledge)
+    if updated:
+        with transaction_session() as session:
+            session.add(cga)
+            try:
+                session.commit()
+            except SQLAlchemyDataError:
+                raise InvalidGoalParticipationNameError()
+    return cga
+
+
+def _update_user_goal_association(campaign_goal, user, participation=None, pledge=None):
+    """Update the association of ``user`` with ``campaign_goal`` in the
+    session, without committing, see :func:`update_user_goal_association`.
+
+    :returns: tuple -- ``(association, updated)``
+    """
     cga = CampaignGoalAssociationModel.query.filter_by(campaign=campaign_goal.campaign)\
                                             .filter_by(campaign_goal=campaign_goal)\
                                             .filter_by(user=user)\
@@ -707,12 +1346,4 @@ def update_user_goal_association(campaign_goal, user, participation=None, pledge
             msg %= (user.username, campaign_goal.campaign.name)
             raise PreviousUserContributionError(msg)
         updated = cga.update_field('pledge', pledge)
-
-    if updated:
-        with transaction_session() as session:
-            session.add(cga)
-            try:
-                session.commit()
-            except SQLAlchemyDataError:
-                raise InvalidGoalParticipationNameError()
-    return cga
+    return cga, updated
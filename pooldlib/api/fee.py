@@ -5,8 +5,18 @@ pooldlib.api.fee
 .. currentmodule:: pooldlib.api.fee
 
 """
+import threading
+
+from pooldlib.signals import signals_available, models_committed
 from pooldlib.postgresql.models import Fee as FeeModel
-from pooldlib.payment import total_after_fees as _total_after_fees
+from pooldlib.payment import FeeSchedule
+
+# Compiled fee schedules, by tuple of fee names.
+_schedules = dict()
+# Incremented whenever the cached schedules are discarded, so that a schedule
+# compiled from fees read before a discard is not cached after it.
+_generation = 0
+_schedules_lock = threading.Lock()
 
 
 def get(fee_name, fee_names=None):
@@ -35,10 +45,49 @@ def get(fee_name, fee_names=None):
     return fees
 
 
+def schedule(fee_names):
+    """Retrieve the :class:`pooldlib.payment.FeeSchedule` compiled from the
+    enabled fees named in ``fee_names``. Schedules are cached for the life of
+    the process and discarded whenever a :class:`pooldlib.postgresql.models.Fee`
+    is committed. Without signal support (see :mod:`pooldlib.signals`) nothing
+    is cached.
+
+    :param fee_names: A list of names corresponding to the desired Fees,
+                      or of the Fees themselves.
+    :type fee_names: list of strings or of :class:`pooldlib.postgresql.models.Fee`
+
+    :returns: :class:`pooldlib.payment.FeeSchedule`
+    """
+    key = tuple(getattr(f, 'name', f) for f in fee_names)
+    compiled = _schedules.get(key)
+    if compiled is None:
+        generation = _generation
+        compiled = FeeSchedule(get(None, fee_names=key))
+        if signals_available:
+            with _schedules_lock:
+                # NOTE :: Fees committed since the read leave the schedule stale.
+                if generation == _generation:
+                    _schedules[key] = compiled
+    return compiled
+
+
+def _discard_schedules(session, changes=None):
+    global _generation
+    if any(isinstance(model, FeeModel) for (model, operation) in changes or ()):
+        with _schedules_lock:
+            _generation += 1
+            _schedules.clear()
+
+
+if signals_available:
+    models_committed.connect(_discard_schedules)
+
+
 def calculate(fees, amount):
     """Calculate fees associated with a given amount, for a given list of fees.
 
-    :param fees: A list of fees to use in the calculation.
+    :param fees: A list of fees to use in the calculation, or of their names,
+                 see :func:`schedule`.
     :type fees: list of :class:`pooldlib.postgresql.models.Fee`
     :param amount: The base amount to use in the calculation.
     :type amount: decimal.Decimal
@@ -49,5 +98,31 @@ def calculate(fees, amount):
                                                 'fee': The calculated fee amount}
                                                ...]}
     """
-    total = _total_after_fees(amount, fees=fees)
-    return total
+    _check_fees(fees)
+    return schedule(fees).price(amount)
+
+
+def calculate_batch(fees, amounts):
+    """Calculate fees associated with each of many amounts, for a given list of
+    fees. See :func:`pooldlib.payment.total_after_fees_batch`.
+
+    :param fees: A list of fees to use in the calculation, or of their names,
+                 see :func:`schedule`.
+    :type fees: list of :class:`pooldlib.postgresql.models.Fee`
+    :param amounts: The base amounts to use in the calculation.
+    :type amounts: list of decimal.Decimal
+
+    :returns: dictionary, structure: {'charge': {'initial': list of the passed in amounts,
+                                                 'final': list of total charges after fees are applied},
+                                      'fees': [{'name': First fee name,
+                                                'fee': list of the calculated fee amounts}
+                                               ...]}
+    """
+    _check_fees(fees)
+    return schedule(fees).price_batch(amounts)
+
+
+def _check_fees(fees):
+    if not isinstance(fees, (tuple, list)):
+        msg = 'fees must be of type list or tuple'
+        raise TypeError(msg)
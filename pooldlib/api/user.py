@@ -6,8 +6,10 @@ pooldlib.api.user
 
 """
 import re
+import sys
+import time
+import threading
 from uuid import uuid4 as uuid
-from decimal import Decimal
 
 from sqlalchemy.exc import IntegrityError as SQLAlchemyIntegrityError
 from sqlalchemy.orm.attributes import manager_of_class
@@ -21,10 +23,10 @@ from stripe import (AuthenticationError as StripeAuthenticationError,
 import pooldlib.log
 from pooldlib import Transact
 from pooldlib.payment import (StripeCustomer,
-                              StripeUser,
-                              QUANTIZE_CENTS,
-                              total_after_fees as payment_total_after_fees)
+                              StripeUser)
 from pooldlib.api.campaign import organizer as get_campaign_organizer
+from pooldlib.api import balance as _balance
+from pooldlib.api import fee as _fee
 from pooldlib.generators import alphanumeric_string
 from pooldlib.exceptions import (InvalidPasswordError,
                                  EmailUnavailableError,
@@ -578,54 +580,161 @@ def associate_stripe_authorization_code(user, auth_code, stripe_private_key, for
            stripe_user_grant_scope=user_data['scope'])
 
 
-def payment_to_campaign(user, campaign, amount, currency, fees, note=None, goal=None, full_name=None):
+def payment_to_campaign(user, campaign, amount, currency, fees, note=None, goal=None, full_name=None,
+                        pipelined=False, net=False):
     """Use this function to make a payment to the 'organizer' of 'campaign'.
     While we are actively not holding money, this method should be used for any
     and all money related transactions in which funds are being directed to a
     campaign. Records will be written to all appropriate ledger tables, and the
     transaction executed with stripe.
 
+    If ``pipelined`` is `True` the stripe charge is made on a separate thread
+    while the ledger entries are prepared, so that only the write of the
+    entries is left once stripe responds. Should any balance involved not yet
+    exist, the entries are only prepared after the charge succeeds. Nothing
+    is written if the charge fails.
+
+    ``fees`` are priced with the cached schedule of :func:`pooldlib.api.fee.schedule`,
+    so they may be given by name to avoid querying them.
+
+    If ``net`` is `True` the funds passing through the balances involved are
+    netted out, see :class:`pooldlib.transact.Transact`.
+
     :raises: :class:`pooldlib.exception.StripeCustomerAccountError`
              :class:`pooldlib.exception.StripeUserAccountError`
              :class:`pooldlib.exception.CampaignConfigurationError`
     """
-    transact_ledger = Transact()
-    deposit_id, withdrawal_id = [uuid() for i in range(2)]
+    transact_ledger = Transact(net=net)
+
+    organizer = _campaign_payment_organizer(user, campaign)
+    schedule = _fee.schedule(fees)
+    if not pipelined:
+        txn_dict, stripe_ref_number = _charge_for_campaign(user, campaign, organizer, amount, currency,
+                                                           schedule, note=note)
+        ids = _stage_campaign_payment(transact_ledger, user, campaign, organizer, amount, currency,
+                                      txn_dict, stripe_ref_number, goal=goal, full_name=full_name)
+        transact_ledger.execute()
+        return ids
+
+    # NOTE :: Load the currency before the charging thread reads it.
+    currency.code
+    # NOTE :: Staging creates any missing balance, which must not outlive a
+    # failed charge, so only stage ahead of the charge when all of them exist.
+    stage_early = _has_balances(currency, user, goal.campaign if goal else campaign, organizer)
+    charge = _InThread(_charge_for_campaign, user, campaign, organizer, amount, currency, schedule, note=note)
+    staging_error = None
+    if stage_early:
+        try:
+            # NOTE :: The reference number is only known once the charge completes.
+            ids = _stage_campaign_payment(transact_ledger, user, campaign, organizer, amount, currency,
+                                          schedule.price(amount), None, goal=goal, full_name=full_name)
+        except Exception:
+            staging_error = sys.exc_info()
+    try:
+        txn_dict, stripe_ref_number = charge.result()
+    except Exception:
+        # NOTE :: Nothing is written for a failed charge, discard what staging read or flushed.
+        db.session.rollback()
+        raise
+    try:
+        if staging_error is not None:
+            raise staging_error[0], staging_error[1], staging_error[2]
+        if stage_early:
+            transact_ledger.set_reference_number(stripe_ref_number)
+        else:
+            ids = _stage_campaign_payment(transact_ledger, user, campaign, organizer, amount, currency,
+                                          txn_dict, stripe_ref_number, goal=goal, full_name=full_name)
+    except Exception:
+        msg = 'Stripe charge completed, but its ledger entries could not be staged!'
+        data = dict(user=str(user),
+                    campaign=str(campaign),
+                    stripe_ref_number=stripe_ref_number,
+                    total=txn_dict['charge']['final'])
+        logger.transaction(msg, data=data)
+        raise
+    transact_ledger.execute()
+    return ids
+
 
-    if user.stripe_customer_id is None:
+def _campaign_payment_organizer(user, campaign, organizer=None):
+    """Verify that ``user`` can pay, and the organizer of ``campaign`` can be
+    paid, with Stripe and return the organizer.
+    """
+    # NOTE :: Missing metadata raises AttributeError, see :class:`pooldlib.postgresql.common.MetadataMixin`.
+    if getattr(user, 'stripe_customer_id', None) is None:
         msg = 'User does not have an associated Stripe customer account!'
         data = dict(user=str(user))
         logger.error(msg, data=data)
         raise StripeCustomerAccountError(msg)
 
-    organizer = get_campaign_organizer(campaign)
+    organizer = organizer or get_campaign_organizer(campaign)
     if organizer is None:
         msg = 'No organizer was found for campaign!'
         data = dict(campaign=str(campaign))
         logger.critical(msg, data=data)
         raise CampaignConfigurationError(msg)
-    if organizer.stripe_user_id is None or organizer.stripe_user_token is None:
+    if getattr(organizer, 'stripe_user_id', None) is None or getattr(organizer, 'stripe_user_token', None) is None:
         msg = 'User does not have an associated Stripe user account, need to complete this transaction!'
         data = dict(user=str(user))
         logger.error(msg, data=data)
         raise StripeUserAccountError(msg)
+    return organizer
+
+
+def _has_balances(currency, *holders):
+    """Return `True` if every :class:`pooldlib.postgresql.models.User` or
+    :class:`pooldlib.postgresql.models.Campaign` in ``holders`` has a balance in
+    ``currency``.
+    """
+    for holder in holders:
+        if holder.__class__.__name__ == 'User':
+            balances = _balance.get(user_id=holder.id, currency_id=currency.id)
+        else:
+            balances = _balance.get(campaign_id=holder.id, currency_id=currency.id)
+        if not balances:
+            return False
+    return True
 
-    txn_dict, amount_cents, fee_cents = _calculate_transaction_amounts(amount, fees)
+
+def _charge_for_campaign(user, campaign, organizer, amount, currency, schedule, note=None, idempotency_key=None):
+    """Charge ``user`` for a payment of ``amount`` to ``organizer`` with Stripe,
+    with the fees of ``schedule``, a :class:`pooldlib.payment.FeeSchedule`.
+    Makes no use of the database session, so may be called from any thread
+    once the attributes of ``user``, ``organizer`` and ``currency`` are loaded.
+    A charge made again with the same ``idempotency_key`` returns the first
+    charge, see :func:`pooldlib.payment.StripeCustomer.charge`.
+
+    :returns: tuple -- ``(txn_dict, stripe_ref_number)``
+    """
+    txn_dict, amount_cents, fee_cents = _calculate_transaction_amounts(amount, schedule)
 
     description = 'User: %s, paying towards campaign: %s.' % (user.id, campaign.id)
     if note is not None:
         description += ' %s' % note
 
-    ret = _execute_charge(organizer.stripe_user_token, amount_cents, fee_cents, currency, user, description)
+    started = time.time()
+    ret = _execute_charge(organizer.stripe_user_token, amount_cents, fee_cents, currency, user, description,
+                          idempotency_key)
+    charge_time = time.time() - started
 
     msg = 'Transaction successfully completed.'
     data = dict(sub_total=amount,
                 currency=currency.code,
-                total=txn_dict['charge']['final'])
+                total=txn_dict['charge']['final'],
+                charge_seconds=charge_time)
     meta = dict(stripe_response=ret)
     logger.transaction(msg, data=data, **meta)
+    return txn_dict, ret['id']
+
+
+def _stage_campaign_payment(transact_ledger, user, campaign, organizer, amount, currency,
+                            txn_dict, stripe_ref_number, goal=None, full_name=None):
+    """Stage all ledger entries of a completed Stripe charge on ``transact_ledger``.
+
+    :returns: tuple -- ``(deposit_id, withdrawal_id)``
+    """
+    deposit_id, withdrawal_id = [uuid() for i in range(2)]
 
-    stripe_ref_number = ret['id']
     # Transaction for ``user`` with credit=``amount``
     transact_ledger.transaction(user,
                                 'stripe',
@@ -642,15 +751,14 @@ def payment_to_campaign(user, campaign, amount, currency, fees, note=None, goal=
                                     credit=txn_dict['charge']['final'],
                                     id=deposit_id,
                                     full_name=full_name)
-    for fee in fees:
-        fee_amount = [f['fee'] for f in txn_dict['fees'] if f['name'] == fee.name][0]
+    for fee in txn_dict['fees']:
         # External Ledger for ``user`` for ``debit=fee_amount``
         transact_ledger.external_ledger(user,
                                         'stripe',
                                         stripe_ref_number,
                                         currency,
-                                        debit=fee_amount,
-                                        fee=fee,
+                                        debit=fee['fee'],
+                                        fee=fee['id'],
                                         id=deposit_id)
 
     if not goal:
@@ -689,35 +797,58 @@ def payment_to_campaign(user, campaign, amount, currency, fees, note=None, goal=
                                     currency,
                                     debit=amount,
                                     id=withdrawal_id)
-    transact_ledger.execute()
     return (deposit_id, withdrawal_id)
 
 
-def _convert_dollars_to_cents(amount):
-    amount_cents = amount * Decimal(100)
-    amount_cents = amount_cents.quantize(QUANTIZE_CENTS)
-    return int(amount_cents)
+def _calculate_transaction_amounts(amount, schedule):
+    txn_dict = schedule.price(amount)
+    amount_cents, fee_cents = schedule.price_cents(amount)
+    # NOTE :: The stripe fee, always last, is not part of the application fee.
+    if schedule.stripe_fee is not None:
+        fee_cents = fee_cents[:-1]
 
+    return txn_dict, amount_cents, sum(fee_cents)
 
-def _calculate_transaction_amounts(amount, fees):
-    txn_dict = payment_total_after_fees(amount, fees=fees)
-    non_stripe_fees = [fee for fee in txn_dict['fees'] if fee['name'] != 'stripe-transaction']
-    fee_cents = Decimal(0)
-    for fee in non_stripe_fees:
-        fee_cents += _convert_dollars_to_cents(fee['fee'])
-    amount_cents = _convert_dollars_to_cents(txn_dict['charge']['final'])
 
-    return txn_dict, amount_cents, fee_cents
+class _InThread(threading.Thread):
+    """Call ``target`` with ``args`` and ``kwargs`` on a new thread, see
+    :meth:`result`.
+    """
+
+    def __init__(self, target, *args, **kwargs):
+        super(_InThread, self).__init__()
+        self.daemon = True
+        self._call = (target, args, kwargs)
+        self._result = None
+        self._error = None
+        self.start()
+
+    def run(self):
+        (target, args, kwargs) = self._call
+        try:
+            self._result = target(*args, **kwargs)
+        except Exception:
+            self._error = sys.exc_info()
+
+    def result(self):
+        """Wait for the call to return and return its result, or raise the
+        error it raised.
+        """
+        self.join()
+        if self._error is not None:
+            raise self._error[0], self._error[1], self._error[2]
+        return self._result
 
 
-def _execute_charge(api_key, amount_cents, fee_cents, currency, user, description):
+def _execute_charge(api_key, amount_cents, fee_cents, currency, user, description, idempotency_key=None):
     client = StripeCustomer(api_key)
     try:
         ret = client.charge(amount_cents,
                             fee_cents,
                             currency,
                             user,
-                            description)
+                            description,
+                            idempotency_key=idempotency_key)
     except StripeCardError:
         # Errors caused by us
         msg = 'The user\'s credit card was declined.'
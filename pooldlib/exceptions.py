@@ -186,6 +186,13 @@ class PreviousUserContributionError(CampaignAPIError):
     """
 
 
+class PledgeCollectionPendingError(CampaignAPIError):
+    """Raised for a pledge whose collection was started but whose Stripe
+    charge was never recorded, e.g. because the collecting process stopped.
+    The charge must be reconciled with Stripe before the pledge is collected.
+    """
+
+
 ##################################
 ### Transaction API Related Exceptions
 class TransactAPIError(PooldlibError):
@@ -201,6 +208,11 @@ class InsufficentFundsTransferError(TransactAPIError):
 class InsufficentFundsTransactionError(TransactAPIError):
     """An attempt was made to execute a transaction with insufficient
     funds in the target balance."""
+
+
+class TransactConflictError(TransactAPIError):
+    """A transact list could not be executed because the balances involved
+    kept being modified concurrently, even after retrying."""
 ##################################
 
 
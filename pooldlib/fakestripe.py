@@ -0,0 +1,302 @@
+"""
+pooldlib.fakestripe
+===============================
+
+.. currentmodule:: pooldlib.fakestripe
+
+A local stand-in for the parts of the Stripe API used by
+:mod:`pooldlib.payment`, for exercising the payment pipeline without network
+access to Stripe, e.g. when load testing. The server answers the customer,
+token and charge endpoints of the Stripe API and the ``/oauth/token`` endpoint
+of Stripe Connect, with configurable latency and injected errors. Requests
+sent with an ``Idempotency-Key`` header are answered, as by Stripe, with the
+response to the first successful request made with the same key.
+
+Usage:
+    >>> from pooldlib.fakestripe import FakeStripeServer
+    >>> with FakeStripeServer(latency=0.2, error_rate=0.01) as server:
+    ...     user.payment_to_campaign(...)
+    >>> server.calls['/v1/charges']
+    1
+
+"""
+import json
+import time
+import random
+import urlparse
+import threading
+import BaseHTTPServer
+import SocketServer
+from uuid import uuid4 as uuid
+from collections import defaultdict
+
+import stripe
+
+from pooldlib import payment
+
+
+# Injectable errors, mapped to (HTTP status, Stripe error type, error code,
+# message). ``connection`` errors close the connection without a response.
+ERRORS = {
+    'card': (402, 'card_error', 'card_declined', 'Your card was declined.'),
+    'invalid_request': (400, 'invalid_request_error', 'invalid_request', 'Invalid request.'),
+    'authentication': (401, 'authentication_error', 'invalid_client', 'Invalid API key provided.'),
+    'api': (500, 'api_error', 'api_error', 'An unexpected error occurred.'),
+    'connection': None,
+}
+
+
+def _customer(params):
+    return dict(id='cus_%s' % uuid().hex,
+                object='customer',
+                livemode=False,
+                created=int(time.time()),
+                description=params.get('description'),
+                email=params.get('email'))
+
+
+def _token(params):
+    return dict(id='tok_%s' % uuid().hex,
+                object='token',
+                livemode=False,
+                created=int(time.time()),
+                used=False,
+                type='card')
+
+
+def _charge(params):
+    return dict(id='ch_%s' % uuid().hex,
+                object='charge',
+                livemode=False,
+                created=int(time.time()),
+                amount=int(params['amount']),
+                currency=params['currency'],
+                description=params.get('description'),
+                paid=True,
+                refunded=False)
+
+
+def _oauth_token(params):
+    return dict(access_token='sk_test_%s' % uuid().hex,
+                refresh_token='rt_%s' % uuid().hex,
+                token_type='bearer',
+                stripe_publishable_key='pk_test_%s' % uuid().hex,
+                stripe_user_id='acct_%s' % uuid().hex[:16],
+                scope=params.get('scope', 'read_write'),
+                livemode=False)
+
+
+# Path: (response builder, required parameters)
+ENDPOINTS = {
+    '/v1/customers': (_customer, ()),
+    '/v1/tokens': (_token, ()),
+    '/v1/charges': (_charge, ('amount', 'currency')),
+    '/oauth/token': (_oauth_token, ('code', 'grant_type')),
+}
+
+
+class _ThreadingHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        length = int(self.headers.getheader('content-length') or 0)
+        params = urlparse.parse_qs(self.rfile.read(length))
+        params = dict((k, v[-1]) for (k, v) in params.items())
+        self.server.fake.respond(self, params)
+
+    def log_message(self, *args):
+        pass
+
+
+class FakeStripeServer(object):
+    """A threaded HTTP server on ``host``, answering requests as Stripe would.
+    Responses are delayed by ``latency`` seconds, plus up to ``jitter``
+    seconds at random, and a fraction ``error_rate`` of requests fail with an
+    error chosen at random from ``errors`` (see :data:`ERRORS`). Errors for
+    specific requests can be queued with :meth:`fail`. :attr:`calls` counts
+    every request received and :attr:`created` only the objects created, not
+    requests answered from an earlier request with the same idempotency key.
+
+    Point :class:`pooldlib.payment.StripeCustomer` at :attr:`api_base` and
+    :class:`pooldlib.payment.StripeUser` at :attr:`connect_api_base`, or use
+    the server as a context manager, which starts it and sends all Stripe
+    requests made meanwhile to it.
+
+    :param host: The address to listen on.
+    :type host: string
+    :param port: The port to listen on, by default any free port.
+    :type port: integer
+    :param latency: Seconds to wait before every response.
+    :type latency: float
+    :param jitter: Maximum additional seconds to wait at random.
+    :type jitter: float
+    :param error_rate: The fraction of requests to fail, between 0 and 1.
+    :type error_rate: float
+    :param errors: The errors to choose from for failed requests.
+    :type errors: tuple of strings, keys of :data:`ERRORS`
+    :param seed: Seed for latency jitter and error injection.
+    :type seed: integer
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0, jitter=0.0,
+                 error_rate=0.0, errors=('api', ), seed=None):
+        unknown = [e for e in errors if e not in ERRORS]
+        if unknown:
+            msg = 'Unknown error type(s): %s' % ', '.join(unknown)
+            raise ValueError(msg)
+
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.errors = tuple(errors)
+        # Number of requests received, by path.
+        self.calls = defaultdict(int)
+        # Number of objects created, by path.
+        self.created = defaultdict(int)
+        # Responses to requests made with an idempotency key, by (path, key).
+        self._idempotent = dict()
+        # Addresses of all clients which have connected.
+        self.connections = set()
+        self._failures = defaultdict(list)
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._server = None
+        self._installed = None
+
+    @property
+    def api_base(self):
+        return 'http://%s:%s/v1' % (self.host, self.port)
+
+    @property
+    def connect_api_base(self):
+        return 'http://%s:%s' % (self.host, self.port)
+
+    def start(self):
+        """Start serving requests on a background thread.
+        """
+        self._server = _ThreadingHTTPServer((self.host, self.port), _Handler)
+        self._server.fake = self
+        self.port = self._server.server_port
+        worker = threading.Thread(target=self._server.serve_forever)
+        worker.daemon = True
+        worker.start()
+
+    def stop(self):
+        """Stop serving requests. Pooled connections to the server are closed.
+        """
+        if self._server is None:
+            return
+        # NOTE :: Idle keep-alive connections would hold handler threads open.
+        payment.configure_http()
+        self._server.shutdown()
+        self._server.server_close()
+        self._server = None
+
+    def install(self):
+        """Send all requests of :mod:`pooldlib.payment` to this server, until
+        :meth:`uninstall` is called.
+        """
+        self._installed = (stripe.api_base, payment.StripeConnectRequestor.api_base)
+        stripe.api_base = self.api_base
+        payment.StripeConnectRequestor.api_base = self.connect_api_base
+
+    def uninstall(self):
+        if self._installed is None:
+            return
+        (stripe.api_base, payment.StripeConnectRequestor.api_base) = self._installed
+        self._installed = None
+
+    def fail(self, path, error, times=1):
+        """Fail the next ``times`` requests to ``path`` with ``error``.
+
+        :param path: The endpoint to fail, e.g. ``/v1/charges``.
+        :type path: string
+        :param error: The error to respond with, a key of :data:`ERRORS`.
+        :type error: string
+        :param times: The number of requests to fail.
+        :type times: integer
+        """
+        if error not in ERRORS:
+            msg = 'Unknown error type: %s' % error
+            raise ValueError(msg)
+        with self._lock:
+            self._failures[path].extend([error] * times)
+
+    def respond(self, request, params):
+        path = request.path.split('?')[0]
+        with self._lock:
+            self.calls[path] += 1
+            self.connections.add(request.client_address)
+            delay = self.latency
+            if self.jitter:
+                delay += self._random.uniform(0, self.jitter)
+            if self._failures[path]:
+                error = self._failures[path].pop(0)
+            elif self.error_rate and self._random.random() < self.error_rate:
+                error = self._random.choice(self.errors)
+            else:
+                error = None
+
+        if delay:
+            time.sleep(delay)
+
+        if error == 'connection':
+            request.close_connection = 1
+            return
+
+        connect = path.startswith('/oauth/')
+        endpoint = ENDPOINTS.get(path)
+        key = request.headers.getheader('idempotency-key')
+        if error is not None:
+            (status, body) = self._error(error, connect)
+        elif endpoint is None:
+            msg = 'Unrecognized request URL (POST: %s).' % path
+            (status, body) = self._error('invalid_request', connect, message=msg)
+        elif not request.headers.getheader('authorization'):
+            (status, body) = self._error('authentication', connect)
+        else:
+            (build, required) = endpoint
+            missing = [p for p in required if p not in params]
+            if missing:
+                msg = 'Missing required param: %s.' % missing[0]
+                (status, body) = self._error('invalid_request', connect, message=msg, param=missing[0])
+            else:
+                (status, body) = (200, build(params))
+                with self._lock:
+                    if key and (path, key) in self._idempotent:
+                        body = self._idempotent[(path, key)]
+                    else:
+                        self.created[path] += 1
+                        if key:
+                            self._idempotent[(path, key)] = body
+
+        body = json.dumps(body)
+        request.send_response(status)
+        request.send_header('Content-Type', 'application/json')
+        request.send_header('Content-Length', str(len(body)))
+        request.end_headers()
+        request.wfile.write(body)
+
+    def _error(self, error, connect, message=None, param=None):
+        (status, type, code, default_message) = ERRORS[error]
+        message = message or default_message
+        if connect:
+            # Stripe Connect reports OAuth errors in their own format, see
+            # :class:`pooldlib.payment.StripeConnectRequestor`.
+            return status, dict(error=code, error_description=message)
+        return status, dict(error=dict(type=type, code=code, message=message, param=param))
+
+    def __enter__(self):
+        self.start()
+        self.install()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.uninstall()
+        self.stop()
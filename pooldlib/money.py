@@ -0,0 +1,65 @@
+"""
+pooldlib.money
+===============================
+
+.. currentmodule:: pooldlib.money
+
+Fixed-point integer representation of currency amounts. Amounts are held as
+integer *units* of 1/10000 of a currency unit, the scale at which the
+database stores every amount (``DECIMAL(24, 4)``), so that fee math and
+:class:`pooldlib.Transact` staging can use integer arithmetic and only
+convert to and from ``decimal.Decimal`` at the database and API edges.
+
+"""
+from decimal import Decimal, ROUND_HALF_UP
+
+
+# Units per currency unit, and per cent.
+UNIT = 10000
+CENT = 100
+
+_SCALE = Decimal(1).scaleb(-4)
+
+
+def to_units(amount):
+    """Convert ``amount`` to integer units. Amounts with more than four decimal
+    places are rounded the way the database rounds them when they are stored.
+
+    :param amount: The amount to convert.
+    :type amount: decimal.Decimal or integer
+
+    :returns: integer
+    """
+    amount = Decimal(amount).quantize(_SCALE, rounding=ROUND_HALF_UP)
+    return int(amount.scaleb(4))
+
+
+def from_units(units):
+    """Convert integer ``units`` to a ``decimal.Decimal`` with four decimal
+    places, as read from the database.
+
+    :returns: decimal.Decimal
+    """
+    return Decimal(units).scaleb(-4)
+
+
+def from_cents(cents):
+    """Convert integer ``cents`` to a ``decimal.Decimal`` with two decimal
+    places, as returned by ``amount.quantize(QUANTIZE_DOLLARS)``.
+
+    :returns: decimal.Decimal
+    """
+    return Decimal(cents).scaleb(-2)
+
+
+def round_div(numerator, denominator):
+    """Divide integers, rounding half to even, the default rounding of
+    ``decimal.Decimal.quantize``. ``denominator`` must be positive.
+
+    :returns: integer
+    """
+    quotient, remainder = divmod(numerator, denominator)
+    twice = 2 * remainder
+    if twice > denominator or (twice == denominator and quotient % 2):
+        quotient += 1
+    return quotient
@@ -1,16 +1,23 @@
+import os
 import json
+import math
+import time
+import threading
 from decimal import Decimal
+from collections import deque
 
+import requests
 import stripe
-from stripe import (Charge as _Charge,
-                    Customer as _Customer,
-                    Token as _Token)
+from requests.adapters import HTTPAdapter
 
 import pooldlib.log
+from pooldlib import config
+from pooldlib.exceptions import ExternalAPIUnavailableError
+from pooldlib.money import UNIT, CENT, to_units, from_cents, round_div
 
 logger = pooldlib.log.get_logger(None, logging_name=__name__)
 
-__all__ = ('StripeCustomer', 'StripeUser')
+__all__ = ('StripeCustomer', 'StripeUser', 'FeeSchedule', 'CircuitBreaker')
 
 # All charges to stripe must be exact down to the cent, so for now
 # We will limit ourselves to this decimal scale
@@ -46,46 +53,444 @@ def total_after_fees(amount, fees=None, is_payer=True):
     if not isinstance(fees, (tuple, list)):
         msg = 'fees must be of type list or tuple'
         raise TypeError(msg)
-    if not isinstance(amount, Decimal):
-        msg = 'Transaction amount must be of type decimal.Decimal.'
+    return FeeSchedule(fees).price(amount, is_payer=is_payer)
+
+
+def total_after_fees_batch(amounts, fees=None, is_payer=True):
+    """Calculate all fees related to transactions of each of ``amounts``, as
+    by :func:`total_after_fees`. The fee schedule is prepared once for all of
+    the amounts and the results are returned by column, the ``n``-th entry of
+    each list corresponding to ``amounts[n]``.
+
+    :param amounts: The decimal amounts on which to base the transactions.
+    :type amounts: list of decimal.Decimal
+    :param fees: A list of fees to associate with the transactions.
+    :type fees: list of :class:`pooldlib.postgresql.models.Fee`
+    :param is_payer: Indicates whether or not the fees are calculated from
+                     the point of view of the payer or payee (payer fees are
+                     additive to the total amount, payee fees are decremental).
+    :type is_payer: boolean
+
+    :raises: TypeError
+
+    :returns: dictionary, structure: {'charge': {'initial': list of the passed in amounts,
+                                                 'final': list of total charges after fees are applied},
+                                      'fees': [{'name': First fee name,
+                                                'id': First fee id,
+                                                'fee': list of the calculated fee amounts}
+                                               ...]}
+    """
+    if not isinstance(fees, (tuple, list)):
+        msg = 'fees must be of type list or tuple'
         raise TypeError(msg)
+    return FeeSchedule(fees).price_batch(amounts, is_payer=is_payer)
+
+
+class FeeSchedule(object):
+    """A list of fees compiled for pricing. The flat and fractional part of
+    every fee, and the divisor grossing up a charge for the stripe-transaction
+    fee, are read from the :class:`pooldlib.postgresql.models.Fee` objects
+    once, so a schedule can be kept and used after they are gone, see
+    :func:`pooldlib.api.fee.schedule`.
+
+        >>> schedule = FeeSchedule(fees)
+        >>> schedule.price(Decimal('25.0000'))  # As total_after_fees(Decimal('25.0000'), fees)
+
+    :param fees: The fees to compile.
+    :type fees: list of :class:`pooldlib.postgresql.models.Fee`
+    """
 
-    stripe_fee = [f for f in fees if f.name == 'stripe-transaction']
-    stripe_fee = stripe_fee[0] if stripe_fee else None
-    other_fees = [f for f in fees if f.name != 'stripe-transaction']
-
-    ledger = {'charge': {'initial': amount, },
-              'fees': list()}
-
-    charge_amount = amount
-    multiplier = 1 if is_payer else -1
-    for other_fee in other_fees:
-        fee_total = other_fee.flat + other_fee.fractional_pct * amount
-        fee_total = fee_total
-        charge_amount += multiplier * fee_total
-        entry = {'name': other_fee.name,
-                 'id': other_fee.id,
-                 'fee': fee_total.quantize(QUANTIZE_DOLLARS)}
-        ledger['fees'].append(entry)
-
-    if stripe_fee is not None:
-        # Percentages are stored as percentages in the db, convert it to a decimal
-        new_charge_amount = (stripe_fee.flat + charge_amount) / (Decimal('1.0000') - stripe_fee.fractional_pct)
-        stripe_fee_amount = new_charge_amount - charge_amount
-        entry = {'name': stripe_fee.name,
-                 'id': stripe_fee.id,
-                 'fee': stripe_fee_amount.quantize(QUANTIZE_DOLLARS)}
-        ledger['fees'].append(entry)
-        charge_amount = new_charge_amount
-
-    ledger['charge']['final'] = charge_amount.quantize(QUANTIZE_DOLLARS)
-    return ledger
+    def __init__(self, fees):
+        self.names = tuple(f.name for f in fees)
+        # NOTE :: Fee math is done in integer units (see :mod:`pooldlib.money`),
+        # NOTE :: rounding to cents exactly as quantizing the Decimal amounts does.
+        # (name, id, flat, fractional_pct) of each fee but the stripe fee.
+        self.fees = tuple((f.name, f.id, to_units(f.flat), to_units(f.fractional_pct))
+                          for f in fees if f.name != 'stripe-transaction')
+        stripe_fee = [f for f in fees if f.name == 'stripe-transaction']
+        self.stripe_fee = None
+        if stripe_fee:
+            stripe_fee = stripe_fee[0]
+            # Percentages are stored as percentages in the db, convert it to a decimal
+            divisor = UNIT - to_units(stripe_fee.fractional_pct)
+            self.stripe_fee = (stripe_fee.name, stripe_fee.id, to_units(stripe_fee.flat), divisor)
+
+    def price(self, amount, is_payer=True):
+        """Price a single ``amount``, see :func:`total_after_fees`.
+        """
+        if not isinstance(amount, Decimal):
+            msg = 'Transaction amount must be of type decimal.Decimal.'
+            raise TypeError(msg)
+
+        batch = self.price_batch((amount, ), is_payer=is_payer)
+        ledger = {'charge': {'initial': amount,
+                             'final': batch['charge']['final'][0]},
+                  'fees': list()}
+        for entry in batch['fees']:
+            ledger['fees'].append({'name': entry['name'],
+                                   'id': entry['id'],
+                                   'fee': entry['fee'][0]})
+        return ledger
+
+    def price_batch(self, amounts, is_payer=True):
+        """Price each of ``amounts``, see :func:`total_after_fees_batch`.
+        """
+        amounts = list(amounts)
+        if not all(isinstance(a, Decimal) for a in amounts):
+            msg = 'Transaction amounts must be of type decimal.Decimal.'
+            raise TypeError(msg)
+
+        columns = [list() for f in self.fees]
+        stripe_column = list()
+        final = list()
+        for amount in amounts:
+            (final_cents, fee_cents) = self.price_cents(amount, is_payer=is_payer)
+            final.append(from_cents(final_cents))
+            for (column, cents) in zip(columns, fee_cents):
+                column.append(from_cents(cents))
+            if self.stripe_fee is not None:
+                stripe_column.append(from_cents(fee_cents[-1]))
+
+        ledger = {'charge': {'initial': amounts,
+                             'final': final},
+                  'fees': list()}
+        for ((name, id, _, _), column) in zip(self.fees, columns):
+            ledger['fees'].append({'name': name,
+                                   'id': id,
+                                   'fee': column})
+        if self.stripe_fee is not None:
+            (name, id, _, _) = self.stripe_fee
+            ledger['fees'].append({'name': name,
+                                   'id': id,
+                                   'fee': stripe_column})
+        return ledger
+
+    def price_cents(self, amount, is_payer=True):
+        """Price ``amount`` in integer cents, without building a ledger.
+
+        :param amount: The amount on which to base the transaction.
+        :type amount: decimal.Decimal
+
+        :returns: tuple -- ``(final, fees)``, the total charge after fees and a
+                  list of every fee, in the order of :func:`price`, in cents.
+        """
+        multiplier = 1 if is_payer else -1
+        amount = to_units(amount)
+        # Products of two unit amounts carry UNIT * UNIT per currency unit.
+        per_cent = UNIT * UNIT // CENT
+        charge = amount * UNIT
+        fees = list()
+        for (_, _, flat, fractional_pct) in self.fees:
+            fee_total = flat * UNIT + fractional_pct * amount
+            charge += multiplier * fee_total
+            fees.append(round_div(fee_total, per_cent))
+
+        if self.stripe_fee is None:
+            return (round_div(charge, per_cent), fees)
+
+        # The grossed up charge is (flat + charge) / divisor, kept as a fraction.
+        (_, _, flat, divisor) = self.stripe_fee
+        numerator = (flat * UNIT + charge) * UNIT
+        fees.append(round_div(numerator - charge * divisor, divisor * per_cent))
+        return (round_div(numerator, divisor * per_cent), fees)
+
+
+# Keep-alive HTTP connections shared by every Stripe request made through
+# pooldlib, see :func:`configure_http`.
+HTTP_POOL_SIZE = int(config.STRIPE_HTTP_POOL_SIZE or 10)
+HTTP_CONNECT_TIMEOUT = float(config.STRIPE_HTTP_CONNECT_TIMEOUT or 10)
+HTTP_READ_TIMEOUT = float(config.STRIPE_HTTP_READ_TIMEOUT or 80)
+
+_http_session = None
+_http_session_lock = threading.Lock()
+
+
+def configure_http(pool_size=None, connect_timeout=None, read_timeout=None):
+    """Configure the pool of keep-alive HTTPS connections used for requests to
+    Stripe. Defaults are read from the ``STRIPE_HTTP_POOL_SIZE``,
+    ``STRIPE_HTTP_CONNECT_TIMEOUT`` and ``STRIPE_HTTP_READ_TIMEOUT``
+    configuration values. Connections already open are closed.
+
+    :param pool_size: The maximum number of connections kept open per host.
+    :type pool_size: integer
+    :param connect_timeout: Seconds to wait for a connection to be established.
+    :type connect_timeout: float
+    :param read_timeout: Seconds to wait for a response once connected.
+    :type read_timeout: float
+    """
+    global HTTP_POOL_SIZE, HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT, _http_session
+    with _http_session_lock:
+        if pool_size is not None:
+            HTTP_POOL_SIZE = pool_size
+        if connect_timeout is not None:
+            HTTP_CONNECT_TIMEOUT = connect_timeout
+        if read_timeout is not None:
+            HTTP_READ_TIMEOUT = read_timeout
+        session, _http_session = _http_session, None
+    if session is not None:
+        session.close()
+
+
+def http_session():
+    """The :class:`requests.Session` holding the pooled connections to Stripe,
+    created on first use.
+    """
+    global _http_session
+    with _http_session_lock:
+        if _http_session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=2, pool_maxsize=HTTP_POOL_SIZE)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            _http_session = session
+        return _http_session
+
+
+# Circuit breaker settings for requests to Stripe, see :class:`CircuitBreaker`.
+BREAKER_WINDOW = int(config.STRIPE_BREAKER_WINDOW or 50)
+BREAKER_MIN_CALLS = int(config.STRIPE_BREAKER_MIN_CALLS or 10)
+BREAKER_ERROR_RATE = float(config.STRIPE_BREAKER_ERROR_RATE or 0.5)
+BREAKER_SLOW_CALL = float(config.STRIPE_BREAKER_SLOW_CALL or 10)
+BREAKER_RESET_TIMEOUT = float(config.STRIPE_BREAKER_RESET_TIMEOUT or 30)
+
+
+class CircuitBreaker(object):
+    """Track the outcome of calls to an external service over a rolling
+    window of the last ``window`` calls. Once at least ``min_calls`` have
+    been made and the fraction of them which failed, or took longer than
+    ``slow_call`` seconds, reaches ``error_rate``, the circuit *opens* and
+    calls are refused with :class:`pooldlib.exceptions.ExternalAPIUnavailableError`
+    instead of waiting on the service. After ``reset_timeout`` seconds the
+    circuit is *half-open*: up to ``probes`` calls at a time are let through,
+    and the circuit closes again once one succeeds, or re-opens if one fails.
+
+    Usage:
+
+        >>> probe = breaker.acquire()  # Raises if the circuit is open.
+        >>> started = time.time()
+        >>> ...
+        >>> breaker.record(probe, time.time() - started, failed=False)
+        >>> breaker.stats()['p99']
+
+    :param name: Name of the service, used in logs and error messages.
+    :type name: string
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, name, window=BREAKER_WINDOW, min_calls=BREAKER_MIN_CALLS,
+                 error_rate=BREAKER_ERROR_RATE, slow_call=BREAKER_SLOW_CALL,
+                 reset_timeout=BREAKER_RESET_TIMEOUT, probes=1, latency_window=1000):
+        self.name = name
+        self.min_calls = min_calls
+        self.error_rate = error_rate
+        self.slow_call = slow_call
+        self.reset_timeout = reset_timeout
+        self.probes = probes
+        self.state = self.CLOSED
+        self.rejected = 0
+        self._outcomes = deque(maxlen=window)
+        self._failures = 0
+        self._latencies = deque(maxlen=latency_window)
+        self._opened_at = None
+        self._probing = 0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Reserve a call to the service.
+
+        :raises: :class:`pooldlib.exceptions.ExternalAPIUnavailableError`
+
+        :returns: boolean -- `True` if the call is a half-open probe, to be
+                  passed to :meth:`record`.
+        """
+        with self._lock:
+            if self.state == self.OPEN:
+                if time.time() - self._opened_at < self.reset_timeout:
+                    self._reject()
+                self.state = self.HALF_OPEN
+                self._probing = 0
+            if self.state == self.HALF_OPEN:
+                if self._probing >= self.probes:
+                    self._reject()
+                self._probing += 1
+                return True
+        return False
+
+    def record(self, probe, seconds, failed=False):
+        """Record the outcome of a call reserved with :meth:`acquire`.
+
+        :param probe: The value returned by :meth:`acquire`.
+        :type probe: boolean
+        :param seconds: The duration of the call.
+        :type seconds: float
+        :param failed: `True` if the call failed because of the service.
+        :type failed: boolean
+        """
+        failed = failed or seconds >= self.slow_call
+        with self._lock:
+            self._latencies.append(seconds)
+            if probe:
+                self._probing -= 1
+                if failed:
+                    self._open()
+                elif self.state == self.HALF_OPEN:
+                    self.state = self.CLOSED
+                    self._outcomes.clear()
+                    self._failures = 0
+                    logger.info('Circuit breaker closed.', data=dict(service=self.name))
+                return
+            if self.state != self.CLOSED:
+                # NOTE :: The call started before the circuit opened.
+                return
+
+            if len(self._outcomes) == self._outcomes.maxlen and self._outcomes[0]:
+                self._failures -= 1
+            self._outcomes.append(failed)
+            if failed:
+                self._failures += 1
+            calls = len(self._outcomes)
+            if calls >= self.min_calls and self._failures >= self.error_rate * calls:
+                self._open()
+
+    def stats(self):
+        """Current state of the circuit and latency of recent calls.
+
+        :returns: dict, keys: state, calls, error_rate, rejected, p50, p99
+                  (the latency percentiles in seconds, `None` before any call).
+        """
+        with self._lock:
+            latencies = sorted(self._latencies)
+            calls = len(self._outcomes)
+            error_rate = float(self._failures) / calls if calls else 0.0
+            return dict(state=self.state,
+                        calls=calls,
+                        error_rate=error_rate,
+                        rejected=self.rejected,
+                        p50=_percentile(latencies, 0.50),
+                        p99=_percentile(latencies, 0.99))
+
+    def _open(self):
+        self.state = self.OPEN
+        self._opened_at = time.time()
+        data = dict(service=self.name,
+                    calls=len(self._outcomes),
+                    failures=self._failures)
+        logger.error('Circuit breaker opened.', data=data)
+
+    def _reject(self):
+        self.rejected += 1
+        msg = '%s is unavailable, requests are suspended.' % self.name
+        raise ExternalAPIUnavailableError(msg)
+
+
+def _percentile(values, fraction):
+    if not values:
+        return None
+    rank = int(math.ceil(fraction * len(values))) - 1
+    return values[max(rank, 0)]
+
+
+# Guards all requests made to Stripe by :class:`PooledRequestor`.
+breaker = CircuitBreaker('Stripe')
+
+
+class PooledRequestor(stripe.APIRequestor):
+    """A :class:`stripe.APIRequestor` which sends requests over the pooled,
+    keep-alive connections of :func:`http_session` instead of opening a new
+    connection, and completing a new TLS handshake, for every request.
+    Requests are sent to ``api_base``, by default ``stripe.api_base``, and
+    guarded by :data:`breaker`. Connection errors, server errors and slow
+    responses count as failures. If ``idempotency_key`` is given it is sent
+    as the ``Idempotency-Key`` header, so that Stripe answers a repeated
+    request with the response to the first one instead of executing it again.
+
+    The ``requests_request``, ``api_url``, ``encode`` and error handling hooks
+    overridden or used here are internal to ``stripe.APIRequestor``, as of the
+    ``stripe`` version pinned in ``setup.py``.
+    """
+    api_base = None
+
+    def __init__(self, key=None, api_base=None, idempotency_key=None):
+        super(PooledRequestor, self).__init__(key)
+        if api_base is not None:
+            self.api_base = api_base
+        self.idempotency_key = idempotency_key
+
+    def api_url(self, url=''):
+        return '%s%s' % (self.api_base or stripe.api_base, url)
+
+    def requests_request(self, meth, abs_url, headers, params):
+        meth = meth.lower()
+        data = None
+        if meth in ('get', 'delete'):
+            if params:
+                abs_url = '%s?%s' % (abs_url, self.encode(params))
+        elif meth == 'post':
+            data = self.encode(params)
+        else:
+            msg = 'Unrecognized HTTP method %r.' % meth
+            raise stripe.APIConnectionError(msg)
+        if self.idempotency_key is not None:
+            headers = dict(headers)
+            headers['Idempotency-Key'] = self.idempotency_key
+
+        verify = False
+        if stripe.verify_ssl_certs:
+            verify = os.path.join(os.path.dirname(stripe.__file__), 'data', 'ca-certificates.crt')
+        probe = breaker.acquire()
+        started = time.time()
+        status_code = None
+        try:
+            result = http_session().request(meth,
+                                             abs_url,
+                                             headers=headers,
+                                             data=data,
+                                             timeout=(HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT),
+                                             verify=verify)
+            # Reading the content here could raise e.g. a socket timeout.
+            content = result.content
+            status_code = result.status_code
+        except Exception, e:
+            self.handle_requests_error(e)
+        finally:
+            failed = status_code is None or status_code >= 500
+            breaker.record(probe, time.time() - started, failed=failed)
+        return content, status_code
+
+
+def _pooled(resource):
+    """Return a subclass of the stripe ``resource`` whose ``create`` is sent
+    through :class:`PooledRequestor`, to ``api_base`` and with
+    ``idempotency_key`` if given.
+    """
+    class Pooled(resource):
+
+        @classmethod
+        def create(cls, api_key=None, api_base=None, idempotency_key=None, **params):
+            requestor = PooledRequestor(api_key, api_base=api_base, idempotency_key=idempotency_key)
+            response, api_key = requestor.request('post', resource.class_url(), params)
+            return stripe.convert_to_stripe_object(response, api_key)
+
+    Pooled.__name__ = resource.__name__
+    return Pooled
+
+
+_Charge = _pooled(stripe.Charge)
+_Customer = _pooled(stripe.Customer)
+_Token = _pooled(stripe.Token)
 
 
 class _StripeObject(object):
+    """Base of the Stripe clients. Requests are sent to ``api_base`` if it is
+    given, e.g. the address of a :class:`pooldlib.fakestripe.FakeStripeServer`,
+    and otherwise to Stripe.
+    """
 
-    def __init__(self, api_key=None):
+    def __init__(self, api_key=None, api_base=None):
         self.api_key = api_key
+        self.api_base = api_base
 
     def _handle_error(self, error, user, params, raise_errors=True):
         meta = dict(user=str(user),
@@ -153,11 +558,13 @@ class StripeCustomer(_StripeObject):
                       description='Poold user: %s' % user.id,
                       email=user.email)
         try:
-            stripe_user = _Customer.create(api_key=self.api_key, **kwargs)
+            stripe_user = _Customer.create(api_key=self.api_key, api_base=self.api_base, **kwargs)
             msg = 'New Stripe Customer Created'
             logger.transaction(msg, **kwargs)
         except stripe.StripeError, e:
             self._handle_error(e, user, kwargs)
+        except ExternalAPIUnavailableError:
+            raise
         except Exception, e:  # Catch any other error and log, then re-raise
             msg = 'An unknown error occurred while creating a new Stripe Customer.'
             data = dict(error_type=type(e).__class__,
@@ -167,15 +574,29 @@ class StripeCustomer(_StripeObject):
 
         return stripe_user.id
 
-    def charge(self, charge_amount, app_fee, currency, user, charge_description):
-        cust_token = _Token.create(customer=user.stripe_customer_id, api_key=self.api_key)
+    def charge(self, charge_amount, app_fee, currency, user, charge_description, idempotency_key=None):
+        """Charge the Stripe customer of ``user``. If ``idempotency_key`` is
+        given, charging again with the same key, and the same amounts, returns
+        the first charge instead of creating another one.
+        """
+        # NOTE :: The card token is a charge parameter, a repeated charge must reuse it.
+        token_key = None
+        if idempotency_key is not None:
+            token_key = '%s:token' % idempotency_key
+        cust_token = _Token.create(customer=user.stripe_customer_id,
+                                   api_key=self.api_key,
+                                   api_base=self.api_base,
+                                   idempotency_key=token_key)
         kwargs = dict(amount=charge_amount,
                       application_fee=app_fee,
                       card=cust_token.id,
                       currency=currency.code,
                       description=charge_description)
         try:
-            charge = _Charge.create(api_key=self.api_key, **kwargs)
+            charge = _Charge.create(api_key=self.api_key,
+                                    api_base=self.api_base,
+                                    idempotency_key=idempotency_key,
+                                    **kwargs)
         except stripe.StripeError, e:
             self._handle_error(e, user, kwargs)
         return charge
@@ -185,7 +606,7 @@ class StripeUser(_StripeObject):
 
     def __init__(self, *args, **kwargs):
         super(StripeUser, self).__init__(*args, **kwargs)
-        self.client = StripeConnectRequestor(self.api_key)
+        self.client = StripeConnectRequestor(self.api_key, api_base=self.api_base)
 
     def process_authorization_code(self, auth_code, user):
         """Exchange the authorization_code returned by Stripe Connect for an
@@ -218,6 +639,8 @@ class StripeUser(_StripeObject):
             response, api_key = self.client.request('POST', '/oauth/token', params=data)
         except stripe.StripeError, e:
             self._handle_error(e, user, data)
+        except ExternalAPIUnavailableError:
+            raise
         except Exception, e:  # Catch any other error and log, then re-raise
             msg = 'An unexpected error occurred while retrieving access token for user'
             data = dict(error=type(e).__name__,
@@ -233,16 +656,13 @@ class StripeUser(_StripeObject):
         return ret
 
 
-class StripeConnectRequestor(stripe.APIRequestor):
+class StripeConnectRequestor(PooledRequestor):
     """A subclass of :class:`stripe.APIRequestor` to facilitate making
-    requests to Stripe Connect endpoints.  All requests are made using SSL.
+    requests to Stripe Connect endpoints.  All requests are made using SSL,
+    over the pooled connections of :func:`http_session`.
     """
     api_base = 'https://connect.stripe.com'
 
-    @classmethod
-    def api_url(cls, url=''):
-        return '%s%s' % (cls.api_base, url)
-
     def _handle_api_error(self, rbody, rcode, resp):
         # We've got to do some jiggery-pokery with the response
         # so that the super-method can handle errors thrown by
@@ -16,6 +16,10 @@ class BalanceMixin(object):
         :type get_or_create: boolean, default `True`
         :param for_update: If `True` the `FOR UPDATE` directive will be used, locking the row for an `UPDATE` query.
         :type for_update: boolean, default `False`
+
+        If the balance is striped a :class:`StripedBalance` is returned, unless
+        ``for_update`` is `True`, in which case only the first stripe is
+        locked and returned (see :func:`pooldlib.api.balance.get`).
         """
         from pooldlib.api import balance
         from pooldlib.postgresql import (db,
@@ -28,6 +32,8 @@ class BalanceMixin(object):
             balance = balance.get(for_update=for_update, user_id=self.id, currency_id=currency.id)
         else:
             balance = balance.get(for_update=for_update, campaign_id=self.id, currency_id=currency.id)
+        if isinstance(balance, list) and len(balance) > 1:
+            balance = StripedBalance(balance)
 
         # If we don't find a balance for the user, create if requested to
         if not balance and get_or_create:
@@ -50,3 +56,37 @@ class BalanceMixin(object):
         if isinstance(balance, list):
             balance = balance[0]
         return balance
+
+
+class StripedBalance(object):
+    """Read-only view of a balance which has been split across several
+    :class:`pooldlib.postgresql.models.Balance` rows (stripes) to spread lock
+    contention on busy campaign balances. ``amount`` is the sum of all
+    stripes, every other attribute is read from the first stripe.
+
+    :param stripes: All balance rows for a single balance holder and currency.
+    :type stripes: list of :class:`pooldlib.postgresql.models.Balance`
+    """
+
+    def __init__(self, stripes):
+        self.stripes = sorted(stripes, key=lambda s: s.stripe)
+
+    @property
+    def amount(self):
+        return sum((s.amount for s in self.stripes), Decimal('0.0000'))
+
+    def __getattr__(self, name):
+        if name == 'stripes':
+            raise AttributeError(name)
+        return getattr(self.stripes[0], name)
+
+    def __eq__(self, other):
+        if isinstance(other, StripedBalance):
+            other = other.stripes[0]
+        return self.stripes[0] is other
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return '<%r %r stripes=%r>' % (self.__class__.__name__, self.id, len(self.stripes))
@@ -5,10 +5,12 @@ from .campaign import (Campaign,
                        Invitee,
                        CampaignGoal,
                        CampaignGoalAssociation,
-                       CampaignGoalMeta)
+                       CampaignGoalMeta,
+                       CampaignStats,
+                       CampaignGoalStats)
 from .currency import Currency
 from .fee import Fee
 from .ledger import InternalLedger, ExternalLedger, CampaignGoalLedger
 from .purchase import Purchase
-from .transaction import Transfer, Transaction, Exchange
+from .transaction import Transfer, Transaction, TransactKey, Exchange
 from .user import User, UserMeta, AnonymousUser, UserPurchase
@@ -19,6 +19,16 @@ class Balance(common.Model, common.EnabledMixin):
                             nullable=True)
     campaign = db.relationship('Campaign', backref='balances', lazy='select')
     type = db.Column(db.Enum('user', 'campaign', name='balance_type_enum'))
+    # Index of this row among the sub-rows of a striped balance, see
+    # :class:`pooldlib.postgresql.common.StripedBalance`.
+    stripe = db.Column(db.SmallInteger(unsigned=True),
+                       nullable=False,
+                       default=0)
+    # Incremented on every update, stale ORM updates raise
+    # :class:`sqlalchemy.orm.exc.StaleDataError`.
+    version = db.Column(db.Integer, nullable=False)
+
+    __mapper_args__ = {'version_id_col': version}
 
     @classmethod
     def filter_by(cls, currency=None, query=None):
@@ -1,5 +1,10 @@
+from datetime import datetime
+
+from sqlalchemy.exc import IntegrityError
+
 from pooldlib.postgresql import db, common
 from pooldlib.postgresql.types import DateTimeTZ
+from .ledger import CampaignGoalLedger
 
 
 class Campaign(common.ConfigurationModel,
@@ -34,6 +39,12 @@ class CampaignAssociation(db.Model, common.TrackIPMixin, common.TrackTimeMixin,
     role = db.Column(db.Enum('organizer', 'participant', name='campaign_role_enum'))
     pledge = db.Column(db.DECIMAL(precision=24, scale=4),
                        nullable=True)
+    # Set before the pledge is charged, then the Stripe charge id once it has
+    # been, see :func:`pooldlib.api.campaign.collect_pledges`.
+    collecting = db.Column(DateTimeTZ, nullable=True)
+    charge_reference = db.Column(db.String(255), nullable=True)
+    # Set once the pledge has been charged and written to the ledger.
+    collected = db.Column(DateTimeTZ, nullable=True)
 
     __table_args__ = (db.UniqueConstraint(user_id, campaign_id), {})
 
@@ -110,6 +121,15 @@ class CampaignGoal(common.ConfigurationModel, common.ActiveMixin, common.Metadat
                             nullable=True)
 
 
+# Invitation lookup when a user joins, see :func:`pooldlib.api.campaign.associate_user`.
+db.Index('ix_invitee_campaign_id_lower_email', Invitee.campaign_id, db.func.lower(Invitee.email))
+db.Index('ix_invitee_campaign_id_user_id', Invitee.campaign_id, Invitee.user_id)
+
+# Keyset pagination, see :func:`pooldlib.api.campaign.campaigns_page`.
+db.Index('ix_campaign_start_id', Campaign.start, Campaign.id)
+db.Index('ix_campaign_goal_campaign_id_start_id', CampaignGoal.campaign_id, CampaignGoal.start, CampaignGoal.id)
+
+
 class CampaignGoalMeta(common.Model, common.EnabledMixin, common.KeyValueMixin):
     __tablename__ = 'campaign_goal_meta'
 
@@ -117,3 +137,148 @@ class CampaignGoalMeta(common.Model, common.EnabledMixin, common.KeyValueMixin):
     campaign_goal_id = db.Column(db.BigInteger(unsigned=True),
                                  db.ForeignKey('campaign_goal.id'),
                                  nullable=False)
+
+
+class CampaignStats(db.Model, common.TrackTimeMixin):
+    """Running totals for a campaign, kept current by the transactions which
+    write the rows they count, see :func:`pooldlib.api.campaign.stats`.
+    """
+    __tablename__ = 'campaign_stats'
+
+    campaign_id = db.Column(db.BigInteger(unsigned=True),
+                            db.ForeignKey('campaign.id'),
+                            primary_key=True)
+    participants = db.Column(db.Integer, nullable=False, default=0)
+    pledged = db.Column(db.DECIMAL(precision=24, scale=4), nullable=False, default=0)
+    invited = db.Column(db.Integer, nullable=False, default=0)
+    accepted = db.Column(db.Integer, nullable=False, default=0)
+
+    @classmethod
+    def increment(cls, session, campaign_id, **deltas):
+        """Add ``deltas`` to the counters of ``campaign_id`` in ``session``.
+        Call this after writing the counted rows: a campaign without a row yet
+        has one created by counting its rows, which then already holds the
+        deltas.
+
+        :param session: Session in which the counted rows were written.
+        :type session: :class:`pooldlib.postgresql.db.session`
+        :param campaign_id: The campaign whose counters to update.
+        :type campaign_id: integer
+        :param deltas: Amounts to add, keyed by counter name.
+        :type deltas: kwarg dictionary
+        """
+        _increment(session, cls.__table__.c.campaign_id, [campaign_id], cls.tally, deltas)
+
+    @classmethod
+    def tally(cls, campaign_id):
+        """Build a ``SELECT`` counting the counters of ``campaign_id`` from the
+        `CampaignAssociation` and `Invitee` tables, with the columns of
+        ``campaign_stats``.
+        """
+        ca = CampaignAssociation.__table__
+        invitee = Invitee.__table__
+        now = datetime.utcnow()
+        participants = db.select([db.func.count()])\
+                         .where(ca.c.campaign_id == campaign_id)
+        pledged = db.select([db.func.coalesce(db.func.sum(ca.c.pledge), 0)])\
+                    .where(ca.c.campaign_id == campaign_id)
+        invited = db.select([db.func.count()])\
+                    .where(invitee.c.campaign_id == campaign_id)
+        accepted = db.select([db.func.count()])\
+                     .where(invitee.c.campaign_id == campaign_id)\
+                     .where(invitee.c.accepted != None)
+        return db.select([db.literal(campaign_id, type_=db.BigInteger).label('campaign_id'),
+                          participants.as_scalar().label('participants'),
+                          pledged.as_scalar().label('pledged'),
+                          invited.as_scalar().label('invited'),
+                          accepted.as_scalar().label('accepted'),
+                          db.literal(now, type_=cls.__table__.c.created.type).label('created'),
+                          db.literal(now, type_=cls.__table__.c.modified.type).label('modified')])
+
+
+class CampaignGoalStats(db.Model, common.TrackTimeMixin):
+    """Running totals for a campaign goal, the number of associated users and
+    the amount raised, kept current by the transactions which write the rows
+    they count, see :func:`pooldlib.api.campaign.stats`.
+    """
+    __tablename__ = 'campaign_goal_stats'
+
+    campaign_goal_id = db.Column(db.BigInteger(unsigned=True),
+                                 db.ForeignKey('campaign_goal.id'),
+                                 primary_key=True)
+    campaign_id = db.Column(db.BigInteger(unsigned=True),
+                            db.ForeignKey('campaign.id'),
+                            nullable=False,
+                            index=True)
+    participants = db.Column(db.Integer, nullable=False, default=0)
+    raised = db.Column(db.DECIMAL(precision=24, scale=4), nullable=False, default=0)
+
+    @classmethod
+    def increment(cls, session, campaign_goal_ids, campaign_id, **deltas):
+        """Add ``deltas`` to the counters of each of ``campaign_goal_ids``, goals
+        of ``campaign_id``, in ``session``. As with :func:`CampaignStats.increment`,
+        call this after writing the counted rows.
+        """
+        def tally(campaign_goal_id):
+            now = datetime.utcnow()
+            return db.select([db.literal(campaign_goal_id, type_=db.BigInteger).label('campaign_goal_id'),
+                              db.literal(campaign_id, type_=db.BigInteger).label('campaign_id'),
+                              cls.participants_total(campaign_goal_id).label('participants'),
+                              cls.raised_total(campaign_goal_id).label('raised'),
+                              db.literal(now, type_=cls.__table__.c.created.type).label('created'),
+                              db.literal(now, type_=cls.__table__.c.modified.type).label('modified')])
+        _increment(session, cls.__table__.c.campaign_goal_id, campaign_goal_ids, tally, deltas)
+
+    @classmethod
+    def participants_total(cls, campaign_goal_id):
+        """Build a scalar ``SELECT`` counting the `CampaignGoalAssociation` rows
+        of ``campaign_goal_id``, which may be a column to correlate with.
+        """
+        cga = CampaignGoalAssociation.__table__
+        return db.select([db.func.count()])\
+                 .where(cga.c.campaign_goal_id == campaign_goal_id)\
+                 .as_scalar()
+
+    @classmethod
+    def raised_total(cls, campaign_goal_id):
+        """Build a scalar ``SELECT`` summing the `CampaignGoalLedger` of
+        ``campaign_goal_id``, which may be a column to correlate with.
+        """
+        cgl = CampaignGoalLedger.__table__
+        credit = db.func.coalesce(db.func.sum(cgl.c.credit), 0)
+        debit = db.func.coalesce(db.func.sum(cgl.c.debit), 0)
+        return db.select([credit - debit])\
+                 .where(cgl.c.campaign_goal_id == campaign_goal_id)\
+                 .as_scalar()
+
+
+# Postgres error code of a duplicate primary key.
+_UNIQUE_VIOLATION = '23505'
+
+
+def _increment(session, key, key_values, tally, deltas):
+    """Add ``deltas`` to the rows of ``key.table`` with a ``key`` in
+    ``key_values`` with one ``UPDATE``. Missing rows are inserted from the
+    ``SELECT`` returned by ``tally`` for their key. Should another transaction
+    insert the same row first, ``deltas`` are added to its row instead.
+    """
+    table = key.table
+    values = dict((name, table.c[name] + delta) for (name, delta) in deltas.items())
+    values['modified'] = datetime.utcnow()
+    update = table.update().where(key.in_(key_values)).values(values).returning(key)
+    updated = set(row[0] for row in session.execute(update))
+    # NOTE :: Rows are created on first write, counting the rows written so far.
+    for key_value in key_values:
+        if key_value in updated:
+            continue
+        select = tally(key_value)
+        savepoint = session.begin_nested()
+        try:
+            session.execute(table.insert().from_select(select.columns.keys(), select))
+            savepoint.commit()
+        except IntegrityError, e:
+            savepoint.rollback()
+            if getattr(e.orig, 'pgcode', None) != _UNIQUE_VIOLATION:
+                raise
+            # NOTE :: The concurrent insert only counted rows committed before it.
+            session.execute(table.update().where(key == key_value).values(values))
@@ -21,6 +21,16 @@ class Transaction(common.LedgerModel):
                                  nullable=True)
 
 
+class TransactKey(db.Model, common.TrackTimeMixin):
+    """Idempotency key of an executed :class:`pooldlib.Transact` list, mapped
+    to the record id its ledger entries were written with.
+    """
+    __tablename__ = 'transact_key'
+
+    key = db.Column(db.String(255), primary_key=True)
+    record_id = db.Column(UUID, nullable=False)
+
+
 class Exchange(common.LedgerModel):
     debit_currency_id = db.Column(db.BigInteger(unsigned=True),
                                   db.ForeignKey('currency.id'),
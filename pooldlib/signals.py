@@ -49,3 +49,6 @@ _signals = Namespace()
 # Define available signals
 models_committed = _signals.signal('models-committed')
 before_models_committed = _signals.signal('before-models-committed')
+# Sent by :class:`pooldlib.Transact` once an execution completes, successfully
+# or not, with the ``timings`` recorded for it.
+transact_executed = _signals.signal('transact-executed')
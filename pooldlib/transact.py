@@ -5,21 +5,55 @@ pooldlib.api.transact
 .. currentmodule:: pooldlib.api.transact
 
 """
+import time
+import Queue
+import random
+import threading
 from uuid import uuid4 as uuid
 from decimal import Decimal
+from functools import wraps
+from contextlib import contextmanager
 from collections import defaultdict
 
+from sqlalchemy.exc import DBAPIError, IntegrityError
+from sqlalchemy.orm.exc import StaleDataError
 
+from pooldlib.money import to_units, from_units
+from pooldlib.signals import transact_executed
 from pooldlib.sqlalchemy import transaction_session
-from pooldlib.postgresql import (Transaction as TransactionModel,
+from pooldlib.postgresql import (db,
+                                 Transaction as TransactionModel,
                                  Transfer as TransferModel,
+                                 TransactKey as TransactKeyModel,
                                  ExternalLedger as ExternalLedgerModel,
                                  InternalLedger as InternalLedgerModel,
-                                 CampaignGoalLedger as CampaignGoalLedgerModel)
-from pooldlib.exceptions import (InsufficentFundsTransferError,
+                                 CampaignGoalLedger as CampaignGoalLedgerModel,
+                                 CampaignGoalStats as CampaignGoalStatsModel)
+from pooldlib.postgresql.common import StripedBalance
+from pooldlib.exceptions import (TransactAPIError,
+                                 TransactConflictError,
+                                 InsufficentFundsTransferError,
                                  InsufficentFundsTransactionError)
 
 
+MODES = ('lock', 'atomic', 'optimistic')
+# Postgres error codes for aborts which succeed when simply tried again:
+# serialization_failure and deadlock_detected.
+TRANSIENT_PGCODES = ('40001', '40P01')
+
+
+def _staging(method):
+    """Add the time spent in ``method`` to the staging time of the list."""
+    @wraps(method)
+    def timed(self, *args, **kwargs):
+        started = time.time()
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            self._timings['staging'] += time.time() - started
+    return timed
+
+
 class Transact(object):
     """``pooldlib`` API for working with user/user, user/campaign, etc transfers and
     (external) transactions. A user depositing funds in their poold account via stripe
@@ -58,11 +92,91 @@ class Transact(object):
         >>> if not t.verify(): raise TransactionError()
         >>> t.execute()
         >>> # (USD) Balance of a_user is increased by $40.00.
+
+    Balance changes are applied according to ``mode``:
+
+        - ``'lock'`` (default): every touched balance is locked with a single
+          ordered ``SELECT ... FOR UPDATE`` and updated through the ORM.
+        - ``'atomic'``: the net change for each balance is applied in the
+          database with ``UPDATE balance SET amount = amount + :delta``, guarded
+          against overdrawing, without reading the balance first.
+        - ``'optimistic'``: balances are read without locking and updated
+          through the ORM, relying on the balance version column to detect
+          concurrent modification.
+
+        >>> t = Transact(mode='atomic')
+
+    With ``net=True`` the staged credits and debits of each balance are
+    collapsed into their net change before execution, and balances which net
+    to zero are neither locked nor updated. Every transfer, transaction and
+    ledger row is still written. This suits lists of offsetting movements,
+    such as funds passing through a campaign to its organizer:
+
+        >>> t = Transact(net=True)
+
+    In every mode, if the database aborts the execution because of a stale
+    balance version, a deadlock or a serialization failure, the whole
+    transact list is executed again after a randomized, exponentially
+    growing delay, at most ``retries`` more times. The number of retries
+    and give ups across all instances is available from
+    :func:`Transact.retry_stats`.
+
+    The time spent in each phase of staging and executing the list is sent
+    with the :data:`pooldlib.signals.transact_executed` signal once execution
+    completes, successfully or not, as a dict of ``timings``:
+
+        - ``staging``, ``lock``, ``flush``, ``insert``, ``commit`` and
+          ``total``: seconds spent in each phase. ``lock`` is the time spent
+          reading, and waiting to lock, the balances involved.
+        - ``balance_locks``: seconds spent updating each balance, by balance
+          id, in ``'atomic'`` mode, where every balance is locked by its own
+          ``UPDATE``. The other modes lock all balances with one query.
+        - ``rows``: number of rows written, by table name.
+        - ``attempts``: number of times execution was attempted.
+
+        >>> def record(transact, timings=None):
+        ...     histogram('transact.lock').observe(timings['lock'])
+        >>> transact_executed.connect(record)
+
+    :param mode: How balance changes are applied, see above.
+    :type mode: string
+    :param net: Whether to skip balances whose staged changes net to zero.
+    :type net: boolean
+    :param retries: The maximum number of times execution is retried.
+    :type retries: integer
+    :param backoff: Upper bound, in seconds, of the delay before the first
+                    retry. The bound doubles with every further retry.
+    :type backoff: float
+    :param max_backoff: Upper bound, in seconds, of any single delay.
+    :type max_backoff: float
     """
 
-    def __init__(self):
+    _retry_stats = dict(retries=0, give_ups=0)
+    _retry_stats_lock = threading.Lock()
+
+    def __init__(self, mode='lock', net=False, retries=3, backoff=0.01, max_backoff=1.0):
+        if mode not in MODES:
+            msg = 'Unknown Transact mode %r, must be one of %s.'
+            msg %= (mode, ', '.join(MODES))
+            raise TypeError(msg)
+        self.mode = mode
+        self.net = net
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
         self.reset()
 
+    @classmethod
+    def retry_stats(cls):
+        """Counters for retried executions across all transact lists.
+
+        :returns: dict -- ``retries``, the number of times an execution was
+                  retried, and ``give_ups``, the number of executions which
+                  failed after exhausting their retries.
+        """
+        with cls._retry_stats_lock:
+            return dict(cls._retry_stats)
+
     def transfer_to_campaign_goal(self, amount, currency, campaign_goal, transfer_from, id=None):
         """Add a balance **transfer** to the `Transact` list. Use this method if the balance
         transfer is contributing to a specific ``CampaignGoal``. Funds will be transfered *from*
@@ -119,6 +233,7 @@ class Transact(object):
 
         self._record_campaign_goal_transfer(campaign_goal, transfer_to, debit=amount)
 
+    @_staging
     def transfer(self, amount, currency, destination=None, origin=None, fee=None, id=None):
         """Add a balance **transfer** to the `Transact` list.  Valid transfers are:
 
@@ -142,15 +257,16 @@ class Transact(object):
         party = None
         if fee:
             party = getattr(destination, 'username', None) or destination.name
-        credit_balance = destination.balance_for_currency(currency, for_update=True)
+        credit_balance = destination.balance_for_currency(currency)
         self._transfer_credit(credit_balance, amount, fee=fee, party=party, id=id)
 
         party = None
         if fee:
             party = getattr(origin, 'username', None) or origin.name
-        debit_balance = origin.balance_for_currency(currency, for_update=True)
+        debit_balance = origin.balance_for_currency(currency)
         self._transfer_debit(debit_balance, amount, fee=fee, party=party, id=id)
 
+    @_staging
     def transaction(self, balance_holder, external_party, external_reference, currency, debit=None, credit=None, fee=None, id=None):
         """Add an external **transaction** to the `Transact` list.
         One of either ``debit`` or ``credit`` **must** be defined.
@@ -172,15 +288,16 @@ class Transact(object):
         :param fee: Fee associated with the transfer.
         :type fee: :class:`pooldlib.postgresql.models.Fee`, string name of Fee or integer id of Fee.
         """
-        txn_balance = balance_holder.balance_for_currency(currency, for_update=True)
+        txn_balance = balance_holder.balance_for_currency(currency)
         if credit is not None:
             self._transaction_credit(txn_balance, credit, fee=fee, id=id)
         elif debit is not None:
             self._transaction_debit(txn_balance, debit, fee=fee, id=id)
 
+    @_staging
     def external_ledger(self, balance_holder, processor, reference_number, currency,
                         debit=None, credit=None, fee=None, id=None, full_name=None):
-        balance = balance_holder.balance_for_currency(currency, for_update=True)
+        balance = balance_holder.balance_for_currency(currency)
         el = self._new_external_ledger(processor,
                                        balance.currency,
                                        'transaction',
@@ -192,6 +309,18 @@ class Transact(object):
                                        full_name=full_name)
         self._external_ledger_items.append(el)
 
+    def set_reference_number(self, reference_number):
+        """Set the reference number of all external ledger entries which were
+        added without one. This allows the list to be prepared while the
+        external transaction it records is still in progress.
+
+        :param reference_number: Identifier provided by third party referencing transaction.
+        :type reference_number: string
+        """
+        for el in self._external_ledger_items:
+            if el.reference_number is None:
+                el.reference_number = reference_number
+
     def verify(self):
         """Verify that there are no errors associated with the transact list.
 
@@ -199,42 +328,129 @@ class Transact(object):
         """
         return len(self._errors) == 0
 
-    def execute(self):
-        """Atomically execute the full transact list.
+    def execute(self, idempotency_key=None):
+        """Atomically execute the full transact list. Every balance touched by
+        the list is locked with a single ``SELECT ... FOR UPDATE`` ordered by
+        balance id before any of them is modified, so concurrent transact lists
+        always acquire their locks in the same order. All staged rows for each
+        ledger table are written with a single multi-row ``INSERT``.
+
+        If ``idempotency_key`` is given it is recorded along with the ledger
+        entries. Executing any transact list again with the same key writes
+        nothing and returns the record id of the first, successful, execution,
+        which is also assigned to ``self.id``.
+
+        :param idempotency_key: Caller supplied key identifying this execution,
+                                e.g. derived from a client request id.
+        :type idempotency_key: string or `None`
 
         :raises: InsufficentFundsTransferError
+                 InsufficentFundsTransactionError
+                 TransactConflictError
+
+        :returns: uuid -- The record id the ledger entries were written with.
         """
-        if self._errors:
-            exc, msg = self._errors.pop()
-            self.reset()
-            raise exc(msg)
+        self._raise_staging_errors()
 
-        with transaction_session(auto_commit=True) as session:
-            for xfer_class_values in self._transfers.values():
-                for xfer in xfer_class_values.values():
-                    session.add(xfer)
-            session.flush()
+        # NOTE :: Failures reset the list, hold on to its timings.
+        timings = self._timings
+        started = time.time()
+        try:
+            return self._execute_attempts(idempotency_key)
+        finally:
+            timings['total'] = time.time() - started
+            transact_executed.send(self, timings=timings)
 
-            for txn_class_values in self._transactions.values():
-                for txn in txn_class_values.values():
-                    session.add(txn)
-            session.flush()
+    def _execute_attempts(self, idempotency_key):
+        if idempotency_key is not None:
+            record_id = _executed_record_id(idempotency_key)
+            if record_id is not None:
+                self.id = record_id
+                return record_id
+
+        attempts = 0
+        while True:
+            attempts += 1
+            self._timings['attempts'] = attempts
+            try:
+                with transaction_session() as session:
+                    if idempotency_key is not None:
+                        # NOTE :: Inserted first, a concurrent execution with the same
+                        # key blocks here until this transaction completes.
+                        key = dict(key=idempotency_key, record_id=self.id)
+                        session.execute(TransactKeyModel.__table__.insert().values(key))
+                    self._execute(session)
+                    with self._timed('commit'):
+                        session.commit()
+                return self.id
+            except IntegrityError:
+                db.session.rollback()
+                record_id = None
+                if idempotency_key is not None:
+                    record_id = _executed_record_id(idempotency_key)
+                if record_id is None:
+                    raise
+                self.id = record_id
+                return record_id
+            except (StaleDataError, DBAPIError), e:
+                if not _is_transient(e):
+                    raise
+                if attempts > self.retries:
+                    self._count_retry('give_ups')
+                    msg = 'Transact %s failed after %s attempts, its balances were modified concurrently: %s'
+                    msg %= (self.id, attempts, e)
+                    self.reset()
+                    raise TransactConflictError(msg)
+            self._count_retry('retries')
+            delay = min(self.max_backoff, self.backoff * 2 ** (attempts - 1))
+            time.sleep(random.uniform(0, delay))
 
     def reset(self):
         """Reset the current state of the transact list.
         """
-        self._transfers = defaultdict(lambda: defaultdict(int))
+        # Staged transfer and transaction rows, keyed by (balance id, direction).
+        self._transfers = dict()
         self._internal_ledger_items = list()
-        self._transactions = defaultdict(lambda: defaultdict(int))
+        self._transactions = dict()
         self._external_ledger_items = list()
+        self._campaign_goal_ledger_items = list()
+        # NOTE :: Staged amounts are held in integer units, see :mod:`pooldlib.money`.
+        self._balance_deltas = defaultdict(int)
+        self._balance_debits = dict()
+        # NOTE :: Balances are referenced by id only once staged, so that the
+        # NOTE :: list can be executed in a session other than the staging one.
+        self._striped_balances = dict()
+        self._stripe_debits = defaultdict(int)
         self._errors = list()
+        self._timings = dict(staging=0.0,
+                             lock=0.0,
+                             balance_locks=dict(),
+                             flush=0.0,
+                             insert=0.0,
+                             commit=0.0,
+                             total=0.0,
+                             rows=dict(),
+                             attempts=0)
         self.id = uuid()
 
+    def _credited_stripe(self, balance):
+        """Return the balance a credit to ``balance`` is written against. A
+        :class:`pooldlib.postgresql.common.StripedBalance` is credited through
+        one of its stripes, chosen at random, so that both the ledger row and
+        the balance change reference the same row.
+        """
+        stripes = getattr(balance, 'stripes', None)
+        if stripes:
+            return random.choice(stripes)
+        return balance
+
     def _transfer_credit(self, balance, amount, fee=None, party=None, id=None):
-        t = self._transfers['credit'][balance.id] or self._new_transfer(balance, id=id)
-        t.credit = t.credit or Decimal('0.0000')
-        t.credit += amount
-        balance.amount += amount
+        balance = self._credited_stripe(balance)
+        key = (balance.id, 'credit')
+        t = self._transfers.get(key) or self._new_transfer(balance, id=id)
+        units = to_units(amount)
+        t.credit = (t.credit or 0) + units
+        self._stage_balance_delta(balance, units)
 
         if fee:
             il = self._new_internal_ledger(party,
@@ -245,13 +461,13 @@ class Transact(object):
                                            id=None)
             self._internal_ledger_items.append(il)
 
-        self._transfers['credit'][balance.id] = t
+        self._transfers[key] = t
 
     def _transfer_debit(self, balance, amount, fee=None, party=None, id=None):
-        t = self._transfers['debit'][balance.id] or self._new_transfer(balance, id=id)
-        t.debit = t.debit or Decimal('0.0000')
-        t.debit += amount
-        balance.amount -= amount
+        key = (balance.id, 'debit')
+        t = self._transfers.get(key) or self._new_transfer(balance, id=id)
+        units = to_units(amount)
+        t.debit = (t.debit or 0) + units
 
         if fee:
             il = self._new_internal_ledger(party,
@@ -262,88 +478,647 @@ class Transact(object):
                                            id=None)
             self._internal_ledger_items.append(il)
 
-        if balance.amount < Decimal('0.0000'):
-            msg = 'Transfer of %s failed, %s balance %s has insufficient funds (%s).'
-            msg %= (amount, balance.type, balance, balance.amount)
-            self._errors.append((InsufficentFundsTransferError, msg))
-
-        self._transfers['debit'][balance.id] = t
+        self._stage_balance_delta(balance, -units, error=InsufficentFundsTransferError)
+        self._transfers[key] = t
 
     def _transaction_credit(self, balance, amount, fee=None, id=None):
-        t = self._transactions['credit'][balance.id] or self._new_transaction(balance, id=id)
-        t.credit = t.credit or Decimal('0.0000')
-        t.credit += amount
-        balance.amount += amount
-        self._transactions['credit'][balance.id] = t
+        balance = self._credited_stripe(balance)
+        key = (balance.id, 'credit')
+        t = self._transactions.get(key) or self._new_transaction(balance, id=id)
+        units = to_units(amount)
+        t.credit = (t.credit or 0) + units
+        self._stage_balance_delta(balance, units)
+        self._transactions[key] = t
 
     def _transaction_debit(self, balance, amount, fee=None, id=None):
-        t = self._transactions['debit'][balance.id] or self._new_transaction(balance, id=id)
-        t.debit = t.debit or Decimal('0.0000')
-        t.debit += amount
-        balance.amount -= amount
+        key = (balance.id, 'debit')
+        t = self._transactions.get(key) or self._new_transaction(balance, id=id)
+        units = to_units(amount)
+        t.debit = (t.debit or 0) + units
+        self._stage_balance_delta(balance, -units, error=InsufficentFundsTransactionError)
+        self._transactions[key] = t
+
+    def _count_retry(self, counter):
+        with self._retry_stats_lock:
+            self._retry_stats[counter] += 1
+
+    @contextmanager
+    def _timed(self, phase):
+        started = time.time()
+        try:
+            yield
+        finally:
+            self._timings[phase] += time.time() - started
+
+    def _raise_staging_errors(self):
+        if self._errors:
+            exc, msg = self._errors.pop()
+            self.reset()
+            raise exc(msg)
+
+    def _execute(self, session):
+        """Apply all staged balance changes and write all staged ledger rows
+        in ``session``, without committing.
+        """
+        if self.mode == 'atomic':
+            self._apply_balance_deltas_atomic()
+        else:
+            self._apply_balance_deltas(for_update=self.mode == 'lock')
+        # Write the balance changes first, ledger rows reference them.
+        with self._timed('flush'):
+            session.flush()
+        with self._timed('insert'):
+            for (model, items) in self._ledger_items():
+                self._timings['rows'][model.__tablename__] = _bulk_insert(session, model, items)
+            self._update_goal_stats(session)
+
+    def _update_goal_stats(self, session):
+        """Add the staged campaign goal transfers to the amount raised for
+        each goal, see :class:`pooldlib.postgresql.models.CampaignGoalStats`.
+        """
+        raised = defaultdict(int)
+        for item in self._campaign_goal_ledger_items:
+            raised[(item.campaign_goal_id, item.campaign_id)] += (item.credit or 0) - (item.debit or 0)
+        # NOTE :: Updated in goal id order, like balances, to avoid deadlocks.
+        for ((goal_id, campaign_id), units) in sorted(raised.items()):
+            CampaignGoalStatsModel.increment(session, [goal_id], campaign_id, raised=from_units(units))
+
+    def _stage_balance_delta(self, balance, delta, error=None):
+        """Record a change of ``delta`` units to ``balance``. Balances are not locked
+        or modified until :func:`Transact.execute`, the check made here
+        against the unlocked amount only serves :func:`Transact.verify`.
+
+        Debits from a :class:`pooldlib.postgresql.common.StripedBalance` are
+        drawn down across its stripes once they are locked, credits are staged
+        against a single stripe, see :func:`Transact._credited_stripe`.
+        """
+        stripes = getattr(balance, 'stripes', None)
+        if stripes:
+            self._striped_balances[balance.id] = [s.id for s in stripes]
+            self._stripe_debits[balance.id] -= delta
+            self._balance_debits[balance.id] = error
+            remaining = sum(to_units(s.amount) + self._balance_deltas.get(s.id, 0) for s in stripes)
+            remaining -= self._stripe_debits[balance.id]
+            if remaining < 0:
+                self._errors.append(_insufficient_funds(error, -delta, balance, remaining))
+            return
+
+        self._balance_deltas[balance.id] += delta
+        if error is None:
+            return
+
+        self._balance_debits[balance.id] = error
+        remaining = to_units(balance.amount) + self._balance_deltas[balance.id]
+        if remaining < 0:
+            self._errors.append(_insufficient_funds(error, -delta, balance, remaining))
+
+    def _staged_deltas(self):
+        """Return copies of the staged balance deltas, the error to raise for
+        each debited balance and the staged debits of striped balances, so
+        that executing the list leaves the staged state untouched should the
+        attempt be retried. If ``self.net`` is `True`, credits to the stripes
+        of a striped balance are first set against its debits, and balances
+        left with no change are dropped.
+
+        :returns: tuple -- ``(deltas, debits, stripe_debits)``
+        """
+        deltas = dict(self._balance_deltas)
+        debits = dict(self._balance_debits)
+        stripe_debits = dict(self._stripe_debits)
+        if not self.net:
+            return (deltas, debits, stripe_debits)
+
+        for (balance_id, amount) in stripe_debits.items():
+            for stripe_id in self._striped_balances[balance_id]:
+                credit = deltas.get(stripe_id, 0)
+                take = min(credit, amount)
+                if take > 0:
+                    deltas[stripe_id] = credit - take
+                    amount -= take
+            stripe_debits[balance_id] = amount
+
+        deltas = dict((i, d) for (i, d) in deltas.items() if d != 0)
+        stripe_debits = dict((i, d) for (i, d) in stripe_debits.items() if d != 0)
+        return (deltas, debits, stripe_debits)
+
+    def _stripe_ids(self, stripe_debits):
+        ids = set()
+        for balance_id in stripe_debits:
+            ids.update(self._striped_balances[balance_id])
+        return ids
+
+    def _balance_ids(self):
+        """Return the ids of every balance, and every stripe of a striped
+        balance, touched by the list.
+        """
+        ids = set(self._balance_deltas.keys())
+        for stripe_ids in self._striped_balances.values():
+            ids.update(stripe_ids)
+        return ids
+
+    def _draw_down_stripes(self, rows, deltas, debits, stripe_debits):
+        """Spread each staged debit of a striped balance over its stripes in
+        ``rows``, taking from the fullest stripes first, and fold the result
+        into ``deltas``.
+
+        :raises: InsufficentFundsTransferError
+                 InsufficentFundsTransactionError
+        """
+        for (balance_id, amount) in stripe_debits.items():
+            stripes = [rows[i] for i in self._striped_balances[balance_id]]
+            striped = StripedBalance(list(stripes))
+            available = lambda s: to_units(s.amount) + deltas.get(s.id, 0)
+            stripes.sort(key=available, reverse=True)
+
+            remaining = amount
+            for stripe in stripes:
+                take = min(available(stripe), remaining)
+                if take <= 0:
+                    break
+                deltas[stripe.id] = deltas.get(stripe.id, 0) - take
+                debits[stripe.id] = self._balance_debits[balance_id]
+                remaining -= take
+
+            if remaining > 0:
+                error = self._balance_debits[balance_id]
+                exc, msg = _insufficient_funds(error, amount, striped, -remaining)
+                self.reset()
+                raise exc(msg)
+
+    def _apply_balance_deltas(self, for_update=True):
+        """Read every staged balance in a single query ordered by id, then
+        apply the net change for each one through the ORM. If ``for_update``
+        is `True` the balances are locked by the read, otherwise concurrent
+        changes are detected by the version check made when the changes are
+        flushed.
+
+        :raises: InsufficentFundsTransferError
+                 InsufficentFundsTransactionError
+        """
+        from pooldlib.api import balance as _balance
+
+        (deltas, debits, stripe_debits) = self._staged_deltas()
+        ids = set(deltas.keys()) | self._stripe_ids(stripe_debits)
+        with self._timed('lock'):
+            if for_update:
+                rows = _balance.lock(list(ids))
+            else:
+                rows = _balance.refresh(list(ids))
+        rows = dict((b.id, b) for b in rows)
+        self._draw_down_stripes(rows, deltas, debits, stripe_debits)
+
+        for balance_id in sorted(deltas.keys()):
+            balance = rows[balance_id]
+            delta = deltas[balance_id]
+            balance.amount += from_units(delta)
+            if balance.amount < Decimal('0.0000'):
+                error = debits[balance.id]
+                exc, msg = _insufficient_funds(error, -delta, balance, to_units(balance.amount))
+                self.reset()
+                raise exc(msg)
+
+    def _apply_balance_deltas_atomic(self):
+        """Apply the net change for each staged balance with a single guarded
+        ``UPDATE`` per balance, in balance id order. A balance which would be
+        overdrawn is left untouched by the database and reported as having
+        insufficient funds. Only the stripes of striped balances being debited
+        are locked, so their debits can be spread across them.
+
+        :raises: InsufficentFundsTransferError
+                 InsufficentFundsTransactionError
+        """
+        from pooldlib.api import balance as _balance
 
-        if balance.amount < Decimal('0.0000'):
-            msg = 'Transaction of %s failed, %s balance %s has insufficient funds (%s).'
-            msg %= (amount, balance.type, balance, balance.amount)
-            self._errors.append((InsufficentFundsTransactionError, msg))
+        (deltas, debits, stripe_debits) = self._staged_deltas()
+        stripe_ids = self._stripe_ids(stripe_debits)
+        if stripe_ids:
+            with self._timed('lock'):
+                rows = dict((b.id, b) for b in _balance.lock(list(stripe_ids)))
+            self._draw_down_stripes(rows, deltas, debits, stripe_debits)
 
-        self._transactions['debit'][balance.id] = t
+        for balance_id in sorted(deltas.keys()):
+            delta = deltas[balance_id]
+            if delta == 0:
+                continue
+            started = time.time()
+            amount = _balance.apply_delta(balance_id, from_units(delta))
+            waited = time.time() - started
+            self._timings['balance_locks'][balance_id] = waited
+            self._timings['lock'] += waited
+            if amount is None:
+                (balance,) = _balance.refresh([balance_id])
+                error = debits[balance_id]
+                exc, msg = _insufficient_funds(error, -delta, balance, to_units(balance.amount) + delta)
+                self.reset()
+                raise exc(msg)
 
+    def _ledger_items(self):
+        """Return ``(model, items)`` pairs for every ledger table written by
+        :func:`Transact.execute`, in insert order.
+        """
+        return ((TransferModel, self._transfers.values()),
+                (TransactionModel, self._transactions.values()),
+                (InternalLedgerModel, self._internal_ledger_items),
+                (ExternalLedgerModel, self._external_ledger_items),
+                (CampaignGoalLedgerModel, self._campaign_goal_ledger_items))
+
+    # NOTE :: Ledger rows are staged as plain records holding the column values,
+    # NOTE :: related rows are referenced by id only. They are turned into
+    # NOTE :: table rows by :func:`_bulk_insert` when the list is executed.
     def _new_transfer(self, balance, id=None):
-        t = TransferModel()
-        t.balance = balance
-        t.record_id = id or self.id
-        return t
+        return _StagedBalanceEntry(balance_id=balance.id, record_id=id or self.id)
 
     def _new_transaction(self, balance, id=None):
-        t = TransactionModel()
-        t.balance = balance
-        t.id = id or self.id
-        return t
+        # NOTE :: Transactions have no record_id, the row id is the record id.
+        return _StagedBalanceEntry(balance_id=balance.id, id=id or self.id)
 
     def _new_internal_ledger(self, party, currency, record_table, fee, debit=None, credit=None, id=None):
-        il = InternalLedgerModel()
+        il = _StagedInternalLedger()
         il.record_id = id or self.id
         il.record_table = record_table
         il.party = party
-        il.currency = currency
-        il.fee = fee
+        il.currency_id = currency.id
+        il.fee_id = _fee_id(fee)
 
         if credit is not None:
-            il.credit = credit
+            il.credit = to_units(credit)
         elif debit is not None:
-            il.debit = debit
+            il.debit = to_units(debit)
         return il
 
     def _new_external_ledger(self, processor, currency, record_table, reference_number,
                              fee, debit=None, credit=None, id=None, full_name=None):
-        el = ExternalLedgerModel()
+        el = _StagedExternalLedger()
         el.record_id = id or self.id
         el.record_table = record_table
         el.reference_number = reference_number
         el.processor = processor
-        el.currency = currency
-        el.fee = fee
+        el.currency_id = currency.id
+        el.fee_id = _fee_id(fee)
         el.full_name = full_name
 
         if credit is not None:
-            el.credit = credit
+            el.credit = to_units(credit)
         elif debit is not None:
-            el.debit = debit
+            el.debit = to_units(debit)
         return el
 
+    @_staging
     def _record_campaign_goal_transfer(self, campaign_goal, transferrer, debit=None, credit=None):
-        cgl = CampaignGoalLedgerModel()
-        cgl.campaign_goal = campaign_goal
-        cgl.campaign = campaign_goal.campaign
+        cgl = _StagedCampaignGoalLedger()
+        cgl.campaign_goal_id = campaign_goal.id
+        cgl.campaign_id = campaign_goal.campaign_id
         cgl.party_type = transferrer.__class__.__name__.lower()
         cgl.party_id = transferrer.id
         if debit is not None:
-            cgl.debit = debit
-            self._transfers['debit'][campaign_goal.name] = cgl
+            cgl.debit = to_units(debit)
         elif credit is not None:
-            cgl.credit = credit
-            self._transfers['credit'][campaign_goal.name] = cgl
+            cgl.credit = to_units(credit)
         else:
             msg = "One of ``debit`` or ``credit`` must be defined!"
             raise TypeError(msg)
+        self._campaign_goal_ledger_items.append(cgl)
+
+
+class TransactBatcher(object):
+    """Group commit for :class:`Transact` lists executed from many threads.
+    Submitted transact lists are collected by a single worker thread for up
+    to ``window`` seconds, or until ``max_items`` are waiting, and executed
+    together in one database transaction with a single commit. Every balance
+    touched by the batch is locked once, in balance id order, before any of
+    the lists is executed. Each transact list then runs within its own
+    savepoint, so a failure in one of them does not affect the others in the
+    batch. Should the database abort the batch with a deadlock or a
+    serialization failure it is executed again, as by :func:`Transact.execute`.
+
+    Usage:
+
+        >>> batcher = TransactBatcher(window=0.005, max_items=200)
+        >>> t = Transact()
+        >>> t.transfer(Decimal('25.0000'), currency, destination=a_campaign, origin=a_user)
+        >>> batcher.execute(t)  # Blocks until the batch is committed.
+        >>> pending = batcher.submit(another_transact)
+        >>> pending.wait()  # Raises any error encountered executing the transact.
+
+    :param window: The maximum number of seconds to wait for more transact
+                   lists once the first one of a batch is received.
+    :type window: float
+    :param max_items: The maximum number of transact lists in a single batch.
+    :type max_items: integer
+    :param retries: The maximum number of times a batch is retried.
+    :type retries: integer
+    :param backoff: Upper bound, in seconds, of the delay before the first
+                    retry. The bound doubles with every further retry.
+    :type backoff: float
+    :param max_backoff: Upper bound, in seconds, of any single delay.
+    :type max_backoff: float
+    """
+
+    def __init__(self, window=0.005, max_items=200, retries=3, backoff=0.01, max_backoff=1.0):
+        self.window = window
+        self.max_items = max_items
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self._queue = Queue.Queue()
+        self._lock = threading.Lock()
+        self._worker = None
+
+    def submit(self, transact, idempotency_key=None):
+        """Queue ``transact`` for execution with the next batch.
+
+        :param transact: The transact list to execute.
+        :type transact: :class:`Transact`
+        :param idempotency_key: Caller supplied key identifying this execution,
+                                see :func:`Transact.execute`.
+        :type idempotency_key: string or `None`
+
+        :raises: InsufficentFundsTransferError
+                 InsufficentFundsTransactionError
+
+        :returns: :class:`PendingTransact`
+        """
+        transact._raise_staging_errors()
+        pending = PendingTransact(transact, idempotency_key=idempotency_key)
+        self._start()
+        self._queue.put(pending)
+        return pending
+
+    def execute(self, transact, idempotency_key=None, timeout=None):
+        """Execute ``transact`` with the next batch and block until the batch
+        has been committed. Errors are raised, and the record id returned, as
+        by :func:`Transact.execute`.
+        """
+        return self.submit(transact, idempotency_key=idempotency_key).wait(timeout=timeout)
+
+    def stop(self):
+        """Execute any queued transact lists and stop the worker thread.
+        """
+        with self._lock:
+            worker, self._worker = self._worker, None
+        if worker is None:
+            return
+        self._queue.put(None)
+        worker.join()
+
+    def _start(self):
+        with self._lock:
+            if self._worker is not None:
+                return
+            self._worker = threading.Thread(target=self._run, name='TransactBatcher')
+            self._worker.daemon = True
+            self._worker.start()
+
+    def _run(self):
+        from pooldlib.postgresql import db
+
+        running = True
+        while running:
+            batch = [self._queue.get()]
+            if batch[0] is None:
+                break
+            deadline = time.time() + self.window
+            while len(batch) < self.max_items:
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    break
+                try:
+                    pending = self._queue.get(timeout=timeout)
+                except Queue.Empty:
+                    break
+                if pending is None:
+                    running = False
+                    break
+                batch.append(pending)
+            self._execute_batch(batch)
+        db.shutdown_session()
+
+    def _execute_batch(self, batch):
+        started = time.time()
+        committing = None
+        attempts = 0
+        while True:
+            attempts += 1
+            try:
+                committing = self._commit_batch(batch)
+                break
+            except (StaleDataError, DBAPIError), e:
+                if not _is_transient(e):
+                    self._fail_batch(batch, e)
+                    break
+                if attempts > self.retries:
+                    msg = 'Batch of %s transact lists failed after %s attempts, its balances were modified concurrently: %s'
+                    msg %= (len(batch), attempts, e)
+                    self._fail_batch(batch, TransactConflictError(msg))
+                    break
+            except Exception, e:
+                self._fail_batch(batch, e)
+                break
+            delay = min(self.max_backoff, self.backoff * 2 ** (attempts - 1))
+            time.sleep(random.uniform(0, delay))
+
+        finished = time.time()
+        for pending in batch:
+            # NOTE :: The commit, and total time, is shared by the whole batch.
+            timings = pending.transact._timings
+            timings['attempts'] = attempts
+            if committing is not None:
+                timings['commit'] = finished - committing
+            timings['total'] = finished - started
+            transact_executed.send(pending.transact, timings=timings)
+            pending.done.set()
+
+    def _commit_batch(self, batch):
+        """Execute every transact list in ``batch`` which has not already
+        failed, each within its own savepoint, and commit them together.
+        Transient database errors abort the whole batch, so that it can be
+        tried again.
+
+        :returns: float, the time at which the commit started.
+        """
+        from pooldlib.api import balance as _balance
+
+        batch = [p for p in batch if p.error is None]
+        with transaction_session() as session:
+            # NOTE :: Lists in a batch may touch the same balances in any order,
+            # NOTE :: lock all of them up front, in id order, so that batches
+            # NOTE :: and single transact lists cannot deadlock each other.
+            ids = set()
+            for pending in batch:
+                ids.update(pending.transact._balance_ids())
+            locking = time.time()
+            _balance.lock(sorted(ids))
+            waited = time.time() - locking
+            for pending in batch:
+                pending.transact._timings['lock'] += waited
+
+            for pending in batch:
+                savepoint = session.begin_nested()
+                try:
+                    pending.execute(session)
+                    savepoint.commit()
+                except IntegrityError, e:
+                    savepoint.rollback()
+                    if not pending.executed_record():
+                        pending.error = e
+                except (StaleDataError, DBAPIError), e:
+                    savepoint.rollback()
+                    if _is_transient(e):
+                        raise
+                    pending.error = e
+                except Exception, e:
+                    savepoint.rollback()
+                    pending.error = e
+            committing = time.time()
+            session.commit()
+        return committing
+
+    def _fail_batch(self, batch, error):
+        # The batch as a whole failed to commit.
+        for pending in batch:
+            pending.error = pending.error or error
+
+
+class PendingTransact(object):
+    """Handle for a :class:`Transact` submitted to a :class:`TransactBatcher`.
+    """
+
+    def __init__(self, transact, idempotency_key=None):
+        self.transact = transact
+        self.idempotency_key = idempotency_key
+        self.error = None
+        self.done = threading.Event()
+
+    def wait(self, timeout=None):
+        """Block until the batch containing the transact list is committed.
+
+        :raises: Any error encountered while executing the transact list.
+                 :class:`pooldlib.exceptions.TransactAPIError` if ``timeout``
+                 seconds pass before the batch completes.
+
+        :returns: uuid -- The record id the ledger entries were written with.
+        """
+        if not self.done.wait(timeout):
+            msg = 'Timed out waiting for batched transact %s.' % self.transact.id
+            raise TransactAPIError(msg)
+        if self.error is not None:
+            raise self.error
+        return self.transact.id
+
+    def execute(self, session):
+        """Execute the transact list in ``session``, recording its
+        ``idempotency_key`` first, see :func:`Transact.execute`. A list whose
+        key has already been executed writes nothing.
+        """
+        if self.executed_record():
+            return
+        if self.idempotency_key is not None:
+            key = dict(key=self.idempotency_key, record_id=self.transact.id)
+            session.execute(TransactKeyModel.__table__.insert().values(key))
+        self.transact._execute(session)
+
+    def executed_record(self):
+        """If the ``idempotency_key`` of the list has already been executed,
+        take over the record id of that execution.
+
+        :returns: bool -- ``True`` if the key has already been executed.
+        """
+        if self.idempotency_key is None:
+            return False
+        record_id = _executed_record_id(self.idempotency_key)
+        if record_id is None:
+            return False
+        self.transact.id = record_id
+        return True
+
+
+def _fee_id(fee):
+    """Return the id of ``fee``, a :class:`pooldlib.postgresql.models.Fee`,
+    an integer id of a Fee or `None`.
+    """
+    return getattr(fee, 'id', fee)
+
+
+def _executed_record_id(idempotency_key):
+    q = db.session.query(TransactKeyModel.record_id)
+    return q.filter_by(key=idempotency_key).scalar()
+
+
+def _is_transient(error):
+    if isinstance(error, StaleDataError):
+        return True
+    return getattr(error.orig, 'pgcode', None) in TRANSIENT_PGCODES
+
+
+def _insufficient_funds(error, amount, balance, remaining):
+    action = 'Transfer' if error is InsufficentFundsTransferError else 'Transaction'
+    msg = '%s of %s failed, %s balance %s has insufficient funds (%s).'
+    msg %= (action, from_units(amount), balance.type, balance, from_units(remaining))
+    return (error, msg)
+
+
+class _StagedRow(object):
+    """Column values of a ledger row staged by a :class:`Transact` list.
+    Columns not named in ``__slots__`` are written as `NULL`, or their default.
+    ``debit`` and ``credit`` are held in integer units.
+    """
+    __slots__ = ()
+
+    def __init__(self, **kw):
+        for name in self.__slots__:
+            setattr(self, name, kw.get(name))
+
+
+class _StagedBalanceEntry(_StagedRow):
+    """A transfer or transaction row, one per (balance, direction)."""
+    __slots__ = ('id', 'record_id', 'balance_id', 'debit', 'credit')
+
+
+class _StagedInternalLedger(_StagedRow):
+    __slots__ = ('record_id', 'record_table', 'party', 'currency_id', 'fee_id', 'debit', 'credit')
+
+
+class _StagedExternalLedger(_StagedRow):
+    __slots__ = ('record_id', 'record_table', 'reference_number', 'processor',
+                 'currency_id', 'fee_id', 'full_name', 'debit', 'credit')
+
+
+class _StagedCampaignGoalLedger(_StagedRow):
+    __slots__ = ('campaign_goal_id', 'campaign_id', 'party_type', 'party_id', 'debit', 'credit')
+
+
+def _ledger_row(item, table):
+    """Column values of the staged ``item`` for ``table``. Columns left unset
+    which have a default are omitted, so the default applies.
+    """
+    row = dict()
+    for c in table.columns:
+        value = getattr(item, c.key, None)
+        if value is None and c.default is not None:
+            continue
+        row[c.key] = value
+    for key in ('debit', 'credit'):
+        if row.get(key) is not None:
+            row[key] = from_units(row[key])
+    return row
+
+
+def _bulk_insert(session, model, items):
+    """Write all ``items`` to the table of ``model`` with a single multi-row
+    ``INSERT`` statement, bypassing the per-object ORM flush.
+
+    :param session: Session in which to execute the insert.
+    :type session: :class:`pooldlib.postgresql.db.session`
+    :param model: Ledger model class whose table receives the rows.
+    :type model: subclass of :class:`pooldlib.postgresql.common.LedgerModel`
+    :param items: Staged rows for the table of ``model``.
+    :type items: list of staged rows
+
+    :returns: integer, the number of rows written.
+    """
+    if not items:
+        return 0
+    table = model.__table__
+    rows = [_ledger_row(item, table) for item in items]
+    session.execute(table.insert().values(rows))
+    return len(rows)
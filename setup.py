@@ -31,7 +31,10 @@ install_requires = [
     'cement==2.0.2',
     'Werkzeug>=0.7',
     'SQLAlchemy',
-    'stripe',
+    # NOTE :: pooldlib.payment.PooledRequestor overrides internal hooks of
+    # NOTE :: stripe.APIRequestor, only upgrade along with it.
+    'stripe==1.7.0',
+    'requests>=2.4',
     'twilio',
 ]
 
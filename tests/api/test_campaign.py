@@ -2,22 +2,31 @@ from datetime import datetime, timedelta
 from decimal import Decimal
 import pytz
 from uuid import uuid4 as uuid
-from nose.tools import raises, assert_equal, assert_true, assert_false
+from nose.tools import raises, assert_equal, assert_true, assert_false, assert_raises
+from mock import patch
 
 from pooldlib.exceptions import (InvalidUserRoleError,
                                  InvalidGoalParticipationNameError,
                                  DuplicateCampaignUserAssociationError,
                                  DuplicateCampaignGoalUserAssociationError,
-                                 PreviousUserContributionError)
+                                 PreviousUserContributionError,
+                                 PledgeCollectionPendingError,
+                                 StripeCustomerAccountError)
 from pooldlib.postgresql import db
 from pooldlib.postgresql import (Campaign as CampaignModel,
+                                 Currency as CurrencyModel,
+                                 Fee as FeeModel,
+                                 Transaction as TransactionModel,
+                                 ExternalLedger as ExternalLedgerModel,
                                  Invitee as InviteeModel,
                                  CampaignMeta as CampaignMetaModel,
                                  CampaignGoal as CampaignGoalModel,
                                  CampaignGoalAssociation as CampaignGoalAssociationModel,
-                                 CampaignAssociation as CampaignAssociationModel)
+                                 CampaignAssociation as CampaignAssociationModel,
+                                 CampaignStats as CampaignStatsModel)
 
 from pooldlib.api import campaign
+from pooldlib.fakestripe import FakeStripeServer
 
 from tests import tag
 from tests.base import PooldLibPostgresBaseTest
@@ -128,6 +137,26 @@ class TestGetCampaigns(PooldLibPostgresBaseTest):
                                    filter_inactive=True)
         assert_equal(1, len(comms))
 
+    @tag('campaign')
+    def test_campaigns_page(self):
+        ids = [self.com_one_id, self.com_two_id, self.com_three_id]
+        (page, cursor) = campaign.campaigns_page(ids, filter_inactive=False, limit=2)
+        assert_equal([self.com_one_id, self.com_two_id], [c.id for c in page])
+        (page, cursor) = campaign.campaigns_page(ids, filter_inactive=False, limit=2, cursor=cursor)
+        assert_equal([self.com_three_id], [c.id for c in page])
+        assert_true(cursor is None)
+
+    @tag('campaign')
+    @raises(ValueError)
+    def test_campaigns_page_invalid_cursor(self):
+        campaign.campaigns_page(None, cursor='not a cursor')
+
+    @tag('campaign')
+    def test_iter_campaigns(self):
+        ids = [self.com_one_id, self.com_two_id, self.com_three_id]
+        comms = campaign.iter_campaigns(ids, filter_inactive=False, chunk_size=2)
+        assert_equal(ids, [c.id for c in comms])
+
     @tag('campaign')
     def test_get_campaigns_exclude_all_inactive(self):
         comms = campaign.campaigns([self.com_one_id, self.com_three_id])
@@ -267,6 +296,33 @@ class TestCampaignInvite(PooldLibPostgresBaseTest):
             assert_equal(self.campaign.id, invite.campaign_id)
             assert_true(invite.user_id is None)
 
+    @tag('campaign')
+    def test_invite_mixed(self):
+        invited = 'johnny-invited@example.com'
+        campaign.add_invite(self.campaign, invited)
+        emails = [invited,
+                  self.email.upper(),
+                  'johnny-new@example.com',
+                  'johnny-new@example.com',
+                  self.email]
+        invites = campaign.add_invites(self.campaign, emails)
+
+        assert_equal([self.email.upper(), 'johnny-new@example.com'], [i.email for i in invites])
+        assert_equal(self.user.id, invites[0].user_id)
+        assert_true(invites[1].user_id is None)
+        invites = InviteeModel.query.filter_by(campaign_id=self.campaign.id).all()
+        assert_equal(3, len(invites))
+
+    @tag('campaign')
+    def test_invite_case_insensitive(self):
+        campaign.add_invite(self.campaign, 'Johnny-Cased@example.com')
+        invites = campaign.add_invites(self.campaign, ['johnny-cased@example.com',
+                                                       'Johnny-New@example.com',
+                                                       'johnny-new@EXAMPLE.com'])
+        assert_equal(['Johnny-New@example.com'], [i.email for i in invites])
+        invites = InviteeModel.query.filter_by(campaign_id=self.campaign.id).all()
+        assert_equal(2, len(invites))
+
 
 class TestCampaignAssociateUser(PooldLibPostgresBaseTest):
 
@@ -314,6 +370,19 @@ class TestCampaignAssociateUser(PooldLibPostgresBaseTest):
     def test_associate_unknown_role(self):
         campaign.associate_user(self.campaign, self.user, 'MinisterOfSillyWalks', 'walker')
 
+    @tag('campaign')
+    def test_associate_accepts_invitation(self):
+        campaign.add_invite(self.campaign, self.email.upper())
+        other = self.create_campaign('Other Campaign', 'Other Campaign')
+        campaign.add_invite(other, self.email)
+        campaign.associate_user(self.campaign, self.user, 'participant', 'participating')
+
+        invite = InviteeModel.query.filter_by(campaign_id=self.campaign.id).one()
+        assert_true(invite.accepted is not None)
+        assert_equal(self.user.id, invite.user_id)
+        invite = InviteeModel.query.filter_by(campaign_id=other.id).one()
+        assert_true(invite.accepted is None)
+
     @tag('campaign')
     @raises(DuplicateCampaignUserAssociationError)
     def test_create_duplicate_association(self):
@@ -398,6 +467,121 @@ class TestGetAssociations(PooldLibPostgresBaseTest):
         assert_equal(ass.campaign_id, self.campaign.id)
 
 
+class TestCollectPledges(PooldLibPostgresBaseTest):
+
+    def setUp(self):
+        super(TestCollectPledges, self).setUp()
+        self.campaign = self.create_campaign('Test Collect Pledges',
+                                             'To Test Collect Pledges')
+        self.create_balance(campaign=self.campaign, currency_code='USD', amount=Decimal(0))
+
+        self.organizer = self.create_user(uuid().hex, 'Pledge Organizer', '%s@example.com' % uuid().hex)
+        self.create_user_meta(self.organizer, stripe_user_id=uuid().hex)
+        self.create_user_meta(self.organizer, stripe_user_token=uuid().hex)
+        self.create_balance(user=self.organizer, currency_code='USD', amount=Decimal(0))
+        self.create_campaign_association(self.campaign, self.organizer, 'organizer')
+
+        self.pledgers = list()
+        for pledge in (Decimal('25.0000'), Decimal('40.0000')):
+            u = self.create_user(uuid().hex, 'Pledge Participant', '%s@example.com' % uuid().hex)
+            self.create_user_meta(u, stripe_customer_id=uuid().hex)
+            self.create_balance(user=u, currency_code='USD', amount=Decimal(0))
+            self.create_campaign_association(self.campaign, u, 'participant', pledge=pledge)
+            self.pledgers.append(u)
+
+        self.no_customer = self.create_user(uuid().hex, 'Pledge Participant', '%s@example.com' % uuid().hex)
+        self.create_campaign_association(self.campaign, self.no_customer, 'participant', pledge=Decimal('10.0000'))
+
+        self.currency = CurrencyModel.query.filter_by(code='USD').first()
+        self.stripe_fee = FeeModel.query.filter_by(name='stripe-transaction').first()
+
+    @tag('campaign')
+    @patch('pooldlib.api.user._execute_charge')
+    def test_collect_pledges(self, mock_execute_charge):
+        mock_execute_charge.side_effect = lambda *args: dict(id=uuid().hex)
+
+        report = campaign.collect_pledges(self.campaign,
+                                          self.currency,
+                                          (self.stripe_fee,),
+                                          concurrency=2)
+        assert_equal(3, len(report))
+        assert_equal(2, mock_execute_charge.call_count)
+
+        results = dict((r['user'].id, r) for r in report)
+        failed = results[self.no_customer.id]
+        assert_true(isinstance(failed['error'], StripeCustomerAccountError))
+        assert_true(failed['deposit_id'] is None)
+
+        for u in self.pledgers:
+            result = results[u.id]
+            assert_true(result['error'] is None)
+            assert_true(result['reference'] is not None)
+            txn = TransactionModel.query.filter_by(id=result['deposit_id']).first()
+            assert_equal(result['amount'], txn.credit)
+            assert_equal(txn.balance.user_id, u.id)
+            ldgr = ExternalLedgerModel.query.filter_by(record_id=result['deposit_id'])\
+                                            .filter_by(fee_id=None)\
+                                            .first()
+            assert_equal(result['reference'], ldgr.reference_number)
+
+    @tag('campaign')
+    @patch('pooldlib.api.user._execute_charge')
+    def test_collect_pledges_skips_collected(self, mock_execute_charge):
+        mock_execute_charge.side_effect = lambda *args: dict(id=uuid().hex)
+
+        campaign.collect_pledges(self.campaign, self.currency, (self.stripe_fee,), chunk_size=1)
+        for u in self.pledgers:
+            ass = CampaignAssociationModel.query.filter_by(campaign_id=self.campaign.id,
+                                                           user_id=u.id).first()
+            assert_true(ass.collected is not None)
+
+        report = campaign.collect_pledges(self.campaign, self.currency, (self.stripe_fee,))
+        assert_equal(1, len(report))
+        assert_equal(self.no_customer.id, report[0]['user'].id)
+        assert_equal(2, mock_execute_charge.call_count)
+
+    @tag('campaign')
+    def test_collect_pledges_rerun_after_failed_write(self):
+        with FakeStripeServer() as server:
+            with patch('pooldlib.api.campaign._write_collected_pledges') as mock_write:
+                mock_write.side_effect = RuntimeError('Lost the database.')
+                assert_raises(RuntimeError, campaign.collect_pledges,
+                              self.campaign, self.currency, (self.stripe_fee,))
+            assert_equal(2, server.created['/v1/charges'])
+
+            report = campaign.collect_pledges(self.campaign, self.currency, (self.stripe_fee,))
+            assert_equal(2, server.created['/v1/charges'])
+
+            results = dict((r['user'].id, r) for r in report)
+            for u in self.pledgers:
+                result = results[u.id]
+                assert_true(result['error'] is None)
+                txn = TransactionModel.query.filter_by(id=result['deposit_id']).first()
+                assert_equal(result['amount'], txn.credit)
+                ass = CampaignAssociationModel.query.filter_by(campaign_id=self.campaign.id,
+                                                               user_id=u.id).first()
+                assert_equal(result['reference'], ass.charge_reference)
+                assert_true(ass.collected is not None)
+
+            campaign.collect_pledges(self.campaign, self.currency, (self.stripe_fee,))
+            assert_equal(2, server.created['/v1/charges'])
+
+    @tag('campaign')
+    @patch('pooldlib.api.user._execute_charge')
+    def test_collect_pledges_skips_pending(self, mock_execute_charge):
+        mock_execute_charge.side_effect = lambda *args: dict(id=uuid().hex)
+        ass = CampaignAssociationModel.query.filter_by(campaign_id=self.campaign.id,
+                                                       user_id=self.pledgers[0].id).first()
+        ass.collecting = pytz.UTC.localize(datetime.utcnow())
+        self.commit_model(ass)
+
+        report = campaign.collect_pledges(self.campaign, self.currency, (self.stripe_fee,))
+        results = dict((r['user'].id, r) for r in report)
+        assert_true(isinstance(results[self.pledgers[0].id]['error'], PledgeCollectionPendingError))
+        assert_true(results[self.pledgers[1].id]['error'] is None)
+        assert_equal(1, mock_execute_charge.call_count)
+
+
 class TestCampaignUpdateUserRole(PooldLibPostgresBaseTest):
 
     def setUp(self):
@@ -613,6 +797,102 @@ class TestCampaignDisassociateUser(PooldLibPostgresBaseTest):
         assert_true(ass is None)
 
 
+class TestCampaignStats(PooldLibPostgresBaseTest):
+
+    def setUp(self):
+        super(TestCampaignStats, self).setUp()
+        self.username = uuid().hex
+        self.organizer = self.create_user(self.username, 'Stats Organizer', '%s@example.com' % self.username)
+        self.campaign = campaign.create(self.organizer, uuid().hex, 'To Test Campaign Stats')
+
+        self.username = uuid().hex
+        self.email = '%s@example.com' % self.username
+        self.user = self.create_user(self.username, 'Stats Participant', self.email)
+
+    @tag('campaign')
+    def test_stats(self):
+        campaign.add_invites(self.campaign, [self.email.upper(), 'johnny-left-out@example.com'])
+        campaign.associate_user(self.campaign, self.user, 'participant', 'participating',
+                                pledge=Decimal('25.0000'))
+        stats = campaign.stats(self.campaign)
+        assert_equal(2, stats['participants'])
+        assert_equal(Decimal('25.0000'), stats['pledged'])
+        assert_equal(2, stats['invited'])
+        assert_equal(1, stats['accepted'])
+        assert_equal(0.5, stats['acceptance_rate'])
+        assert_equal(dict(), stats['raised'])
+
+    @tag('campaign')
+    def test_stats_update_and_disassociate(self):
+        campaign.associate_user(self.campaign, self.user, 'participant', 'participating')
+        campaign.update_user_association(self.campaign, self.user, pledge=Decimal('10.0000'))
+        assert_equal(Decimal('10.0000'), campaign.stats(self.campaign)['pledged'])
+
+        campaign.disassociate_user(self.campaign, self.user)
+        stats = campaign.stats(self.campaign)
+        assert_equal(1, stats['participants'])
+        assert_equal(Decimal('0.0000'), stats['pledged'])
+        assert_true(stats['acceptance_rate'] is None)
+
+    @tag('campaign')
+    def test_stats_goal_participants(self):
+        goal = campaign.add_goal(self.campaign, 'Stats Goal', 'To Test Campaign Stats', 'project')
+        assert_equal({goal.id: 1}, campaign.stats(self.campaign)['goal_participants'])
+        campaign.associate_user(self.campaign, self.user, 'participant', 'participating')
+        assert_equal({goal.id: 2}, campaign.stats(self.campaign)['goal_participants'])
+
+    @tag('campaign')
+    def test_stats_failed_pledge_update_rolled_back(self):
+        goal = campaign.add_goal(self.campaign, 'Stats Goal', 'To Test Campaign Stats', 'project')
+        campaign.associate_user(self.campaign, self.user, 'participant', 'participating')
+        campaign.update_user_goal_association(goal, self.user, pledge=Decimal('5.0000'))
+        try:
+            campaign.update_user_association(self.campaign, self.user, pledge=Decimal('10.0000'))
+        except PreviousUserContributionError:
+            pass
+        else:
+            raise AssertionError('PreviousUserContributionError not raised.')
+        db.session.commit()
+
+        ass = CampaignAssociationModel.query.filter_by(campaign_id=self.campaign.id,
+                                                       user_id=self.user.id).first()
+        assert_true(ass.pledge is None)
+        assert_equal(Decimal('0.0000'), campaign.stats(self.campaign)['pledged'])
+
+    @tag('campaign')
+    def test_stats_counted_without_counters(self):
+        com = self.create_campaign(uuid().hex, 'To Test Campaign Stats')
+        self.create_campaign_association(com, self.organizer, 'organizer', pledge=Decimal('5.0000'))
+        assert_true(CampaignStatsModel.query.get(com.id) is None)
+        assert_equal(1, campaign.stats(com)['participants'])
+
+        campaign.associate_user(com, self.user, 'participant', 'participating')
+        counters = CampaignStatsModel.query.get(com.id)
+        assert_equal(2, counters.participants)
+        assert_equal(Decimal('5.0000'), counters.pledged)
+
+    @tag('campaign')
+    def test_stats_counters_created_concurrently(self):
+        com = self.create_campaign(uuid().hex, 'To Test Campaign Stats')
+        self.create_campaign_association(com, self.organizer, 'organizer', pledge=Decimal('5.0000'))
+        tally = CampaignStatsModel.tally
+
+        def concurrent_tally(campaign_id):
+            # Another transaction creates the counters between our UPDATE and INSERT.
+            now = datetime.utcnow()
+            row = dict(campaign_id=campaign_id, participants=1, pledged=Decimal('5.0000'),
+                       invited=0, accepted=0, created=now, modified=now)
+            db.engine.execute(CampaignStatsModel.__table__.insert().values(row))
+            return tally(campaign_id)
+
+        with patch.object(CampaignStatsModel, 'tally', side_effect=concurrent_tally):
+            campaign.associate_user(com, self.user, 'participant', 'participating')
+        db.session.expire_all()
+        counters = CampaignStatsModel.query.get(com.id)
+        assert_equal(2, counters.participants)
+        assert_equal(Decimal('5.0000'), counters.pledged)
+
+
 class TestUpdateCampaign(PooldLibPostgresBaseTest):
 
     def setUp(self):
@@ -803,6 +1083,22 @@ class TestGetCampaignGoals(PooldLibPostgresBaseTest):
         goal = goal[0]
         assert_equal(self.goal_two.id, goal.id)
 
+    @tag('campaign')
+    def test_goals_page(self):
+        pages = list()
+        cursor = None
+        while True:
+            (page, cursor) = campaign.goals_page(self.campaign, filter_inactive=False, limit=1, cursor=cursor)
+            pages.append([g.id for g in page])
+            if cursor is None:
+                break
+        assert_equal([[i] for i in self.goal_ids], pages)
+
+    @tag('campaign')
+    def test_iter_goals(self):
+        goals = campaign.iter_goals(self.campaign, filter_inactive=False, chunk_size=2)
+        assert_equal(list(self.goal_ids), [g.id for g in goals])
+
     @tag('campaign')
     def test_simple_get_specific_goals(self):
         goal_ids = (self.goal_one.id, self.goal_two.id)
@@ -915,6 +1211,22 @@ class TestAddCampaignGoal(PooldLibPostgresBaseTest):
                     assert_true(goal.descendant is None)
             check_last_goal = goal
 
+    @tag('campaign')
+    def test_add_associates_organizer(self):
+        username = uuid().hex
+        user = self.create_user(username, 'Goal Organizer', '%s@example.com' % username)
+        com = campaign.create(user, uuid().hex, 'To Test Add Associates Organizer')
+        goal = campaign.add_goal(com,
+                                 'Test Add Associates Organizer',
+                                 'To Test Add Associates Organizer',
+                                 'project',
+                                 mdata_key_one='mdata value one')
+        ass = CampaignGoalAssociationModel.query.filter_by(campaign_goal_id=goal.id).all()
+        assert_equal(1, len(ass))
+        assert_equal(user.id, ass[0].user_id)
+        assert_equal('participating', ass[0].participation)
+        assert_equal(goal.mdata_key_one, u'mdata value one')
+
 
 class TestCampaignGoalUserAssociation(PooldLibPostgresBaseTest):
 
@@ -1062,6 +1374,31 @@ class TestCampaignGoalUserAssociation(PooldLibPostgresBaseTest):
         campaign.associate_user_with_goal(self.goal_one, self.user, 'opted-in')
         campaign.associate_user_with_goal(self.goal_one, self.user, 'opted-in')
 
+    @tag('campaign')
+    def test_associate_user_invalid_participation(self):
+        try:
+            campaign.associate_user(self.campaign, self.user, 'participant', 'walker')
+        except InvalidGoalParticipationNameError:
+            pass
+        else:
+            raise AssertionError('InvalidGoalParticipationNameError not raised.')
+
+        # Nothing is written if any of the associations fail.
+        ass = CampaignAssociationModel.query.filter_by(user_id=self.user.id)\
+                                            .filter_by(campaign_id=self.campaign.id)\
+                                            .all()
+        assert_equal(0, len(ass))
+        cgas = CampaignGoalAssociationModel.query.filter_by(user_id=self.user.id)\
+                                                 .filter_by(campaign_id=self.campaign.id)\
+                                                 .all()
+        assert_equal(0, len(cgas))
+
+    @tag('campaign')
+    @raises(DuplicateCampaignGoalUserAssociationError)
+    def test_associate_user_twice(self):
+        campaign.associate_user(self.campaign, self.user, 'participant', 'participating')
+        campaign.associate_user(self.campaign, self.user, 'participant', 'participating')
+
 
 class TestUpdateCampaignGoal(PooldLibPostgresBaseTest):
 
@@ -1,6 +1,11 @@
+from decimal import Decimal
+
 from nose.tools import raises, assert_equal, assert_true, assert_false
+from nose import SkipTest
+from mock import patch
 
 from pooldlib.api import fee
+from pooldlib.signals import signals_available
 
 from tests import tag
 from tests.base import PooldLibPostgresBaseTest
@@ -19,3 +24,47 @@ class TestFeeGet(PooldLibPostgresBaseTest):
     def test_get_names(self):
         ret = fee.get(None, ('stripe-transaction', 'poold-transaction'))
         assert_equal(2, len(ret))
+
+
+class TestFeeSchedule(PooldLibPostgresBaseTest):
+
+    @tag('fee')
+    def test_schedule_matches_calculate(self):
+        names = ('stripe-transaction', 'poold-transaction')
+        schedule = fee.schedule(names)
+        amount = Decimal('100.0000')
+        assert_equal(fee.calculate(fee.get(None, names), amount), schedule.price(amount))
+
+    @tag('fee')
+    def test_schedule_discarded_on_fee_commit(self):
+        if not signals_available:
+            raise SkipTest('blinker is not installed.')
+        schedule = fee.schedule(('gimmy-more', ))
+        assert_true(schedule is fee.schedule(('gimmy-more', )))
+
+        gimmy_more = fee.get('gimmy-more')[0]
+        gimmy_more.description = 'Fee used for testing schedules.'
+        self.commit_model(gimmy_more)
+        assert_false(schedule is fee.schedule(('gimmy-more', )))
+
+    @tag('fee')
+    def test_schedule_not_cached_across_fee_commit(self):
+        if not signals_available:
+            raise SkipTest('blinker is not installed.')
+        names = ('poold-transaction', )
+        get = fee.get
+
+        def get_and_commit(*args, **kwargs):
+            fees = get(*args, **kwargs)
+            fee._discard_schedules(None, changes=[(fees[0], 'update')])
+            return fees
+
+        with patch('pooldlib.api.fee.get', get_and_commit):
+            schedule = fee.schedule(names)
+        assert_false(schedule is fee.schedule(names))
+
+    @tag('fee')
+    def test_calculate_by_name(self):
+        names = ['stripe-transaction', 'poold-transaction']
+        amount = Decimal('100.0000')
+        assert_equal(fee.calculate(fee.get(None, names), amount), fee.calculate(names, amount))
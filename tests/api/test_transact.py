@@ -3,15 +3,20 @@ from decimal import Decimal
 
 from nose.tools import raises, assert_equal, assert_true
 from nose import SkipTest
+from sqlalchemy.exc import DBAPIError
 
-from pooldlib.postgresql import (Transfer as TransferModel,
+from pooldlib.postgresql import (db,
+                                 Transfer as TransferModel,
                                  Transaction as TransactionModel,
                                  InternalLedger as InternalLedgerModel,
                                  ExternalLedger as ExternalLedgerModel,
                                  CampaignGoalLedger as CampaignGoalLedgerModel,
+                                 CampaignGoalStats as CampaignGoalStatsModel,
                                  Currency as CurrencyModel,
                                  Fee as FeeModel)
-from pooldlib import Transact
+from pooldlib import Transact, TransactBatcher
+from pooldlib.signals import signals_available, transact_executed
+from pooldlib.api import campaign
 from pooldlib.exceptions import (InsufficentFundsTransferError,
                                  InsufficentFundsTransactionError)
 
@@ -22,6 +27,22 @@ from tests.base import PooldLibPostgresBaseTest
 # TODO :: Transaction related tests need to be fixed!
 
 
+class DeadlockError(Exception):
+    pgcode = '40P01'
+
+
+class DeadlockOnceTransact(Transact):
+    """Transact which is aborted by a deadlock the first time it executes.
+    """
+    deadlocked = False
+
+    def _execute(self, session):
+        if not self.deadlocked:
+            self.deadlocked = True
+            raise DBAPIError('UPDATE balance', {}, DeadlockError())
+        super(DeadlockOnceTransact, self)._execute(session)
+
+
 class TestExternalLedgerEntryWithFullName(PooldLibPostgresBaseTest):
 
     def setUp(self):
@@ -152,6 +173,65 @@ class TestUserCampaignGoalTransfer(PooldLibPostgresBaseTest):
         assert_equal(self.user_a.id, comm_ledger.party_id)
         assert_equal('user', comm_ledger.party_type)
 
+    @tag('transact')
+    def test_all_ledger_tables_written(self):
+        t = Transact()
+        t.transfer_to_campaign_goal(Decimal('10.0000'),
+                                    self.currency,
+                                    self.campaign_goal,
+                                    self.user_a)
+        t.transfer_to_campaign_goal(Decimal('5.0000'),
+                                    self.currency,
+                                    self.campaign_goal,
+                                    self.user_a)
+        t.external_ledger(self.user_a,
+                          'test-party',
+                          'test-reference-number-test_all_ledger_tables_written',
+                          self.currency,
+                          debit=Decimal('1.0000'),
+                          fee=self.fee)
+        assert_true(t.verify())
+        t.execute()
+
+        xfers = TransferModel.query.filter_by(record_id=t.id).all()
+        assert_equal(2, len(xfers))
+
+        comm_ledger = CampaignGoalLedgerModel.query.filter_by(campaign_goal=self.campaign_goal).all()
+        assert_equal(2, len(comm_ledger))
+        assert_equal(Decimal('15.0000'), sum(l.credit for l in comm_ledger))
+
+        ldgr = ExternalLedgerModel.query.filter_by(record_id=t.id).all()
+        assert_equal(1, len(ldgr))
+        assert_equal(self.fee.id, ldgr[0].fee_id)
+
+        check_balance = self.user_a.balance_for_currency(self.currency)
+        assert_equal(Decimal('35.0000'), check_balance.amount)
+
+    @tag('transact')
+    def test_goal_stats_updated(self):
+        t = Transact()
+        t.transfer_to_campaign_goal(Decimal('10.0000'),
+                                    self.currency,
+                                    self.campaign_goal,
+                                    self.user_a)
+        t.transfer_to_campaign_goal(Decimal('5.0000'),
+                                    self.currency,
+                                    self.campaign_goal,
+                                    self.user_a)
+        t.execute()
+        t = Transact()
+        t.transfer_from_campaign_goal(Decimal('3.0000'),
+                                      self.currency,
+                                      self.campaign_goal,
+                                      self.user_a)
+        t.execute()
+
+        stats = CampaignGoalStatsModel.query.get(self.campaign_goal.id)
+        assert_equal(Decimal('12.0000'), stats.raised)
+        assert_equal(self.campaign.id, stats.campaign_id)
+        raised = campaign.stats(self.campaign)['raised']
+        assert_equal({self.campaign_goal.id: Decimal('12.0000')}, raised)
+
 
 class TestUserCampaignTransfer(PooldLibPostgresBaseTest):
 
@@ -190,6 +270,133 @@ class TestUserCampaignTransfer(PooldLibPostgresBaseTest):
         assert_equal(1, len(credit_xfer))
         assert_equal(Decimal('25.0000'), credit_xfer[0].credit)
 
+    @tag('transact')
+    def test_balances_unchanged_until_execute(self):
+        t = Transact()
+        t.transfer(Decimal('25.0000'), self.currency, destination=self.campaign_a, origin=self.user_a)
+        t.transfer(Decimal('10.0000'), self.currency, destination=self.user_a, origin=self.campaign_a)
+        assert_true(t.verify())
+        assert_equal(Decimal('50.0000'), self.user_a_balance.amount)
+        assert_equal(Decimal('50.0000'), self.campaign_a_balance.amount)
+
+        t.execute()
+
+        assert_equal(Decimal('35.0000'), self.user_a.balance_for_currency(self.currency).amount)
+        assert_equal(Decimal('65.0000'), self.campaign_a.balance_for_currency(self.currency).amount)
+
+    @tag('transact')
+    def test_atomic_transfer(self):
+        t = Transact(mode='atomic')
+        t.transfer(Decimal('25.0000'), self.currency, destination=self.campaign_a, origin=self.user_a)
+        assert_true(t.verify())
+        t.execute()
+
+        xfers = TransferModel.query.filter_by(record_id=t.id).all()
+        assert_equal(2, len(xfers))
+        assert_equal(Decimal('25.0000'), self.user_a.balance_for_currency(self.currency).amount)
+        assert_equal(Decimal('75.0000'), self.campaign_a.balance_for_currency(self.currency).amount)
+
+    @tag('transact')
+    def test_optimistic_transfer(self):
+        version = self.user_a.balance_for_currency(self.currency).version
+        t = Transact(mode='optimistic')
+        t.transfer(Decimal('25.0000'), self.currency, destination=self.campaign_a, origin=self.user_a)
+        assert_true(t.verify())
+        t.execute()
+
+        balance = self.user_a.balance_for_currency(self.currency)
+        assert_equal(Decimal('25.0000'), balance.amount)
+        assert_equal(version + 1, balance.version)
+        assert_equal(Decimal('75.0000'), self.campaign_a.balance_for_currency(self.currency).amount)
+
+    @tag('transact')
+    @raises(InsufficentFundsTransferError)
+    def test_atomic_insufficient_funds_transfer(self):
+        t = Transact(mode='atomic')
+        t.transfer(Decimal('25.0000'), self.currency, destination=self.campaign_a, origin=self.user_a)
+        # Drain the balance after staging, the guarded update must refuse the debit.
+        self.user_a_balance.amount = Decimal('10.0000')
+        self.commit_model(self.user_a_balance)
+        record_id = t.id
+        try:
+            t.execute()
+        finally:
+            assert_equal(Decimal('10.0000'), self.user_a.balance_for_currency(self.currency).amount)
+            assert_equal(0, TransferModel.query.filter_by(record_id=record_id).count())
+
+    @tag('transact')
+    @raises(TypeError)
+    def test_unknown_mode(self):
+        Transact(mode='bogus')
+
+    @tag('transact')
+    def test_netted_transfer(self):
+        version = self.campaign_a.balance_for_currency(self.currency).version
+        t = Transact(net=True)
+        t.transfer(Decimal('25.0000'), self.currency, destination=self.campaign_a, origin=self.user_a)
+        t.transfer(Decimal('25.0000'), self.currency, destination=self.user_b, origin=self.campaign_a)
+        assert_true(t.verify())
+        t.execute()
+
+        xfers = TransferModel.query.filter_by(record_id=t.id).all()
+        assert_equal(4, len(xfers))
+        campaign_balance = self.campaign_a.balance_for_currency(self.currency)
+        assert_equal(Decimal('50.0000'), campaign_balance.amount)
+        assert_equal(version, campaign_balance.version)
+        assert_equal(Decimal('25.0000'), self.user_a.balance_for_currency(self.currency).amount)
+        assert_equal(Decimal('75.0000'), self.user_b.balance_for_currency(self.currency).amount)
+
+    @tag('transact')
+    def test_execute_timings(self):
+        if not signals_available:
+            raise SkipTest('blinker is not installed.')
+        received = list()
+
+        def record(transact, timings=None):
+            received.append((transact, timings))
+
+        t = Transact()
+        t.transfer(Decimal('25.0000'), self.currency, destination=self.campaign_a, origin=self.user_a)
+        with transact_executed.connected_to(record):
+            t.execute()
+
+        assert_equal(1, len(received))
+        (sender, timings) = received[0]
+        assert_true(sender is t)
+        assert_equal(1, timings['attempts'])
+        assert_equal(2, timings['rows']['transfer'])
+        assert_equal(0, timings['rows']['transaction'])
+        assert_true(timings['total'] >= timings['lock'] + timings['commit'])
+        assert_true(timings['staging'] > 0)
+
+    @tag('transact')
+    def test_idempotent_execute(self):
+        key = uuid().hex
+        t = Transact()
+        t.transfer(Decimal('25.0000'), self.currency, destination=self.campaign_a, origin=self.user_a)
+        record_id = t.execute(idempotency_key=key)
+
+        retry = Transact()
+        retry.transfer(Decimal('25.0000'), self.currency, destination=self.campaign_a, origin=self.user_a)
+        assert_equal(record_id, retry.execute(idempotency_key=key))
+        assert_equal(record_id, retry.id)
+
+        xfers = TransferModel.query.filter_by(record_id=record_id).all()
+        assert_equal(2, len(xfers))
+        assert_equal(Decimal('25.0000'), self.user_a.balance_for_currency(self.currency).amount)
+
+    @tag('transact')
+    def test_deadlock_retried(self):
+        retries = Transact.retry_stats()['retries']
+        t = DeadlockOnceTransact(backoff=0)
+        t.transfer(Decimal('25.0000'), self.currency, destination=self.campaign_a, origin=self.user_a)
+        t.execute()
+
+        assert_equal(retries + 1, Transact.retry_stats()['retries'])
+        xfers = TransferModel.query.filter_by(record_id=t.id).all()
+        assert_equal(2, len(xfers))
+        assert_equal(Decimal('25.0000'), self.user_a.balance_for_currency(self.currency).amount)
+
     @tag('transact')
     @raises(InsufficentFundsTransferError)
     def test_insufficient_funds_transfer(self):
@@ -246,6 +453,176 @@ class TestUserCampaignTransfer(PooldLibPostgresBaseTest):
         assert_equal(None, debit_iledger[0].credit)
 
 
+class TestStripedCampaignTransfer(PooldLibPostgresBaseTest):
+
+    def setUp(self):
+        super(TestStripedCampaignTransfer, self).setUp()
+        self.currency = CurrencyModel.query.filter_by(code='USD').first()
+
+        n = uuid().hex
+        self.user_a = self.create_user(n, '%s %s' % (n[:16], n[16:]))
+        self.user_a_balance = self.create_balance(user=self.user_a, currency_code='USD')
+
+        self.campaign_a = self.create_campaign(uuid().hex, uuid().hex)
+        self.campaign_a_balance = self.create_balance(campaign=self.campaign_a, currency_code='USD')
+        campaign.stripe_balance(self.campaign_a, self.currency, 4)
+
+    @tag('transact')
+    def test_striped_balance_read(self):
+        check_balance = self.campaign_a.balance_for_currency(self.currency)
+        assert_equal(4, len(check_balance.stripes))
+        assert_equal(Decimal('50.0000'), check_balance.amount)
+        assert_true(check_balance == self.campaign_a_balance)
+        assert_equal(Decimal('50.0000'), campaign.balance(self.campaign_a, self.currency).amount)
+
+    @tag('transact')
+    def test_striped_credit_and_debit(self):
+        for i in range(3):
+            t = Transact()
+            t.transfer(Decimal('10.0000'), self.currency, destination=self.campaign_a, origin=self.user_a)
+            t.execute()
+        assert_equal(Decimal('80.0000'), self.campaign_a.balance_for_currency(self.currency).amount)
+
+        # More than any single stripe holds, drawn down across stripes.
+        t = Transact()
+        t.transfer(Decimal('70.0000'), self.currency, destination=self.user_a, origin=self.campaign_a)
+        assert_true(t.verify())
+        t.execute()
+
+        check_balance = self.campaign_a.balance_for_currency(self.currency)
+        assert_equal(Decimal('10.0000'), check_balance.amount)
+        assert_true(all(s.amount >= Decimal('0.0000') for s in check_balance.stripes))
+        assert_equal(Decimal('90.0000'), self.user_a.balance_for_currency(self.currency).amount)
+
+        xfers = TransferModel.query.filter_by(record_id=t.id).all()
+        assert_equal(2, len(xfers))
+
+    @tag('transact')
+    def test_striped_credit_transfer_references_credited_stripe(self):
+        before = dict((s.id, s.amount) for s in self.campaign_a.balance_for_currency(self.currency).stripes)
+        t = Transact()
+        t.transfer(Decimal('10.0000'), self.currency, destination=self.campaign_a, origin=self.user_a)
+        t.execute()
+
+        db.session.expire_all()
+        after = dict((s.id, s.amount) for s in self.campaign_a.balance_for_currency(self.currency).stripes)
+        credited = [i for i in after if after[i] != before[i]]
+        assert_equal(1, len(credited))
+        xfer = TransferModel.query.filter_by(record_id=t.id, balance_id=credited[0]).first()
+        assert_equal(Decimal('10.0000'), xfer.credit)
+
+    @tag('transact')
+    def test_striped_balance_for_update_single_row(self):
+        b = campaign.balance(self.campaign_a, self.currency, for_update=True)
+        assert_equal(self.campaign_a_balance.id, b.id)
+
+    @tag('transact')
+    @raises(InsufficentFundsTransferError)
+    def test_striped_insufficient_funds(self):
+        t = Transact(mode='atomic')
+        t.transfer(Decimal('55.0000'), self.currency, destination=self.user_a, origin=self.campaign_a)
+        t.execute()
+
+
+class TestTransactBatcher(PooldLibPostgresBaseTest):
+
+    def setUp(self):
+        super(TestTransactBatcher, self).setUp()
+        self.currency = CurrencyModel.query.filter_by(code='USD').first()
+
+        n = uuid().hex
+        self.user_a = self.create_user(n, '%s %s' % (n[:16], n[16:]))
+        self.user_a_balance = self.create_balance(user=self.user_a, currency_code='USD')
+
+        n = uuid().hex
+        self.user_b = self.create_user(n, '%s %s' % (n[:16], n[16:]))
+        self.user_b_balance = self.create_balance(user=self.user_b, currency_code='USD')
+
+        self.campaign_a = self.create_campaign(uuid().hex, uuid().hex)
+        self.campaign_a_balance = self.create_balance(campaign=self.campaign_a, currency_code='USD')
+
+        self.batcher = TransactBatcher(window=0.05, max_items=10)
+        self.addCleanup(self.batcher.stop)
+
+    @tag('transact')
+    def test_batched_execute(self):
+        ta = Transact()
+        ta.transfer(Decimal('10.0000'), self.currency, destination=self.campaign_a, origin=self.user_a)
+        tb = Transact()
+        tb.transfer(Decimal('20.0000'), self.currency, destination=self.campaign_a, origin=self.user_b)
+
+        pending = [self.batcher.submit(ta), self.batcher.submit(tb)]
+        for p in pending:
+            p.wait(timeout=5)
+
+        db.session.expire_all()
+        assert_equal(Decimal('40.0000'), self.user_a.balance_for_currency(self.currency).amount)
+        assert_equal(Decimal('30.0000'), self.user_b.balance_for_currency(self.currency).amount)
+        assert_equal(Decimal('80.0000'), self.campaign_a.balance_for_currency(self.currency).amount)
+        assert_equal(2, TransferModel.query.filter_by(record_id=ta.id).count())
+        assert_equal(2, TransferModel.query.filter_by(record_id=tb.id).count())
+
+    @tag('transact')
+    def test_batched_failure_isolated(self):
+        ta = Transact()
+        ta.transfer(Decimal('40.0000'), self.currency, destination=self.campaign_a, origin=self.user_a)
+        tb = Transact()
+        tb.transfer(Decimal('20.0000'), self.currency, destination=self.campaign_a, origin=self.user_b)
+        # Drain user_a after staging so only ``ta`` fails once executed.
+        self.user_a_balance.amount = Decimal('10.0000')
+        self.commit_model(self.user_a_balance)
+
+        pending_a = self.batcher.submit(ta)
+        pending_b = self.batcher.submit(tb)
+        pending_b.wait(timeout=5)
+        try:
+            pending_a.wait(timeout=5)
+            raise AssertionError('Expected InsufficentFundsTransferError')
+        except InsufficentFundsTransferError:
+            pass
+
+        db.session.expire_all()
+        assert_equal(Decimal('10.0000'), self.user_a.balance_for_currency(self.currency).amount)
+        assert_equal(Decimal('70.0000'), self.campaign_a.balance_for_currency(self.currency).amount)
+
+    @tag('transact')
+    def test_batched_idempotency_key(self):
+        key = uuid().hex
+        ta = Transact()
+        ta.transfer(Decimal('10.0000'), self.currency, destination=self.campaign_a, origin=self.user_a)
+        tb = Transact()
+        tb.transfer(Decimal('10.0000'), self.currency, destination=self.campaign_a, origin=self.user_a)
+
+        pending = [self.batcher.submit(ta, idempotency_key=key),
+                   self.batcher.submit(tb, idempotency_key=key)]
+        record_ids = [p.wait(timeout=5) for p in pending]
+        assert_equal(record_ids[0], record_ids[1])
+
+        db.session.expire_all()
+        assert_equal(Decimal('40.0000'), self.user_a.balance_for_currency(self.currency).amount)
+        assert_equal(2, TransferModel.query.filter_by(record_id=record_ids[0]).count())
+
+    @tag('transact')
+    def test_batched_atomic_insufficient_funds(self):
+        ta = Transact(mode='atomic')
+        ta.transfer(Decimal('40.0000'), self.currency, destination=self.campaign_a, origin=self.user_a)
+        tb = Transact(mode='atomic')
+        tb.transfer(Decimal('20.0000'), self.currency, destination=self.campaign_a, origin=self.user_a)
+
+        pending_a = self.batcher.submit(ta)
+        pending_b = self.batcher.submit(tb)
+        pending_a.wait(timeout=5)
+        try:
+            pending_b.wait(timeout=5)
+            raise AssertionError('Expected InsufficentFundsTransferError')
+        except InsufficentFundsTransferError:
+            pass
+
+        db.session.expire_all()
+        assert_equal(Decimal('10.0000'), self.user_a.balance_for_currency(self.currency).amount)
+        assert_equal(Decimal('90.0000'), self.campaign_a.balance_for_currency(self.currency).amount)
+
+
 class TestUserTransaction(PooldLibPostgresBaseTest):
 
     def setUp(self):
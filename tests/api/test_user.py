@@ -941,6 +941,112 @@ class TestPaymentToCampaign(PooldLibPostgresBaseTest):
         assert_true(poold_ldgr.full_name is None)
 
 
+class TestPipelinedPaymentToCampaign(PooldLibPostgresBaseTest):
+
+    def setUp(self):
+        super(TestPipelinedPaymentToCampaign, self).setUp()
+        n = uuid().hex
+        self.user = self.create_user('StripeUser-%s' % n[:16], 'StripeUser %s' % n[16:],
+                                     email='StripeUser-%s@example.com' % n[16:])
+        self.user_balance = self.create_balance(user=self.user, currency_code='USD', amount=Decimal(0))
+        self.create_user_meta(self.user, stripe_customer_id='cus_%s' % uuid().hex)
+
+        n = uuid().hex
+        self.organizer = self.create_user('StripeUser-%s' % n[:16], 'StripeUser %s' % n[16:],
+                                          email='StripeUser-%s@example.com' % n[16:])
+        self.organizer_balance = self.create_balance(user=self.organizer, currency_code='USD', amount=Decimal(0))
+        self.create_user_meta(self.organizer, stripe_user_id=uuid().hex)
+        self.create_user_meta(self.organizer, stripe_user_token=uuid().hex)
+
+        self.campaign = self.create_campaign('Test Pipelined Payment Campaign',
+                                             'To Test Pipelined Payment Campaign')
+        self.create_balance(campaign=self.campaign, currency_code='USD', amount=Decimal(0))
+
+        self.stripe_fee = FeeModel.query.filter_by(name='stripe-transaction').first()
+        self.currency = CurrencyModel.query.filter_by(code='USD').first()
+
+        self.organizer_patcher = patch('pooldlib.api.user.get_campaign_organizer')
+        self.organizer_patcher.start().return_value = self.organizer
+        self.addCleanup(self.organizer_patcher.stop)
+        self.charge_patcher = patch('pooldlib.api.user._execute_charge')
+        self.patched_charge = self.charge_patcher.start()
+        self.addCleanup(self.charge_patcher.stop)
+
+    @tag('payment')
+    def test_pipelined_payment(self):
+        self.patched_charge.return_value = dict(id='ch_%s' % uuid().hex)
+
+        deposit_id, withdrawal_id = user.payment_to_campaign(self.user,
+                                                             self.campaign,
+                                                             Decimal('100'),
+                                                             self.currency,
+                                                             fees=(self.stripe_fee,),
+                                                             pipelined=True)
+        user_txn = TransactionModel.query.filter_by(id=deposit_id)\
+                                         .filter_by(balance_id=self.user_balance.id)\
+                                         .first()
+        assert_equal(Decimal('100.0000'), user_txn.credit)
+
+        ldgrs = ExternalLedgerModel.query.filter(ExternalLedgerModel.record_id.in_((deposit_id, withdrawal_id)))\
+                                         .all()
+        assert_equal(3, len(ldgrs))
+        for ldgr in ldgrs:
+            assert_equal(self.patched_charge.return_value['id'], ldgr.reference_number)
+
+    @tag('payment')
+    @raises(UserCreditCardDeclinedError)
+    def test_pipelined_payment_declined(self):
+        self.patched_charge.side_effect = UserCreditCardDeclinedError('Declined.')
+        try:
+            user.payment_to_campaign(self.user,
+                                     self.campaign,
+                                     Decimal('100'),
+                                     self.currency,
+                                     fees=(self.stripe_fee,),
+                                     pipelined=True)
+        finally:
+            txns = TransactionModel.query.filter_by(balance_id=self.user_balance.id).all()
+            assert_equal(0, len(txns))
+
+    @tag('payment')
+    @raises(UserCreditCardDeclinedError)
+    def test_pipelined_payment_declined_creates_no_balance(self):
+        n = uuid().hex
+        payer = self.create_user('StripeUser-%s' % n[:16], 'StripeUser %s' % n[16:],
+                                 email='StripeUser-%s@example.com' % n[16:])
+        self.create_user_meta(payer, stripe_customer_id='cus_%s' % uuid().hex)
+        self.patched_charge.side_effect = UserCreditCardDeclinedError('Declined.')
+        try:
+            user.payment_to_campaign(payer,
+                                     self.campaign,
+                                     Decimal('100'),
+                                     self.currency,
+                                     fees=(self.stripe_fee,),
+                                     pipelined=True)
+        finally:
+            db.session.commit()
+            balances = BalanceModel.query.filter_by(user_id=payer.id).all()
+            assert_equal(0, len(balances))
+
+    @tag('payment')
+    @raises(ValueError)
+    def test_pipelined_payment_staging_failure_logged(self):
+        self.patched_charge.return_value = dict(id='ch_%s' % uuid().hex)
+        with patch('pooldlib.api.user._stage_campaign_payment') as stage:
+            stage.side_effect = ValueError('Staging failed.')
+            with patch('pooldlib.api.user.logger') as logger:
+                try:
+                    user.payment_to_campaign(self.user,
+                                             self.campaign,
+                                             Decimal('100'),
+                                             self.currency,
+                                             fees=(self.stripe_fee,),
+                                             pipelined=True)
+                finally:
+                    data = logger.transaction.call_args[1]['data']
+                    assert_equal(self.patched_charge.return_value['id'], data['stripe_ref_number'])
+
+
 class TestPaymentToCampaignGoal(PooldLibPostgresBaseTest):
     # These are functional tests which depend on the stripe api.
     # To run all stripe api related tests run: $ make tests-stripe
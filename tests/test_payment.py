@@ -4,15 +4,17 @@ from datetime import datetime, timedelta
 from uuid import uuid4 as uuid
 
 import stripe
-from nose.tools import raises, assert_equal, assert_true
+from nose.tools import raises, assert_equal, assert_true, assert_raises
 from mock import patch, Mock
 
-from pooldlib import config, DIR, payment
+from pooldlib import config, DIR, payment, money
+from pooldlib.exceptions import ExternalAPIUnavailableError
+from pooldlib.fakestripe import FakeStripeServer
 from pooldlib.postgresql.models import (Currency as CurrencyModel,
                                         Fee as FeeModel)
 
 from tests import tag
-from tests.base import PooldLibPostgresBaseTest
+from tests.base import PooldLibBaseTest, PooldLibPostgresBaseTest
 
 
 class TestTotalAfterFees(PooldLibPostgresBaseTest):
@@ -76,6 +78,214 @@ class TestTotalAfterFees(PooldLibPostgresBaseTest):
         for fee in ret['fees']:
             assert_equal(fees[fee['name']], fee['fee'])
 
+    @tag('payment')
+    def test_batch_matches_single(self):
+        charges = [Decimal('100.0000'), Decimal('25.0000'), Decimal('0.5000')]
+        fees = (self.stripe_fee, self.poold_fee)
+
+        ret = payment.total_after_fees_batch(charges, fees=fees)
+        assert_equal(charges, ret['charge']['initial'])
+        for (i, charge) in enumerate(charges):
+            single = payment.total_after_fees(charge, fees=fees)
+            assert_equal(single['charge']['final'], ret['charge']['final'][i])
+            for (fee, column) in zip(single['fees'], ret['fees']):
+                assert_equal(fee['name'], column['name'])
+                assert_equal(fee['fee'], column['fee'][i])
+
+
+class TestMoney(PooldLibBaseTest):
+
+    @tag('payment')
+    def test_units_round_trip(self):
+        assert_equal(250000, money.to_units(Decimal('25.00')))
+        assert_equal(Decimal('25.0000'), money.from_units(250000))
+        assert_equal('25.0000', str(money.from_units(250000)))
+        assert_equal(-5, money.to_units(Decimal('-0.00045')))
+
+    @tag('payment')
+    def test_round_div_matches_quantize(self):
+        for numerator in range(-2000, 2000, 7):
+            expected = (Decimal(numerator) / Decimal(400)).quantize(Decimal(1))
+            assert_equal(int(expected), money.round_div(numerator, 400))
+
+    @tag('payment')
+    def test_fee_cents(self):
+        fees = list()
+        for (name, flat, fractional_pct) in (('stripe-transaction', '0.3000', '0.0290'),
+                                             ('poold-transaction', '0.0000', '0.0300')):
+            fee = FeeModel(name=name)
+            fee.flat = Decimal(flat)
+            fee.fractional_pct = Decimal(fractional_pct)
+            fees.append(fee)
+        (final, fee_cents) = payment.FeeSchedule(fees).price_cents(Decimal('100.0000'))
+        assert_equal(10639, final)
+        assert_equal([300, 339], fee_cents)
+
+
+class TestPooledRequests(PooldLibBaseTest):
+
+    def setUp(self):
+        self.server = FakeStripeServer()
+        self.server.start()
+        self.addCleanup(self.server.stop)
+
+    @tag('payment')
+    def test_connection_reused(self):
+        first = payment._Token.create(api_key='sk_test', api_base=self.server.api_base, customer='cus_test')
+        second = payment._Token.create(api_key='sk_test', api_base=self.server.api_base, customer='cus_test')
+        assert_true(first.id.startswith('tok_'))
+        assert_true(first.id != second.id)
+        assert_equal(1, len(self.server.connections))
+
+
+class TestFakeStripeServer(PooldLibBaseTest):
+
+    def setUp(self):
+        self.server = FakeStripeServer()
+        self.server.start()
+        self.addCleanup(self.server.stop)
+
+        self.logger_patcher = patch('pooldlib.payment.logger')
+        self.logger_patcher.start()
+        self.addCleanup(self.logger_patcher.stop)
+
+        self.user = Mock()
+        self.user.id = uuid().hex
+        self.user.email = 'StripeUser-%s@example.com' % self.user.id
+        self.user.stripe_customer_id = 'cus_%s' % uuid().hex
+        self.currency = Mock()
+        self.currency.code = 'USD'
+        self.customer = payment.StripeCustomer('sk_test', api_base=self.server.api_base)
+
+    @tag('payment')
+    def test_charge(self):
+        charge = self.customer.charge(1000, 30, self.currency, self.user, 'Test charge')
+        assert_true(charge.id.startswith('ch_'))
+        assert_equal(1000, charge.amount)
+        assert_equal(1, self.server.calls['/v1/tokens'])
+        assert_equal(1, self.server.calls['/v1/charges'])
+
+    @tag('payment')
+    def test_idempotent_charge(self):
+        key = uuid().hex
+        first = self.customer.charge(1000, 30, self.currency, self.user, 'Test charge', idempotency_key=key)
+        second = self.customer.charge(1000, 30, self.currency, self.user, 'Test charge', idempotency_key=key)
+        assert_equal(first.id, second.id)
+        assert_equal(2, self.server.calls['/v1/charges'])
+        assert_equal(1, self.server.created['/v1/charges'])
+
+    @tag('payment')
+    def test_authorization_code(self):
+        stripe_user = payment.StripeUser('sk_test', api_base=self.server.connect_api_base)
+        ret = stripe_user.process_authorization_code(uuid().hex, self.user)
+        assert_true(ret['access_token'].startswith('sk_test_'))
+        assert_true(ret['user_id'].startswith('acct_'))
+
+    @tag('payment')
+    @raises(stripe.CardError)
+    def test_card_error(self):
+        self.server.fail('/v1/charges', 'card')
+        self.customer.charge(1000, 30, self.currency, self.user, 'Test charge')
+
+    @tag('payment')
+    @raises(stripe.InvalidRequestError)
+    def test_connect_error(self):
+        self.server.fail('/oauth/token', 'invalid_request')
+        stripe_user = payment.StripeUser('sk_test', api_base=self.server.connect_api_base)
+        stripe_user.process_authorization_code(uuid().hex, self.user)
+
+    @tag('payment')
+    def test_connection_error(self):
+        self.server.fail('/v1/customers', 'connection')
+        try:
+            self.customer.token_for_customer(uuid().hex, self.user)
+        except stripe.APIConnectionError:
+            pass
+        else:
+            raise AssertionError('APIConnectionError not raised.')
+        stripe_user_id = self.customer.token_for_customer(uuid().hex, self.user)
+        assert_true(stripe_user_id.startswith('cus_'))
+
+    @tag('payment')
+    def test_install(self):
+        with FakeStripeServer() as server:
+            payment.StripeCustomer('sk_test').token_for_customer(uuid().hex, self.user)
+            assert_equal(1, server.calls['/v1/customers'])
+        assert_equal('https://api.stripe.com/v1', stripe.api_base)
+        assert_equal('https://connect.stripe.com', payment.StripeConnectRequestor.api_base)
+
+
+class TestCircuitBreaker(PooldLibBaseTest):
+
+    def setUp(self):
+        self.logger_patcher = patch('pooldlib.payment.logger')
+        self.logger_patcher.start()
+        self.addCleanup(self.logger_patcher.stop)
+        self.breaker = payment.CircuitBreaker('Test', window=4, min_calls=4, error_rate=0.5,
+                                              slow_call=1.0, reset_timeout=60)
+
+    def call(self, seconds=0.01, failed=False):
+        probe = self.breaker.acquire()
+        self.breaker.record(probe, seconds, failed=failed)
+
+    @tag('payment')
+    def test_opens_on_error_rate(self):
+        self.call()
+        self.call(failed=True)
+        self.call()
+        assert_equal('closed', self.breaker.state)
+        self.call(seconds=2.0)
+        assert_equal('open', self.breaker.state)
+        assert_raises(ExternalAPIUnavailableError, self.breaker.acquire)
+        assert_equal(1, self.breaker.stats()['rejected'])
+
+    @tag('payment')
+    def test_rolling_window(self):
+        self.call(failed=True)
+        for i in range(3):
+            self.call()
+        # The first failure falls out of the window.
+        self.call(failed=True)
+        assert_equal('closed', self.breaker.state)
+        assert_equal(0.25, self.breaker.stats()['error_rate'])
+
+    @tag('payment')
+    def test_half_open(self):
+        for i in range(4):
+            self.call(failed=True)
+        self.breaker.reset_timeout = 0
+        probe = self.breaker.acquire()
+        assert_true(probe)
+        assert_equal('half-open', self.breaker.state)
+        # Only one probe at a time is let through.
+        assert_raises(ExternalAPIUnavailableError, self.breaker.acquire)
+        self.breaker.record(probe, 0.01, failed=True)
+        assert_equal('open', self.breaker.state)
+
+        self.call()
+        assert_equal('closed', self.breaker.state)
+        assert_equal(0, self.breaker.stats()['calls'])
+
+    @tag('payment')
+    def test_latency_stats(self):
+        assert_true(self.breaker.stats()['p50'] is None)
+        for i in range(1, 101):
+            self.call(seconds=i / 1000.0)
+        stats = self.breaker.stats()
+        assert_equal(0.05, stats['p50'])
+        assert_equal(0.099, stats['p99'])
+
+    @tag('payment')
+    def test_guards_stripe_requests(self):
+        breaker = payment.CircuitBreaker('Stripe', min_calls=2, reset_timeout=60)
+        with patch('pooldlib.payment.breaker', breaker):
+            with FakeStripeServer() as server:
+                server.fail('/v1/tokens', 'api', times=2)
+                for i in range(2):
+                    assert_raises(stripe.APIError, payment._Token.create, api_key='sk_test', customer='cus_test')
+                assert_raises(ExternalAPIUnavailableError, payment._Token.create, api_key='sk_test', customer='cus_test')
+                assert_equal(2, server.calls['/v1/tokens'])
+
 
 class TestTokenExchange(PooldLibPostgresBaseTest):
 
@@ -138,7 +348,7 @@ class TestTokenExchange(PooldLibPostgresBaseTest):
         exp_kwargs = dict(description='Poold user: %s' % self.user.id,
                           card=token,
                           email=self.user.email)
-        mock_customer_module.create.assert_called_once_with(api_key=None, **exp_kwargs)
+        mock_customer_module.create.assert_called_once_with(api_key=None, api_base=None, **exp_kwargs)
         assert_equal(mock_customer.id, stripe_user_id)
         self.patched_logger.transaction.assert_called_once_with('New Stripe Customer Created',
                                                                 **exp_kwargs)